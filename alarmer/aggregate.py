@@ -0,0 +1,534 @@
+# -*- coding: UTF-8 -*-
+"""
+Sending Events from many hosts to one place, so a fleet-wide incident turns
+into a handful of notifications instead of one flood per host.
+
+An Agent takes the place of the Dispatcher on each monitored host, and streams
+compact Event records to a Collector over TCP; one JSON object per line. The
+Collector merges the records for a service & process from every host into one
+FleetEvent, and owns the notification channels (a Dispatcher, used in process).
+
+Agents are not authenticated, and the stream isn't encrypted; anyone who can
+reach the Collector can have it send notifications. It listens on localhost by
+default; only listen further out on a private network, with the port
+firewalled to the agents.
+
+Requires Python 3.4+
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import json
+import math
+import time
+import socket
+import select
+import selectors
+import threading
+from collections import deque
+
+from .monitoring import Event, EventStore, DIED
+
+
+def parse_address(address, default_host='0.0.0.0'):
+    """
+    Split a 'host:port' string, like from the [aggregate] section of the ini
+
+    -Returns- Tuple of (host, port)
+
+    -Raises- ValueError when the port is missing, or not a number
+
+    @param address
+        The string to split; IPv6 hosts go in brackets, i.e. [::1]:7117
+
+    @param default_host
+        The host to use when the string is just ':port'.
+        Default is '0.0.0.0'
+    """
+    host, sep, port = address.strip().rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError('Address must be host:port, not {0!r}'.format(address))
+    return host.strip('[]') or default_host, int(port)
+
+
+def encode(event, host):
+    """
+    Turn an Event into a record of the wire format
+
+    -Returns- Bytes; one line, ending in a newline
+
+    @param event
+        An instance of Event
+
+    @param host
+        The name of the host the Event came from
+    """
+    record = {'h' : host,
+              's' : event.service,
+              'p' : event.process,
+              'pid' : event.pid,
+              'b' : event.birth,
+              'l' : event.last_event,
+              'n' : event.event_count,
+              'k' : event.kind,
+              'd' : event.detail,
+             }
+    return json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+def decode(line):
+    """
+    Turn a record of the wire format back into a dictionary
+
+    -Returns- Dictionary with the keys host, service, process, pid, birth,
+              last_event, event_count, kind and detail
+
+    -Raises- ValueError when the record is malformed, or a field is the wrong type
+
+    @param line
+        Bytes of one record, with or without the newline
+    """
+    try:
+        record = json.loads(line.decode('utf-8'))
+        decoded = {'host' : record['h'],
+                   'service' : record['s'],
+                   'process' : record['p'],
+                   'pid' : list(record['pid']),
+                   'birth' : record['b'],
+                   'last_event' : record['l'],
+                   'event_count' : record['n'],
+                   'kind' : record.get('k', DIED),
+                   'detail' : record.get('d'),
+                  }
+    except (KeyError, TypeError, AttributeError, UnicodeDecodeError) as doh:
+        raise ValueError('Malformed record: {0!r}'.format(doh))
+    for key in ('host', 'service', 'process', 'kind'):
+        if not isinstance(decoded[key], str):
+            raise ValueError('Malformed record: {0} must be a string, not {1!r}'.format(key, decoded[key]))
+    if decoded['detail'] is not None and not isinstance(decoded['detail'], str):
+        raise ValueError('Malformed record: detail must be a string, not {0!r}'.format(decoded['detail']))
+    for key in ('birth', 'last_event'):
+        if not _number(decoded[key]):
+            raise ValueError('Malformed record: {0} must be a number, not {1!r}'.format(key, decoded[key]))
+        decoded[key] = float(decoded[key])
+    if not _number(decoded['event_count'], integer=True):
+        raise ValueError('Malformed record: event_count must be an integer, not {0!r}'.format(decoded['event_count']))
+    if not all(_number(x, integer=True) for x in decoded['pid']):
+        raise ValueError('Malformed record: pid must be a list of integers, not {0!r}'.format(decoded['pid']))
+    return decoded
+
+
+def _number(value, integer=False):
+    """Is the value from a record a finite number (and not a boolean)?"""
+    if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)):
+        return False
+    return math.isfinite(value)
+
+
+class FleetEvent(Event):
+    """
+    An Event for a service & process, merged across every host that reported it.
+    The event_count is the total across every host.
+
+    @param record
+        The first record for the service & process, from decode()
+    """
+    __slots__ = ('hosts',)
+
+    def __init__(self, record):
+        super(FleetEvent, self).__init__(record['service'], record['process'], None, now=record['birth'],
+                                         kind=record['kind'], detail=record['detail'])
+        self._pid.clear()
+        self.event_count = 0
+        # host -> [birth of the host's Event, count from older Events, count of the current Event]
+        self.hosts = {}
+        self.merge(record)
+
+    def __repr__(self):
+        return 'FleetEvent(name={0}, hosts={1}, event_count={2})'.format(self.name, len(self.hosts), self.event_count)
+
+    def merge(self, record):
+        """
+        Fold in a record from a host. Records carry the running totals of the
+        Event on the host, so getting the same record twice doesn't count twice.
+
+        -Returns- Boolean; True if the record had something new
+
+        @param record
+            A record for the same service & process, from decode()
+        """
+        entry = self.hosts.get(record['host'])
+        if entry is None:
+            entry = self.hosts[record['host']] = [record['birth'], 0, 0]
+        elif record['birth'] != entry[0]:
+            # the Event on the host went 'green', and this is a new one
+            entry[:] = [record['birth'], entry[1] + entry[2], 0]
+        if record['event_count'] <= entry[2]:
+            return False
+        entry[2] = record['event_count']
+        if record['detail'] is not None:
+            self.detail = record['detail']
+        if record['pid']:
+            self._pid.append(record['pid'][-1])
+        self.birth = min(self.birth, record['birth'])
+        self.last_event = max(self.last_event, record['last_event'])
+        self.event_count = sum(x[1] + x[2] for x in self.hosts.values())
+        return True
+
+
+class Agent(object):
+    """
+    Streams Events to a Collector, in place of running a Dispatcher on this host.
+
+    put() never blocks the monitoring loop; records wait in a bounded buffer
+    while the Collector is unreachable, and the oldest are dropped once it's
+    full. A background thread connects (and reconnects, with backoff) and sends
+    everything that's buffered in one write.
+
+    Stands in for the EventQueue in the blocking loop, and for the Dispatcher
+    in the asyncio Engine.
+
+    @param address
+        Tuple of (host, port) of the Collector
+
+    @param host
+        The name to report for this host.
+        Default is None, which uses the hostname of this machine
+
+    @param maxsize
+        How many records can wait for the Collector.
+        Default is 10000
+
+    @param timeout
+        Seconds to wait on the Collector when connecting, and sending.
+        Default is 5
+
+    @param backoff
+        Seconds to wait before the first reconnect; doubled after every
+        failure, up to MAX_BACKOFF.
+        Default is 1
+    """
+    MAX_BACKOFF = 60
+
+    def __init__(self, address, host=None, maxsize=10000, timeout=5, backoff=1):
+        self.address = address
+        self.host = host or socket.gethostname()
+        self.timeout = timeout
+        self.backoff = backoff
+        self.sent = 0
+        self.dropped = 0
+        self.connects = 0
+        self._buffer = deque(maxlen=maxsize)
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._sock = None
+        self._thread = None
+
+    def __repr__(self):
+        return 'Agent(collector={0}:{1}, depth={2})'.format(self.address[0], self.address[1], self.depth)
+
+    @property
+    def depth(self):
+        """How many records are waiting to be sent"""
+        return len(self._buffer)
+
+    def stats(self):
+        """
+        -Returns- Dictionary of counters about the Agent
+        """
+        return {'depth' : self.depth,
+                'sent' : self.sent,
+                'dropped' : self.dropped,
+                'connects' : self.connects,
+                'connected' : self._sock is not None,
+               }
+
+    def start(self):
+        """Start the sender thread"""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='agent')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the sender thread; anything still buffered is not sent"""
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._disconnect()
+
+    def put(self, event):
+        """
+        Queue an Event for the Collector; never blocks
+
+        -Returns- Boolean; always True, like EventQueue.put
+        """
+        line = encode(event, self.host)
+        with self._cond:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1 # the deque drops the oldest
+            self._buffer.append(line)
+            self._cond.notify()
+        return True
+
+    def flush(self):
+        """
+        Nothing waits on the monitoring side of an Agent; here to match EventQueue
+
+        -Returns- Integer; always 0
+        """
+        return 0
+
+    def dispatch(self, event):
+        """Queue an Event for the Collector; here to match Dispatcher"""
+        self.put(event)
+
+    def digest_due(self):
+        """The Collector does the digest; here to match Dispatcher"""
+        return None
+
+    def flush_digest(self, force=False):
+        """The Collector does the digest; here to match Dispatcher"""
+        pass
+
+    def _connect(self):
+        self._sock = socket.create_connection(self.address, timeout=self.timeout)
+        self.connects += 1
+
+    def _disconnect(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except socket.error:
+                pass
+            self._sock = None
+
+    def _closed(self):
+        """Has the Collector hung up? It never sends, so readable means EOF"""
+        readable, _, _ = select.select([self._sock], [], [], 0)
+        return bool(readable)
+
+    def _run(self):
+        delay = self.backoff
+        while not self._stopped.is_set():
+            with self._cond:
+                while not self._buffer and not self._stopped.is_set():
+                    self._cond.wait()
+                if self._stopped.is_set():
+                    return
+                batch = list(self._buffer)
+                self._buffer.clear()
+            try:
+                if self._sock is not None and self._closed():
+                    self._disconnect()
+                if self._sock is None:
+                    self._connect()
+                self._sock.sendall(b''.join(batch))
+            except (socket.error, OSError):
+                self._disconnect()
+                self._requeue(batch)
+                self._stopped.wait(delay)
+                delay = min(delay * 2, self.MAX_BACKOFF)
+                continue
+            self.sent += len(batch)
+            delay = self.backoff
+
+    def _requeue(self, batch):
+        """Put a batch that failed back in front of anything newer, while there's room"""
+        with self._cond:
+            room = self._buffer.maxlen - len(self._buffer)
+            keep = batch[len(batch) - room:] if room < len(batch) else batch
+            self.dropped += len(batch) - len(keep)
+            self._buffer.extendleft(reversed(keep))
+
+
+class Collector(object):
+    """
+    Receives Event records from many Agents, and notifies once per service &
+    process for the whole fleet. One thread and a selector serve every Agent,
+    so thousands of Agents don't need thousands of threads.
+
+    The first record for a service & process is sent to the Dispatcher right
+    away. Records from other hosts are merged into the open FleetEvent, and go
+    out with its periodic alert (every rate seconds) until it goes 'green'.
+    Agents and the Collector should use the same rate and reset_after.
+
+    @param address
+        Tuple of (host, port) to listen on; port 0 picks a free port
+
+    @param dispatcher
+        An instance of Dispatcher that's been setup(); used in process
+
+    @param logger
+        A Python logger object
+
+    @param reset_after
+        How long, in seconds, an Event needs to be quiet before it's removed
+
+    @param rate
+        How often, in seconds, to alert again on an open Event
+
+    @param max_line
+        The biggest record, in bytes, before an Agent is disconnected.
+        Default is 65536
+    """
+    BACKLOG = 1024
+
+    def __init__(self, address, dispatcher, logger, reset_after, rate, max_line=65536):
+        self.dispatcher = dispatcher
+        self.log = logger
+        self.events = EventStore(reset_after=reset_after, rate=rate)
+        self.max_line = max_line
+        self.received = 0
+        self.malformed = 0
+        self._agents = {}
+        self._selector = selectors.DefaultSelector()
+        family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(address)
+        self._sock.listen(self.BACKLOG)
+        self._sock.setblocking(False)
+        self._selector.register(self._sock, selectors.EVENT_READ, None)
+
+    def __repr__(self):
+        return 'Collector(address={0}:{1}, agents={2}, events={3})'.format(self.address[0],
+                                                                          self.address[1],
+                                                                          len(self._agents),
+                                                                          len(self.events))
+
+    def __len__(self):
+        """How many Agents are connected"""
+        return len(self._agents)
+
+    @property
+    def address(self):
+        """The (host, port) the Collector is listening on"""
+        return self._sock.getsockname()[:2]
+
+    def serve_forever(self):
+        """Handle records from Agents until the process is killed"""
+        while True:
+            self.serve_once()
+
+    def serve_once(self, timeout=None):
+        """
+        Wait for records from Agents (or the next alert), and handle them
+
+        @param timeout
+            The max number of seconds to wait.
+            Default is None, which waits until the next alert is due
+        """
+        wait = self._next_wakeup()
+        if timeout is not None:
+            wait = timeout if wait is None else min(wait, timeout)
+        for key, _ in self._selector.select(wait):
+            if key.data is None:
+                self._accept()
+            else:
+                self._read(key.fileobj, key.data)
+        self.events.expire()
+        for event in self.events.due():
+            self.dispatcher.dispatch(event)
+        self.dispatcher.flush_digest()
+
+    def _next_wakeup(self):
+        """Seconds until a periodic alert or the digest is due; None if neither"""
+        waits = []
+        due = self.events.next_due()
+        if due is not None:
+            waits.append(max(0, due - time.time()))
+        digest = self.dispatcher.digest_due()
+        if digest is not None:
+            waits.append(digest)
+        return min(waits) if waits else None
+
+    def _accept(self):
+        while True:
+            try:
+                conn, peer = self._sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            conn.setblocking(False)
+            self._agents[conn] = peer
+            self._selector.register(conn, selectors.EVENT_READ, bytearray())
+
+    def _read(self, conn, buf):
+        try:
+            chunk = conn.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            chunk = b''
+        if not chunk:
+            self._drop(conn)
+            return
+        buf.extend(chunk)
+        while True:
+            end = buf.find(b'\n')
+            if end < 0:
+                break
+            line = bytes(buf[:end])
+            del buf[:end + 1]
+            if line.strip():
+                self._handle(line, conn)
+        if len(buf) > self.max_line:
+            self.log.warning('Record from agent {0} is over {1} bytes; disconnecting'.format(self._agents.get(conn), self.max_line))
+            self._drop(conn)
+
+    def _handle(self, line, conn):
+        try:
+            record = decode(line)
+        except ValueError as doh:
+            self.malformed += 1
+            self.log.warning('Bad record from agent {0}: {1}'.format(self._agents.get(conn), doh))
+            return
+        try:
+            self.receive(record)
+        except Exception as doh:
+            # one bad record from one agent must not take down the whole fleet
+            self.malformed += 1
+            self.log.exception('Dropped record from agent {0} that could not be merged: {1}'.format(self._agents.get(conn), doh))
+
+    def _drop(self, conn):
+        self._selector.unregister(conn)
+        self._agents.pop(conn, None)
+        conn.close()
+
+    def receive(self, record, now=None):
+        """
+        Merge a record into the open FleetEvent for its service & process, and
+        send it to the Dispatcher if it's news to the fleet.
+
+        -Returns- The FleetEvent, or None if the record was too old to matter
+
+        @param record
+            A dictionary, from decode()
+
+        @param now
+            When the record was received, in EPOC time.
+            Default is None, which uses the current time
+        """
+        if now is None:
+            now = time.time()
+        self.received += 1
+        event = self.events.get(record['service'], record['process'], record['kind'])
+        if event is None:
+            if now - record['last_event'] >= self.events.reset_after:
+                # a periodic alert for an Event that's 'green' here already
+                return None
+            event = FleetEvent(record)
+            self.events.add(event, now=now)
+            self.dispatcher.dispatch(event)
+        else:
+            event.merge(record)
+        return event
+
+    def close(self):
+        """Disconnect every Agent, and stop listening"""
+        for conn in list(self._agents):
+            self._drop(conn)
+        self._selector.unregister(self._sock)
+        self._sock.close()
+        self._selector.close()
@@ -18,6 +18,152 @@ except ImportError:
 
 FILE_PATH = os.path.join('alarmer', 'alarmer.ini')
 
+# The types expected for settings in the ini; validated when the file is loaded
+# so that bad values are found at startup, not in the middle of sending an alert
+SCHEMA = {
+    'monitor' : {'frequency' : (int, float),
+                 'rate' : (int, float),
+                 'reset_after' : (int, float),
+                 'scanner' : str,
+                 'exit_watch' : bool,
+                 'queue_size' : int,
+                 'overflow' : str,
+                 'watch_config' : bool,
+                 'engine' : str,
+                 'mode' : str,
+                 'state_file' : str,
+                 'compact_every' : int,
+                 'threshold_samples' : int,
+                 'flap_window' : (int, float),
+                 'flap_restarts' : int,
+                 'flap_history' : int,
+                },
+    'dispatch' : {'enable_email' : bool,
+                  'enable_slack' : bool,
+                  'email_server_port' : int,
+                  'email_timeout' : (int, float),
+                  'email_workers' : int,
+                  'slack_workers' : int,
+                  'slack_timeout' : (int, float),
+                  'slack_batch' : int,
+                  'enable_webhook' : bool,
+                  'webhook_timeout' : (int, float),
+                  'webhook_workers' : int,
+                  'webhook_batch' : int,
+                  'queue_size' : int,
+                  'retries' : int,
+                  'retry_backoff' : (int, float),
+                  'rate_limit' : (int, float),
+                  'rate_burst' : int,
+                  'recipient_rate_limit' : (int, float),
+                  'recipient_burst' : int,
+                  'breaker_failures' : int,
+                  'breaker_cooldown' : (int, float),
+                  'digest_window' : (int, float),
+                  'ip_cache_ttl' : (int, float),
+                 },
+    'aggregate' : {'collector' : str,
+                   'listen' : str,
+                   'queue_size' : int,
+                   'timeout' : (int, float),
+                  },
+    'metrics' : {'listen' : str,
+                 'textfile' : str,
+                 'interval' : (int, float),
+                },
+    'logging' : {'level' : str,
+                 'location' : str,
+                 'rollover_count' : int,
+                 'max_size' : (int, float),
+                },
+}
+
+
+# The settings to use when the ini leaves them out, as they'd be written in the
+# ini; every setting in SCHEMA, and the strings read without casting
+DEFAULTS = {
+    'monitor' : {'frequency' : '30',
+                 'rate' : '30',
+                 'reset_after' : '90',
+                 'scanner' : 'auto',
+                 'exit_watch' : 'true',
+                 'queue_size' : '1000',
+                 'overflow' : 'block',
+                 'watch_config' : 'true',
+                 'engine' : 'loop',
+                 'mode' : 'standalone',
+                 'state_file' : '',
+                 'compact_every' : '1000',
+                 'threshold_samples' : '3',
+                 'flap_window' : '300',
+                 'flap_restarts' : '5',
+                 'flap_history' : '32',
+                },
+    'services' : {},
+    'dispatch' : {'enable_email' : 'true',
+                  'enable_slack' : 'false',
+                  'email_server_host' : 'localhost',
+                  'email_server_port' : '25',
+                  'email_to' : 'root@localhost',
+                  'email_timeout' : '10',
+                  'email_workers' : '2',
+                  'slack_workers' : '2',
+                  'slack_url' : '',
+                  'slack_timeout' : '10',
+                  'slack_batch' : '20',
+                  'enable_webhook' : 'false',
+                  'webhook_url' : '',
+                  'webhook_timeout' : '10',
+                  'webhook_workers' : '2',
+                  'webhook_batch' : '50',
+                  'plugins' : '',
+                  'queue_size' : '1000',
+                  'retries' : '3',
+                  'retry_backoff' : '1',
+                  'rate_limit' : '0',
+                  'rate_burst' : '20',
+                  'recipient_rate_limit' : '0',
+                  'recipient_burst' : '10',
+                  'breaker_failures' : '5',
+                  'breaker_cooldown' : '60',
+                  'digest_window' : '0',
+                  'ip_cache_ttl' : '300',
+                  'report_interfaces' : '',
+                 },
+    'aggregate' : {'collector' : 'localhost:7117',
+                   'listen' : '127.0.0.1:7117',
+                   'queue_size' : '10000',
+                   'timeout' : '5',
+                  },
+    'metrics' : {'listen' : '',
+                 'textfile' : '',
+                 'interval' : '15',
+                },
+    'logging' : {'level' : 'INFO',
+                 'location' : '/tmp',
+                 'rollover_count' : '5',
+                 'max_size' : '10',
+                },
+}
+
+
+def cast_value(value):
+    """
+    Convert a string from the ini into a Python data type, like a float or
+    boolean. Casting to a function or class is not supported by design.
+
+    -Returns- The cast value, or the original string if it can't be cast
+
+    @param value
+        The string to cast
+    """
+    if value.title() in ('True', 'False'):
+        value = value.title()
+    try:
+        return ast.literal_eval(value)
+    except (SyntaxError, ValueError):
+        return value
+
 
 def find_config_file():
     """
@@ -39,7 +185,7 @@ def find_config_file():
         raise IOError('Unable to find {0}'.format(FILE_PATH))
 
 
-def get_config(section):
+def get_config(section, schema=None, defaults=None):
     """
     A helper function for finding and constructing the configuration
     object.
@@ -48,9 +194,18 @@ def get_config(section):
 
     @param section
         The default section to perform look ups in.
+
+    @param schema
+        The expected types of settings, like SCHEMA. See ConfigReader.
+        Default is None
+
+    @param defaults
+        The settings to use when the file leaves them out, like DEFAULTS. See
+        ConfigReader.
+        Default is None
     """
     config_file = find_config_file()
-    config = ConfigReader(config_file, section)
+    config = ConfigReader(config_file, section, schema=schema, defaults=defaults)
     return config
 
 def get_logger(name='alarmer.log', level=None, location=None, max_size=None, rollover_count=None):
@@ -103,11 +258,101 @@ def get_logger(name='alarmer.log', level=None, location=None, max_size=None, rol
     return logger
 
 
+class ConfigSection(object):
+    """
+    A read-only section of a ConfigSnapshot. Values are accessible as attributes
+    or by key; i.e. section.frequency or section['frequency']
+
+    @param name
+        The name of the section
+
+    @param values
+        A dictionary of the settings in the section
+    """
+    __slots__ = ('_name', '_values')
+
+    def __init__(self, name, values):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_values', dict(values))
+
+    def __repr__(self):
+        return 'ConfigSection(name={0}, items={1})'.format(self._name, ','.join(sorted(self._values)))
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('ConfigSection is read only')
+
+    def __getattr__(self, attr):
+        try:
+            return self._values[attr]
+        except KeyError:
+            raise AttributeError('No option {0} in section {1}'.format(attr, self._name))
+
+    def __getitem__(self, item):
+        return self._values[item]
+
+    def __contains__(self, item):
+        return item in self._values
+
+    def __iter__(self):
+        for item in self._values:
+            yield item
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, item, default=None):
+        return self._values.get(item, default)
+
+    def items(self):
+        return list(self._values.items())
+
+
+class ConfigSnapshot(object):
+    """
+    A read-only copy of the whole ini file, parsed and cast once. Sections are
+    accessible as attributes or by key; i.e. snapshot.monitor.frequency
+
+    @param sections
+        A dictionary mapping section name to a dictionary of its settings
+    """
+    __slots__ = ('_sections',)
+
+    def __init__(self, sections):
+        object.__setattr__(self, '_sections', {k : ConfigSection(k, v) for k, v in sections.items()})
+
+    def __repr__(self):
+        return 'ConfigSnapshot(sections={0})'.format(','.join(sorted(self._sections)))
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('ConfigSnapshot is read only')
+
+    def __getattr__(self, attr):
+        try:
+            return self._sections[attr]
+        except KeyError:
+            raise AttributeError('No section {0}'.format(attr))
+
+    def __getitem__(self, section):
+        return self._sections[section]
+
+    def __contains__(self, section):
+        return section in self._sections
+
+    def __iter__(self):
+        for section in self._sections:
+            yield section
+
+
 class ConfigReader(object):
     """
     Allows for strings to be cast into other data types from
     the supplied ini file.
 
+    The file is parsed and cast once when the object is created; look ups
+    after that never touch the parser.
+
+    -Raises- ConfigParsingError when a setting doesn't match the schema
+
     @param config_file
         The absolute file path to the configuration file
 
@@ -115,12 +360,97 @@ class ConfigReader(object):
         The area to look at in the config file when performing a look up.
         Reduces boiler plate as most objects will look in the same section
         for different bits of information.
+
+    @param schema
+        A dictionary mapping section name to a dictionary of setting name to
+        the expected type (or tuple of types) of the cast value. Every setting
+        in the schema must exist in the file (or in defaults), and have the
+        right type.
+        Default is None, which skips validation
+
+    @param defaults
+        A dictionary mapping section name to a dictionary of setting name to
+        the string to use when the file doesn't have the setting; so a file
+        from an older version keeps working after an upgrade.
+        Default is None, which only uses what's in the file
     """
-    def __init__(self, config_file, default_section):
-        self._config = ConfigParser.SafeConfigParser()
-        self._config.read(config_file)
+    def __init__(self, config_file, default_section, schema=None, defaults=None):
+        self.config_file = config_file
         self.default_section = default_section
+        self.schema = schema
+        self.defaults = defaults
+        self._raw = {}
+        self._cast = {}
+        self._mtime = None
+        self.reload()
+
+    def _stat(self):
+        try:
+            return os.stat(self.config_file).st_mtime
+        except OSError:
+            return None
+
+    def changed(self):
+        """
+        Has the config file been modified since it was last loaded? Only costs
+        a stat() call, so it's cheap enough to check every tick.
 
+        -Returns- Boolean
+        """
+        return self._stat() != self._mtime
+
+    def reload(self):
+        """
+        Read the config file again, and rebuild the snapshot. When the new file
+        doesn't match the schema, the old snapshot is kept.
+
+        **Note** Mutates state of object by replacing the snapshot
+
+        -Raises- ConfigParsingError when a setting doesn't match the schema
+        """
+        self._mtime = self._stat()
+        self._config = _make_parser()
+        self._config.read(self.config_file)
+        schema = self.schema
+        raw = {}
+        for section in self._config.sections():
+            raw[section] = dict(self._config.items(section))
+        for section, items in (self.defaults or {}).items():
+            found = raw.setdefault(section, {})
+            for item, value in items.items():
+                found.setdefault(item, value)
+        cast = {k : {item : cast_value(value) for item, value in raw[k].items()} for k in raw}
+        if schema:
+            validate(cast, schema)
+        self._raw = raw
+        self._cast = cast
+        self.snapshot = ConfigSnapshot(cast)
+
+    def load(self):
+        """
+        Read the config file again into a new ConfigReader, leaving this one as
+        it is; hand the new one to adopt() once it's been checked. The file
+        counts as seen, so changed() is False until it's modified again, even
+        when the new file is rejected.
+
+        -Returns- ConfigReader object
+
+        -Raises- ConfigParsingError when a setting doesn't match the schema
+        """
+        self._mtime = self._stat()
+        return ConfigReader(self.config_file, self.default_section, schema=self.schema, defaults=self.defaults)
+
+    def adopt(self, other):
+        """
+        Take the settings of another ConfigReader, like one from load()
+
+        **Note** Mutates state of object by replacing the snapshot
+        """
+        self._mtime = other._mtime
+        self._config = other._config
+        self._raw = other._raw
+        self._cast = other._cast
+        self.snapshot = other.snapshot
 
     def grab(self, item, section=None, cast=True):
         """
@@ -146,23 +476,13 @@ class ConfigReader(object):
         else:
             area = section
 
+        values = self._cast if cast else self._raw
         try:
-            value = self._config.get(area, item)
-        except ConfigParser.NoOptionError as doh:
-            raise ConfigParsingError(doh)
-        except ConfigParser.NoSectionError as doh:
-            raise ConfigParsingError(doh)
-
-        if cast:
-            if value.title() in ('True', 'False'):
-                value = value.title()
-            try:
-                answer = ast.literal_eval(value)
-            except (SyntaxError, ValueError):
-                answer = value
-        else:
-            answer = value
-        return answer
+            return values[area][item]
+        except KeyError:
+            if area not in values:
+                raise ConfigParsingError('No section: {0}'.format(area))
+            raise ConfigParsingError('No option {0} in section: {1}'.format(item, area))
 
     def grab_many(self, section=None):
         """
@@ -188,14 +508,54 @@ class ConfigReader(object):
             area = section
 
         try:
-            base = dict(self._config.items(area))
-        except ConfigParser.NoSectionError as doh:
-            raise ConfigParsingError(doh)
+            base = self._raw[area]
+        except KeyError:
+            raise ConfigParsingError('No section: {0}'.format(area))
         else:
             final = {k:base[k].split(',') for k in base}
             return final
 
 
+def _make_parser():
+    """
+    Python 3 dropped SafeConfigParser, and stopped stripping inline comments
+    by default.
+    """
+    try:
+        return ConfigParser.ConfigParser(inline_comment_prefixes=('#', ';'))
+    except TypeError:
+        return ConfigParser.SafeConfigParser()
+
+
+def validate(values, schema):
+    """
+    Check that cast settings have the types defined in a schema
+
+    -Raises- ConfigParsingError on the first setting that is missing or the wrong type
+
+    @param values
+        A dictionary mapping section name to a dictionary of cast settings
+
+    @param schema
+        A dictionary mapping section name to a dictionary of setting name to
+        the expected type (or tuple of types)
+    """
+    for section in schema:
+        if section not in values:
+            raise ConfigParsingError('No section: {0}'.format(section))
+        for item, kind in schema[section].items():
+            if item not in values[section]:
+                raise ConfigParsingError('No option {0} in section: {1}'.format(item, section))
+            value = values[section][item]
+            kinds = kind if isinstance(kind, tuple) else (kind,)
+            if str in kinds:
+                kinds += (type(''),) # unicode on Python 2
+            # bool is a subclass of int, but 'true' is not a valid number of seconds
+            if isinstance(value, bool) and bool not in kinds or not isinstance(value, kinds):
+                msg = 'Option {0} in section {1} must be {2}, not {3!r}'
+                raise ConfigParsingError(msg.format(item, section, '/'.join(x.__name__ for x in kinds), value))
+
+
 class ConfigParsingError(Exception):
      """
      A generic error when for failures in parsing the configuation file.
@@ -0,0 +1,301 @@
+# -*- coding: UTF-8 -*-
+"""
+An asyncio based alternative to the blocking loop in alarmer.main
+
+Checking services, expiring events, periodic re-alerts and sending
+notifications each run as their own task, on their own cadence. Tasks are
+scheduled against the event loop's monotonic clock, so a long scan doesn't
+make the others drift, and the Dispatcher runs in the same process (no fork).
+
+Requires Python 3.7+
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import time
+import signal
+import asyncio
+
+from .monitoring import Scheduler, WORKERS
+from .flapping import FLAPPING
+from .metrics import Registry, LoopMetrics, clock
+
+
+class Engine(object):
+    """
+    Runs the monitoring jobs as asyncio tasks.
+
+    @param config
+        An instance of the ConfigReader object; timings are read from it every
+        run, so they follow a reload of the config
+
+    @param logger
+        A Python logger object
+
+    @param services
+        Dictionary mapping service name to Service objects
+
+    @param index
+        The ServiceIndex for the services
+
+    @param table
+        The ProcessTable shared by the services
+
+    @param watcher
+        The exit watcher used by the Services
+
+    @param events
+        An instance of EventStore
+
+    @param dispatcher
+        An instance of Dispatcher; used in process, it's never started
+
+    @param scheduler
+        The Scheduler that says when each service is due for a check.
+        Default is None, which checks every service each frequency seconds
+
+    @param reload
+        A callable that takes no params, and returns the new ServiceIndex after
+        reloading the config (or None), like a partial of main._reload. Called
+        between scans after a SIGHUP, or when the config file changes.
+        Default is None, which never reloads
+
+    @param metrics
+        An instance of metrics.LoopMetrics to record in.
+        Default is None, which records in a Registry of its own
+
+    @param resources
+        An instance of ResourceMonitor, to check the services against their
+        CPU, RSS and FD limits.
+        Default is None, which doesn't check any limits
+
+    @param flaps
+        An instance of FlapDetector, to spot processes that keep restarting.
+        Default is None, which doesn't look for flapping
+    """
+    def __init__(self, config, logger, services, index, table, watcher, events, dispatcher, scheduler=None, reload=None,
+                 metrics=None, resources=None, flaps=None):
+        self.config = config
+        self.log = logger
+        self.services = services
+        self.index = index
+        self.table = table
+        self.watcher = watcher
+        self.events = events
+        self.dispatcher = dispatcher
+        self.scheduler = scheduler
+        self._reload = reload
+        self.metrics = metrics if metrics is not None else LoopMetrics(Registry())
+        self.resources = resources
+        self.flaps = flaps
+        self._outbox = None
+        self._wakeup = None
+        self._hup = None
+
+    def __repr__(self):
+        return 'Engine(services={0}, frequency={1})'.format(len(self.services), self.frequency)
+
+    @property
+    def frequency(self):
+        """Seconds between scans of the process table"""
+        return self.config.grab('frequency')
+
+    def run(self):
+        """Run the engine until the process is killed"""
+        asyncio.run(self.main())
+
+    async def main(self):
+        """Start every task, and wait on them"""
+        loop = asyncio.get_running_loop()
+        self._outbox = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._hup = asyncio.Event()
+        if hasattr(self.watcher, 'fileno'):
+            loop.add_reader(self.watcher.fileno(), self._on_exit)
+        if self._reload is not None and hasattr(signal, 'SIGHUP'):
+            loop.add_signal_handler(signal.SIGHUP, self._hup.set)
+        if self.scheduler is None:
+            self.scheduler = Scheduler(self.frequency)
+            for name in self.services:
+                self.scheduler.add(name)
+        tasks = [self.check(),
+                 self.periodic(self.expire, lambda: self.frequency),
+                 self.realert(),
+                 self.dispatch(),
+                ]
+        await asyncio.gather(*tasks)
+
+    async def periodic(self, job, interval):
+        """
+        Run a job every interval seconds, on the monotonic clock. The next run is
+        scheduled from when the last one was due, not when it finished, so a
+        slow run doesn't push back every run after it.
+
+        @param job
+            A coroutine function to run
+
+        @param interval
+            A callable that returns the seconds between runs; it's checked after
+            every run so the config can be reloaded
+        """
+        loop = asyncio.get_running_loop()
+        next_run = loop.time()
+        while True:
+            try:
+                await job()
+            except Exception:
+                self.log.exception('Task {0} failed'.format(job.__name__))
+            next_run += interval()
+            now = loop.time()
+            if next_run < now:
+                # fell more than a whole interval behind; don't try to catch up
+                next_run = now
+            await asyncio.sleep(next_run - now)
+
+    def send(self, event):
+        """Queue an Event for the dispatch task"""
+        self._outbox.put_nowait(event)
+
+    def _on_dead(self, service, name, pid):
+        self.metrics.deaths.inc(service=service)
+        event, is_new = self.events.record(service, name, pid)
+        if is_new:
+            self.send(event)
+            self._wakeup.set() # a new Event changes when the next re-alert is due
+        if self.flaps is not None:
+            detail = self.flaps.died(service, name)
+            if detail:
+                self._on_flap(service, name, pid, detail)
+
+    def _on_flap(self, service, name, pid, detail):
+        self.metrics.flaps.inc(service=service)
+        event, is_new = self.events.record(service, name, pid, kind=FLAPPING, detail=detail)
+        if is_new:
+            self.send(event)
+            self._wakeup.set()
+
+    def _on_workers(self, service):
+        for name, (count, started, exited) in service.workers.items():
+            self.metrics.workers.set(count, service=service.name, process=name)
+            self.metrics.worker_starts.inc(started, service=service.name, process=name)
+            self.metrics.worker_exits.inc(exited, service=service.name, process=name)
+        for name, pid, detail in service.worker_breaches():
+            event, is_new = self.events.record(service.name, name, pid, kind=WORKERS, detail=detail)
+            if is_new:
+                self.send(event)
+                self._wakeup.set()
+
+    def _on_breach(self, service, name, pid, kind, detail):
+        self.metrics.breaches.inc(service=service, kind=kind)
+        event, is_new = self.events.record(service, name, pid, kind=kind, detail=detail)
+        if is_new:
+            self.send(event)
+            self._wakeup.set()
+
+    async def check(self):
+        """Scan for each service when the Scheduler says it's due"""
+        while True:
+            # reload between scans, never during one; the scan refreshes the
+            # process table in another thread, and so does adding a service
+            if self._hup.is_set() or (self.config.grab('watch_config') and self.config.changed()):
+                self._hup.clear()
+                self._on_reload()
+            due = self.scheduler.due()
+            if due:
+                try:
+                    await self.scan(due)
+                except Exception:
+                    self.log.exception('Task scan failed')
+            # wake at least every frequency seconds, to notice config changes
+            next_due = self.scheduler.clock() + self.frequency
+            if self.scheduler.next_due() is not None:
+                next_due = min(next_due, self.scheduler.next_due())
+            try:
+                await asyncio.wait_for(self._hup.wait(), max(0, next_due - self.scheduler.clock()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def scan(self, names=None):
+        """
+        Scan the process table, and alert on processes that died
+
+        @param names
+            An iterable of the service names to check.
+            Default is None, which checks every service
+        """
+        loop = asyncio.get_running_loop()
+        tick_start = clock()
+        # walking the process table blocks; keep it off the event loop
+        await loop.run_in_executor(None, self.table.refresh)
+        found = self.index.route(self.table)
+        self.metrics.scan.observe(clock() - tick_start)
+        self.metrics.processes.set(self.table.scanned)
+        if names is None:
+            names = list(self.services)
+        due = [self.services[x] for x in names if x in self.services]
+        self.metrics.checks.inc(len(due))
+        status_start = clock()
+        for member in due:
+            new_pids, dead_pids = member.status(self.table, current=found.get(member.name, {}))
+            for name in dead_pids:
+                for pid in dead_pids[name]:
+                    self._on_dead(member.name, name, pid)
+            if self.flaps is not None:
+                for name, pids in new_pids.items():
+                    detail = self.flaps.born(member.name, name, len(pids))
+                    if detail:
+                        self._on_flap(member.name, name, pids[-1], detail)
+            if self.resources is not None:
+                for name, pid, kind, detail in self.resources.check(member):
+                    self._on_breach(member.name, name, pid, kind, detail)
+            if member.tree is not None:
+                self._on_workers(member)
+        self.metrics.status.observe(clock() - status_start)
+        self.metrics.tick.observe(clock() - tick_start)
+        # processes that exited before the watcher got a handle on them
+        self._on_exit()
+
+    def _on_exit(self):
+        """The exit watcher has processes to report"""
+        for key, pid in self.watcher.wait(0):
+            service, name = key
+            if service in self.services and self.services[service].reap(name, pid):
+                self._on_dead(service, name, pid)
+
+    def _on_reload(self):
+        if self._reload is None:
+            return
+        index = self._reload()
+        if index is not None:
+            self.index = index
+            self._wakeup.set() # the alert rate may have changed
+
+    async def expire(self):
+        """Remove the Events that have been 'green' for long enough"""
+        self.events.expire()
+        if self.flaps is not None:
+            self.flaps.expire()
+
+    async def realert(self):
+        """Send periodic alerts, sleeping until the next Event is due"""
+        while True:
+            for event in self.events.due():
+                self.send(event)
+            due = self.events.next_due()
+            timeout = None if due is None else max(0, due - time.time())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def dispatch(self):
+        """Hand Events to the Dispatcher, and send the digest when it's due"""
+        while True:
+            timeout = self.dispatcher.digest_due()
+            try:
+                event = await asyncio.wait_for(self._outbox.get(), timeout)
+            except asyncio.TimeoutError:
+                event = None
+            if event is not None:
+                self.dispatcher.dispatch(event)
+            self.dispatcher.flush_digest()
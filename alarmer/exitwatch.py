@@ -0,0 +1,282 @@
+# -*- coding: UTF-8 -*-
+"""
+Event driven detection of processes exiting.
+
+Instead of calling is_running() on every tracked process every tick, the
+ExitWatcher holds a pidfd for each process and waits on them with epoll; the
+kernel marks a pidfd readable the moment its process exits. Requires Linux 5.3+
+and Python 3.9+, otherwise PollingExitWatcher keeps the old behavior.
+
+Both watchers can be woken early with wake(), like from a signal handler; a
+signal alone doesn't end the wait, since Python retries the interrupted call
+(PEP 475).
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os
+import time
+import errno
+import select
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # not on Windows, where PollingExitWatcher just sleeps
+
+
+def get_exit_watcher():
+    """
+    Pick the best exit watcher for this machine.
+
+    -Returns- Instantiated ExitWatcher, or PollingExitWatcher when pidfds are not supported
+    """
+    if ExitWatcher.available():
+        return ExitWatcher()
+    return PollingExitWatcher()
+
+
+def _wake_pipe():
+    """
+    A pipe for waking a watcher; both ends are non-blocking, so waking from a
+    signal handler never blocks, and draining never hangs.
+
+    -Returns- Tuple of the (read, write) file descriptors, or (None, None)
+              when pipes can't be made non-blocking on this machine
+    """
+    if fcntl is None:
+        return None, None
+    read_fd, write_fd = os.pipe()
+    for fd in (read_fd, write_fd):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return read_fd, write_fd
+
+
+def _wake(write_fd):
+    """Write to a wake pipe; a full pipe will wake the watcher already"""
+    if write_fd is None:
+        return
+    try:
+        os.write(write_fd, b'\0')
+    except (IOError, OSError) as doh:
+        if doh.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+
+
+def _drain(read_fd):
+    """Empty a wake pipe"""
+    try:
+        while os.read(read_fd, 512):
+            pass
+    except (IOError, OSError) as doh:
+        if doh.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+
+
+class ExitWatcher(object):
+    """
+    Watches processes with pidfd_open and epoll.
+
+    Every watched process is tagged with a key, so the caller can route the exit
+    back to whatever was tracking the process; like a (service, process) pair.
+    A process can have many keys, when it's tracked by many services.
+    """
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._by_fd = {}
+        self._by_pid = {}
+        self._keys = {}
+        self._exited = []
+        self._wake_r, self._wake_w = _wake_pipe()
+        self._epoll.register(self._wake_r, select.EPOLLIN)
+
+    def __repr__(self):
+        return 'ExitWatcher(watching={0})'.format(len(self._by_fd))
+
+    def __len__(self):
+        """How many processes are being watched"""
+        return len(self._by_fd)
+
+    @staticmethod
+    def available():
+        """
+        Does this machine support pidfds?
+
+        -Returns- Boolean
+        """
+        if not (hasattr(os, 'pidfd_open') and hasattr(select, 'epoll')):
+            return False
+        try:
+            fd = os.pidfd_open(os.getpid())
+        except OSError:
+            return False
+        os.close(fd)
+        return True
+
+    def fileno(self):
+        """
+        The epoll file descriptor; readable when a watched process exits. Lets
+        an event loop (like asyncio) wait on every watched process at once.
+        """
+        return self._epoll.fileno()
+
+    def watching(self, pid):
+        """Is the supplied PID being watched?"""
+        return pid in self._by_pid
+
+    def wake(self):
+        """End the current (or next) wait() early; safe to call from a signal handler"""
+        _wake(self._wake_w)
+
+    def watch(self, proc, key=None):
+        """
+        Start watching a process for its exit.
+
+        @param proc
+            A process object, like psutil.Process or procfs.ProcRecord
+
+        @param key
+            Returned along with the PID by wait() when the process exits.
+            Default is None
+        """
+        if proc.pid in self._by_pid:
+            if key not in self._keys[proc.pid]:
+                self._keys[proc.pid].append(key)
+            return
+        try:
+            fd = os.pidfd_open(proc.pid)
+        except OSError as doh:
+            if doh.errno == errno.ESRCH:
+                # already gone; report it on the next wait()
+                self._exited.append((key, proc.pid))
+            # otherwise (like EMFILE or ENFILE) leave it unwatched; the scan of
+            # the process table still finds its exit
+            return
+        try:
+            running = proc.is_running()
+        except (OSError, IOError):
+            # can't tell, likely out of file descriptors; same as above
+            os.close(fd)
+            return
+        if not running:
+            # the PID was reused before we got a handle on it
+            os.close(fd)
+            self._exited.append((key, proc.pid))
+            return
+        self._epoll.register(fd, select.EPOLLIN)
+        self._by_fd[fd] = proc.pid
+        self._by_pid[proc.pid] = fd
+        self._keys[proc.pid] = [key]
+
+    def unwatch(self, pid, key=None):
+        """
+        Stop watching a process
+
+        @param pid
+            The PID to stop watching
+
+        @param key
+            Only drop this key; the process is still watched while it has other keys.
+            Default is None, which drops every key
+        """
+        keys = self._keys.get(pid, [])
+        if key is not None:
+            if key not in keys:
+                return
+            keys.remove(key)
+            if keys:
+                return
+        fd = self._by_pid.pop(pid, None)
+        self._keys.pop(pid, None)
+        if fd is not None:
+            self._by_fd.pop(fd, None)
+            self._epoll.unregister(fd)
+            os.close(fd)
+
+    def wait(self, timeout):
+        """
+        Block until a watched process exits, or the timeout is reached.
+
+        -Returns- List of tuples
+            index[0] -> the key supplied to watch()
+            index[1] -> the PID that exited
+
+        @param timeout
+            The max number of seconds to block for
+        """
+        if self._exited:
+            exited, self._exited = self._exited, []
+            return exited
+        exited = []
+        try:
+            ready = self._epoll.poll(max(0, timeout))
+        except (IOError, OSError) as doh:
+            if doh.errno == errno.EINTR:
+                return exited
+            raise
+        for fd, _ in ready:
+            if fd == self._wake_r:
+                _drain(fd)
+                continue
+            pid = self._by_fd[fd]
+            for key in self._keys[pid]:
+                exited.append((key, pid))
+            self.unwatch(pid)
+        return exited
+
+    def close(self):
+        """Release every pidfd, the wake pipe, and the epoll object"""
+        for pid in list(self._by_pid):
+            self.unwatch(pid)
+        self._epoll.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+
+class PollingExitWatcher(object):
+    """
+    Stand-in for ExitWatcher on machines without pidfds. Never reports an exit,
+    so dead processes are only found by polling is_running() every tick.
+    """
+    def __init__(self):
+        self._wake_r, self._wake_w = _wake_pipe()
+
+    def __repr__(self):
+        return 'PollingExitWatcher()'
+
+    def __len__(self):
+        return 0
+
+    @staticmethod
+    def available():
+        return True
+
+    def watching(self, pid):
+        return False
+
+    def wake(self):
+        _wake(self._wake_w)
+
+    def watch(self, proc, key=None):
+        pass
+
+    def unwatch(self, pid, key=None):
+        pass
+
+    def wait(self, timeout):
+        if self._wake_r is None:
+            time.sleep(max(0, timeout))
+            return []
+        try:
+            ready, _, _ = select.select([self._wake_r], [], [], max(0, timeout))
+        except (IOError, OSError, select.error) as doh:
+            if doh.args[0] == errno.EINTR:
+                return []
+            raise
+        if ready:
+            _drain(self._wake_r)
+        return []
+
+    def close(self):
+        if self._wake_r is not None:
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_r = self._wake_w = None
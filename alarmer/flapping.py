@@ -0,0 +1,202 @@
+# -*- coding: UTF-8 -*-
+"""
+Spotting a process that keeps getting restarted, like by a supervisor, which
+otherwise looks like one long Event that only ever counts up.
+
+The latest birth and death times of every service & process are kept in two
+fixed size rings, so the memory used stays the same no matter how long a
+process flaps for; a restart storm just overwrites the oldest times.
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import time
+
+from .resources import Ring
+
+FLAPPING = 'flapping'
+
+
+class _History(object):
+    """The latest births & deaths of one service & process"""
+    __slots__ = ('births', 'deaths')
+
+    def __init__(self, size):
+        self.births = Ring(size)
+        self.deaths = Ring(size)
+
+    @property
+    def last(self):
+        return max(self.births.last or 0, self.deaths.last or 0)
+
+
+class FlapDetector(object):
+    """
+    Counts how often the processes of services restart, over a sliding window.
+
+    A restart is a death and a birth of the same process name; a process is
+    flapping once it restarts the limit number of times within the window.
+
+    @param window
+        Seconds to count restarts over
+
+    @param restarts
+        How many restarts within the window is flapping. Zero turns off flap
+        detection
+
+    @param size
+        How many births & deaths to remember for each service & process; the
+        window can't count more restarts than this.
+        Default is 32, and never less than restarts
+    """
+    def __init__(self, window, restarts, size=32):
+        self.window = window
+        self.restarts = restarts
+        self.size = max(size, restarts)
+        self._history = {}
+
+    def __repr__(self):
+        return 'FlapDetector(window={0}, restarts={1}, tracking={2})'.format(self.window, self.restarts, len(self._history))
+
+    def __len__(self):
+        """How many service & process pairs have history"""
+        return len(self._history)
+
+    def update(self, window, restarts, size=None):
+        """
+        Change the settings, like after the config file was reloaded. The
+        history is dropped if the size of the rings changes.
+
+        @param window
+            Same as the window param when creating a FlapDetector
+
+        @param restarts
+            Same as the restarts param when creating a FlapDetector
+
+        @param size
+            Same as the size param when creating a FlapDetector.
+            Default is None, which keeps the current size
+        """
+        self.window = window
+        self.restarts = restarts
+        size = max(size or self.size, restarts)
+        if size != self.size:
+            self.size = size
+            self._history.clear()
+
+    def _get(self, service, process):
+        history = self._history.get((service, process))
+        if history is None:
+            history = self._history[(service, process)] = _History(self.size)
+        return history
+
+    def born(self, service, process, count=1, now=None):
+        """
+        Record new PIDs for a process
+
+        -Returns- String describing the flapping, or None when it's not flapping
+
+        @param service
+            The name of the service
+
+        @param process
+            The name of the process
+
+        @param count
+            How many new PIDs were found.
+            Default is 1
+
+        @param now
+            When the PIDs were found, in EPOC time.
+            Default is None, which uses the current time
+        """
+        if not self.restarts:
+            return None
+        if now is None:
+            now = time.time()
+        history = self._get(service, process)
+        for _ in range(count):
+            history.births.append(now)
+        return self._check(history, now)
+
+    def died(self, service, process, now=None):
+        """
+        Record a PID of a process that died
+
+        -Returns- String describing the flapping, or None when it's not flapping
+
+        @param service
+            The name of the service
+
+        @param process
+            The name of the process
+
+        @param now
+            When the PID died, in EPOC time.
+            Default is None, which uses the current time
+        """
+        if not self.restarts:
+            return None
+        if now is None:
+            now = time.time()
+        history = self._get(service, process)
+        history.deaths.append(now)
+        return self._check(history, now)
+
+    def rate(self, service, process, now=None):
+        """
+        How many times a process restarted within the window
+
+        -Returns- Integer
+
+        @param service
+            The name of the service
+
+        @param process
+            The name of the process
+
+        @param now
+            The end of the window, in EPOC time.
+            Default is None, which uses the current time
+        """
+        history = self._history.get((service, process))
+        if history is None:
+            return 0
+        if now is None:
+            now = time.time()
+        return self._restarts(history, now)
+
+    def _restarts(self, history, now):
+        since = now - self.window
+        return min(history.births.count_at_least(since), history.deaths.count_at_least(since))
+
+    def _check(self, history, now):
+        restarts = self._restarts(history, now)
+        if restarts < self.restarts:
+            return None
+        return 'restarted {0} times in the last {1:.1f} minutes ({2:.1f} per minute)'.format(restarts,
+                                                                                           self.window / 60,
+                                                                                           restarts * 60 / self.window)
+
+    def expire(self, now=None):
+        """
+        Forget the history of processes that haven't been born or died within
+        the window
+
+        -Returns- Integer; how many service & process pairs were forgotten
+
+        @param now
+            The current time, in EPOC time.
+            Default is None, which uses the current time
+        """
+        if now is None:
+            now = time.time()
+        since = now - self.window
+        stale = [key for key, history in self._history.items() if history.last < since]
+        for key in stale:
+            del self._history[key]
+        return len(stale)
+
+    def forget(self, service):
+        """Drop the history of a service, like when it's removed from the config"""
+        for key in [x for x in self._history if x[0] == service]:
+            del self._history[key]
@@ -0,0 +1,263 @@
+# -*- coding: UTF-8 -*-
+"""
+Keeps the open Events on disk, so a restart (or crash) of alarmer picks up the
+event counts and alert timers where it left off, instead of alerting on
+everything again.
+
+Every change to an Event is appended to a log, one JSON object per line, by a
+background thread; the monitoring loop only adds the change to a buffer in
+memory, so a slow disk never holds up a check. Once the log is long enough,
+the thread writes a snapshot of every open Event and starts a new log, so
+loading at startup only reads the snapshot and a short log.
+
+When the disk fails (ENOSPC, EIO...) the thread logs it, and keeps the changes
+buffered while it retries with backoff; once the buffer is full the oldest
+changes are dropped, and counted.
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os
+import json
+import time
+import errno
+import logging
+import threading
+from collections import deque
+
+from .monitoring import DIED
+
+# atomic on POSIX; Python 2 doesn't have os.replace
+_replace = getattr(os, 'replace', os.rename)
+
+
+class EventJournal(object):
+    """
+    An append-only log of changes to Events, with compacted snapshots.
+
+    @param path
+        The log file; the snapshot is kept next to it, as <path>.snapshot
+
+    @param compact_every
+        How many changes to append to the log before writing a snapshot.
+        Default is 1000
+
+    @param fsync
+        Set to False to skip the fsync after every write; faster, but a power
+        loss can lose the last few changes.
+        Default is True
+
+    @param logger
+        A Python logger object, for when the disk fails.
+        Default is None, which uses the logger of this module
+
+    @param maxsize
+        How many changes can wait to be written while the disk is failing;
+        the oldest are dropped once it's full.
+        Default is 100000
+
+    @param backoff
+        Seconds to wait before retrying a failed write; doubled after every
+        failure, up to MAX_BACKOFF.
+        Default is 1
+    """
+    MAX_BACKOFF = 60
+
+    def __init__(self, path, compact_every=1000, fsync=True, logger=None, maxsize=100000, backoff=1):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.log = logger if logger is not None else logging.getLogger(__name__)
+        self.maxsize = maxsize
+        self.backoff = backoff
+        self.written = 0
+        self.compactions = 0
+        self.failures = 0
+        self.dropped = 0
+        self._reported = 0
+        self._state = {}
+        self._entries = 0
+        self._torn = False
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self._log = None
+
+    def __repr__(self):
+        return 'EventJournal(path={0}, events={1}, pending={2})'.format(self.path, len(self._state), len(self._buffer))
+
+    @property
+    def pending(self):
+        """How many changes are waiting to be written"""
+        return len(self._buffer)
+
+    def load(self):
+        """
+        Read the snapshot, and replay the log on top of it. A line cut short by
+        a crash is skipped.
+
+        -Returns- List of tuples
+            index[0] -> the state of an Event, like from Event.__getstate__
+            index[1] -> when the Event is due for another alert, in EPOC time
+        """
+        state = {}
+        for path in (self.snapshot_path, self.path):
+            try:
+                with open(path, 'rb') as the_file:
+                    for line in the_file:
+                        try:
+                            self._apply(state, json.loads(line.decode('utf-8')))
+                        except (ValueError, KeyError, TypeError, IndexError):
+                            continue
+            except (IOError, OSError) as doh:
+                if doh.errno != errno.ENOENT:
+                    raise
+        self._state = state
+        return [(tuple(x['e']), x['d']) for x in state.values()]
+
+    @staticmethod
+    def _apply(state, record):
+        """Update a dictionary of (service, process, kind) -> record with one change"""
+        if 'x' in record:
+            key = record['x']
+        else:
+            key = record['e'][:2] + record['e'][6:7]
+        if len(key) == 2:
+            key = key + [DIED] # written before Events had kinds
+        if 'x' in record:
+            state.pop(tuple(key), None)
+        else:
+            state[tuple(key)] = record
+
+    def write(self, event, alert_at):
+        """
+        Record the latest state of an Event; never blocks on the disk
+
+        @param event
+            An instance of Event
+
+        @param alert_at
+            When the Event is due for another alert, in EPOC time
+        """
+        self._put({'e' : list(event.__getstate__()), 'd' : alert_at})
+
+    def remove(self, event):
+        """
+        Record that an Event went 'green'; never blocks on the disk
+
+        @param event
+            An instance of Event
+        """
+        self._put({'x' : [event.service, event.process, event.kind]})
+
+    def _put(self, record):
+        with self._cond:
+            self._buffer.append(record)
+            self._trim()
+            self._cond.notify()
+
+    def _trim(self):
+        """Drop the oldest changes over maxsize; the caller holds the lock"""
+        while len(self._buffer) > self.maxsize:
+            self._buffer.popleft()
+            self.dropped += 1
+
+    def start(self):
+        """Open the log, and start the writer thread"""
+        self._log = open(self.path, 'ab')
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='journal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Write out every pending change, then stop the writer thread"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _run(self):
+        delay = self.backoff
+        while True:
+            with self._cond:
+                while not self._buffer and not self._stopped:
+                    self._cond.wait()
+                batch = list(self._buffer)
+                self._buffer.clear()
+                stopping = self._stopped
+            if batch:
+                try:
+                    self._write(batch)
+                except (IOError, OSError, ValueError) as doh:
+                    self.failures += 1
+                    self._torn = True
+                    if stopping:
+                        self.log.error('Lost {0} changes to journal {1}; could not write them before stopping: {2}'.format(len(batch), self.path, doh))
+                        return
+                    self.log.error('Failed to write {0} changes to journal {1}, retrying in {2}s: {3}'.format(len(batch), self.path, delay, doh))
+                    self._retry(batch, delay)
+                    delay = min(delay * 2, self.MAX_BACKOFF)
+                    continue
+                delay = self.backoff
+                if self.dropped > self._reported:
+                    self.log.error('Dropped {0} changes to journal {1} while it could not be written'.format(self.dropped - self._reported, self.path))
+                    self._reported = self.dropped
+            if stopping:
+                return
+
+    def _retry(self, batch, delay):
+        """Put a batch that failed back in front of the buffer, and wait out the delay or a stop"""
+        deadline = time.time() + delay
+        with self._cond:
+            self._buffer.extendleft(reversed(batch))
+            self._trim()
+            while not self._stopped and time.time() < deadline:
+                self._cond.wait(deadline - time.time())
+
+    def _write(self, batch):
+        lines = []
+        if self._torn:
+            # the last failed write may have left half a line; end it, so it's skipped by load()
+            lines.append(b'\n')
+        for record in batch:
+            self._apply(self._state, record)
+            lines.append(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+        if self._log is None:
+            self._log = open(self.path, 'ab')
+        self._log.write(b''.join(lines))
+        self._torn = False
+        self._sync(self._log)
+        self._entries += len(batch)
+        self.written += len(batch)
+        if self._entries >= self.compact_every:
+            self.compact()
+
+    def _sync(self, the_file):
+        the_file.flush()
+        if self.fsync:
+            os.fsync(the_file.fileno())
+
+    def compact(self):
+        """
+        Write a snapshot of every open Event, then start a new log. Only called
+        from the writer thread, or before start().
+        """
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as the_file:
+            for record in self._state.values():
+                the_file.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+            self._sync(the_file)
+        _replace(tmp_path, self.snapshot_path)
+        # the log only holds changes already in the snapshot; replaying it again is harmless
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+            self._log = open(self.path, 'wb')
+        self._entries = 0
+        self.compactions += 1
@@ -0,0 +1,307 @@
+# -*- coding: UTF-8 -*-
+"""
+Keeping a Channel from flooding someone, or from hanging on a dead mail host,
+during a bad incident.
+
+Each Channel can have a token bucket for the whole channel and one per
+recipient, so a burst of events is sent at a steady rate instead of as
+thousands of messages. A circuit breaker stops sending once enough attempts in
+a row have failed, so every send fails fast instead of waiting on a connection
+timeout; once the cooldown is up one send is let through as a probe, and the
+breaker closes again if it works.
+
+Whatever is held back by a bucket or the breaker is counted per event, and
+sent as one summary message once the channel can send again.
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import time
+import threading
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class TokenBucket(object):
+    """
+    Allows rate messages per minute on average, and bursts of up to burst
+    messages. Safe to share between threads.
+
+    @param rate
+        How many messages per minute; tokens are added at this rate
+
+    @param burst
+        The most tokens the bucket holds; i.e. how many messages can be sent
+        at once after a quiet spell.
+        Default is 1
+    """
+    def __init__(self, rate, burst=1, now=None):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.time() if now is None else now
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'TokenBucket(rate={0}, burst={1}, tokens={2:.1f})'.format(self.rate, self.burst, self._tokens)
+
+    def _refill(self, now):
+        elapsed = max(0, now - self._updated)
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate / 60)
+        self._updated = now
+
+    def take(self, now=None):
+        """
+        Use up a token, if there is one
+
+        -Returns- Boolean; False when the message should be held back
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._refill(now)
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def wait(self, now=None):
+        """
+        Seconds until there's a token
+
+        -Returns- Float
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._refill(now)
+            if self._tokens >= 1 or not self.rate:
+                return 0
+            return (1 - self._tokens) * 60 / self.rate
+
+
+class Buckets(object):
+    """
+    One TokenBucket per key, like per recipient; made the first time a key
+    is seen. Safe to share between threads.
+
+    @param rate
+        Same as the rate param of TokenBucket
+
+    @param burst
+        Same as the burst param of TokenBucket
+        Default is 1
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Buckets(rate={0}, burst={1}, keys={2})'.format(self.rate, self.burst, len(self._buckets))
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, now=None):
+        """
+        Use up a token from the bucket of a key
+
+        -Returns- Boolean; False when the message should be held back
+        """
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(key, TokenBucket(self.rate, self.burst, now=now))
+        return bucket.take(now=now)
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending after a number of failed attempts in a row, and lets one
+    probe through once the cooldown is up. Safe to share between threads.
+
+    @param failures
+        How many failed attempts in a row open the breaker
+
+    @param cooldown
+        Seconds to wait before probing an open breaker
+    """
+    def __init__(self, failures, cooldown):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self._failed = 0
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'CircuitBreaker(state={0}, failed={1})'.format(self.state, self._failed)
+
+    def allow(self, now=None):
+        """
+        Can a message be sent? Moves an open breaker to half-open once the
+        cooldown is up, and then only allows the one probe.
+
+        -Returns- Boolean
+        """
+        if self.state == CLOSED:
+            return True
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if self.state == OPEN and now - self._opened >= self.cooldown:
+                self.state = HALF_OPEN
+                return True
+            return self.state == CLOSED
+
+    def wait(self, now=None):
+        """
+        Seconds until a probe is allowed
+
+        -Returns- Float
+        """
+        if self.state != OPEN:
+            return 0
+        if now is None:
+            now = time.time()
+        return max(0, self._opened + self.cooldown - now)
+
+    def release(self):
+        """
+        Hand back the probe allow() let through, when it wasn't sent after all
+        (like when it was rate limited); so the next allow() can probe again
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    def success(self):
+        """
+        Record a message that was sent
+
+        -Returns- Boolean; True when this closed the breaker
+        """
+        with self._lock:
+            self._failed = 0
+            recovered = self.state != CLOSED
+            self.state = CLOSED
+            return recovered
+
+    def failure(self, now=None):
+        """
+        Record a failed attempt to send
+
+        -Returns- Boolean; True when this opened the breaker
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._failed += 1
+            if self.state == OPEN:
+                return False
+            if self.state == HALF_OPEN or self._failed >= self.failures:
+                self.state = OPEN
+                self._opened = now
+                return True
+            return False
+
+
+class Held(object):
+    """
+    Counts the messages held back from a channel, per event, until they're
+    sent as one summary. Safe to share between threads.
+
+    @param most
+        The most events to list by name in the summary; the rest are counted
+        together.
+        Default is 50
+    """
+    def __init__(self, most=50):
+        self.most = most
+        self._counts = {}
+        self._first = None
+        self._last = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Held(messages={0})'.format(len(self))
+
+    def __len__(self):
+        """How many messages are held"""
+        with self._lock:
+            return sum(self._counts.values())
+
+    def add(self, event_name, count=1, now=None):
+        """
+        Hold back a message
+
+        @param event_name
+            What the message was about
+
+        @param count
+            How many messages about the event.
+            Default is 1
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._counts[event_name] = self._counts.get(event_name, 0) + count
+            if self._first is None:
+                self._first = now
+            self._last = now
+
+    def take(self):
+        """
+        Empty out the held messages
+
+        -Returns- Tuple, or None when nothing is held
+            index[0] -> dictionary of event name to count
+            index[1] -> when the first message was held, in EPOC time
+            index[2] -> when the last message was held, in EPOC time
+        """
+        with self._lock:
+            if not self._counts:
+                return None
+            taken = (self._counts, self._first, self._last)
+            self._counts = {}
+            self._first = self._last = None
+        return taken
+
+    def restore(self, taken):
+        """Put back what take() returned, like when the summary couldn't be sent"""
+        counts, first, last = taken
+        with self._lock:
+            for event_name, count in counts.items():
+                self._counts[event_name] = self._counts.get(event_name, 0) + count
+            self._first = first if self._first is None else min(first, self._first)
+            self._last = last if self._last is None else max(last, self._last)
+
+    def summary(self, taken, channel):
+        """
+        The message to send in place of the held ones
+
+        -Returns- String
+
+        @param taken
+            What take() returned
+
+        @param channel
+            The name of the channel the messages were held back from
+        """
+        counts, first, last = taken
+        total = sum(counts.values())
+        lines = ['{0} {1} notifications were held back between {2} and {3}, while the channel was rate limited or down:'.format(
+                    total,
+                    channel,
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(first)),
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last)))]
+        ranked = sorted(counts.items(), key=lambda x: (-x[1], x[0]))
+        for event_name, count in ranked[:self.most]:
+            lines.append('    {0}: {1}'.format(event_name, count))
+        rest = ranked[self.most:]
+        if rest:
+            lines.append('    ...and {0} more from {1} other events'.format(sum(x[1] for x in rest), len(rest)))
+        return '\n'.join(lines)
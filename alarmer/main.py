@@ -1,13 +1,370 @@
 # -*- coding: UTF-8 -*-
 from __future__ import division
 
-import time
-import psutil
-from collections import deque
-from multiprocessing import Pipe
+import signal
 
-from .config import get_config, get_logger
-from .monitoring import Event, Service, Dispatcher
+from .config import get_config, get_logger, SCHEMA, DEFAULTS, ConfigParsingError
+from .monitoring import EventStore, EventQueue, Service, Dispatcher, ProcessTable, ServiceIndex, Scheduler, get_scanner, diff_services, WORKERS
+from .exitwatch import get_exit_watcher, PollingExitWatcher
+from .journal import EventJournal
+from .resources import ResourceMonitor, parse_thresholds
+from .flapping import FlapDetector, FLAPPING
+from .metrics import Registry, SharedRegistry, LoopMetrics, MetricsExporter, clock
+
+
+SEC_TO_MIN = 60
+MODES = ('standalone', 'agent', 'collector')
+
+
+def _on_dead(events, outbox, service, name, pid, metrics=None, flaps=None):
+    """
+    Record that a process of a service died, and alert on it if it's news
+
+    @param events
+        An instance of EventStore
+
+    @param outbox
+        An instance of EventQueue to the Dispatcher, or an Agent
+
+    @param service
+        The name of the service
+
+    @param name
+        The name of the process
+
+    @param pid
+        The PID that died
+
+    @param metrics
+        An instance of LoopMetrics, to count the death in.
+        Default is None
+
+    @param flaps
+        An instance of FlapDetector, to record the death in.
+        Default is None
+    """
+    if metrics is not None:
+        metrics.deaths.inc(service=service)
+    event, is_new = events.record(service, name, pid)
+    if is_new:
+        outbox.put(event) # push to dispatcher for alerting
+    if flaps is not None:
+        detail = flaps.died(service, name)
+        if detail:
+            _on_flap(events, outbox, service, name, pid, detail, metrics)
+
+
+def _on_flap(events, outbox, service, name, pid, detail, metrics=None):
+    """
+    Record that a process of a service keeps restarting, and alert on it if it's news
+
+    @param events
+        An instance of EventStore
+
+    @param outbox
+        An instance of EventQueue to the Dispatcher, or an Agent
+
+    @param service
+        The name of the service
+
+    @param name
+        The name of the process
+
+    @param pid
+        The latest PID of the process
+
+    @param detail
+        String describing the flapping, from FlapDetector
+
+    @param metrics
+        An instance of LoopMetrics, to count the flapping in.
+        Default is None
+    """
+    if metrics is not None:
+        metrics.flaps.inc(service=service)
+    event, is_new = events.record(service, name, pid, kind=FLAPPING, detail=detail)
+    if is_new:
+        outbox.put(event)
+
+
+def _on_breach(events, outbox, service, name, pid, kind, detail, metrics=None):
+    """
+    Record that a process of a service is over a limit, and alert on it if it's news
+
+    @param events
+        An instance of EventStore
+
+    @param outbox
+        An instance of EventQueue to the Dispatcher, or an Agent
+
+    @param service
+        The name of the service
+
+    @param name
+        The name of the process
+
+    @param pid
+        The PID that's over the limit
+
+    @param kind
+        Which limit; cpu, rss or fds
+
+    @param detail
+        String describing the breach, from ResourceMonitor.check
+
+    @param metrics
+        An instance of LoopMetrics, to count the breach in.
+        Default is None
+    """
+    if metrics is not None:
+        metrics.breaches.inc(service=service, kind=kind)
+    event, is_new = events.record(service, name, pid, kind=kind, detail=detail)
+    if is_new:
+        outbox.put(event)
+
+
+def _on_workers(events, outbox, service, metrics=None):
+    """
+    Record the worker counts of a process tree, and alert when a tree has too
+    few or too many workers
+
+    @param events
+        An instance of EventStore
+
+    @param outbox
+        An instance of EventQueue to the Dispatcher, or an Agent
+
+    @param service
+        An instance of Service, right after its status was checked
+
+    @param metrics
+        An instance of LoopMetrics, to record the worker counts in.
+        Default is None
+    """
+    if metrics is not None:
+        for name, (count, started, exited) in service.workers.items():
+            metrics.workers.set(count, service=service.name, process=name)
+            metrics.worker_starts.inc(started, service=service.name, process=name)
+            metrics.worker_exits.inc(exited, service=service.name, process=name)
+    for name, pid, detail in service.worker_breaches():
+        event, is_new = events.record(service.name, name, pid, kind=WORKERS, detail=detail)
+        if is_new:
+            outbox.put(event)
+
+
+def _trees(config):
+    """
+    Services tracked as process trees, from the optional [workers] section
+
+    -Returns- Dictionary mapping service name to a tuple of the (minimum, maximum)
+              expected workers; either can be None
+
+    -Raises- ConfigParsingError when the bounds are malformed
+    """
+    if 'workers' not in config.snapshot:
+        return {}
+    trees = {}
+    for name, items in config.grab_many(section='workers').items():
+        low, sep, high = ','.join(items).partition(':')
+        try:
+            if not sep:
+                raise ValueError
+            bounds = tuple(int(x) if x.strip() else None for x in (low, high))
+            if any(x is not None and x < 0 for x in bounds):
+                raise ValueError
+        except ValueError:
+            raise ConfigParsingError('Workers for service {0} must be min:max, like 2:16 or 2:, not {1!r}'.format(name, ','.join(items)))
+        trees[name] = bounds
+    return trees
+
+
+def _thresholds(config):
+    """
+    Per service CPU, RSS and FD limits, from the optional [thresholds] section
+
+    -Returns- Dictionary mapping service name to a dictionary of limits, like
+              from resources.parse_thresholds
+
+    -Raises- ConfigParsingError when a limit is malformed
+    """
+    if 'thresholds' not in config.snapshot:
+        return {}
+    thresholds = {}
+    for name, items in config.grab_many(section='thresholds').items():
+        try:
+            thresholds[name] = parse_thresholds(items)
+        except ValueError as doh:
+            raise ConfigParsingError('Thresholds for service {0}: {1}'.format(name, doh))
+    return thresholds
+
+
+def _intervals(config):
+    """
+    Per service check intervals, from the optional [intervals] section
+
+    -Returns- Dictionary mapping service name to seconds between checks
+
+    -Raises- ConfigParsingError when an interval isn't a positive number
+    """
+    if 'intervals' not in config.snapshot:
+        return {}
+    intervals = dict(config.snapshot.intervals.items())
+    for name, value in intervals.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            raise ConfigParsingError('Interval for service {0} must be a positive number, not {1!r}'.format(name, value))
+    return intervals
+
+
+def _reload(config, logger, services, table, watcher, events, scheduler, resources=None, flaps=None):
+    """
+    Read the config file again, and apply changes to [services] without losing
+    the state of services that didn't change.
+
+    -Returns- ServiceIndex for the new [services], or None if the config file
+              could not be loaded (the old config stays in use)
+
+    @param config
+        An instance of the ConfigReader object
+
+    @param logger
+        A Python logger object
+
+    @param services
+        Dictionary mapping service name to Service objects; updated in place
+
+    @param table
+        The ProcessTable used by the monitoring loop
+
+    @param watcher
+        The exit watcher used by the Services
+
+    @param events
+        An instance of EventStore; its timings are updated
+
+    @param scheduler
+        An instance of Scheduler; its services and intervals are updated
+
+    @param resources
+        An instance of ResourceMonitor; its limits are updated.
+        Default is None
+
+    @param flaps
+        An instance of FlapDetector; its settings are updated.
+        Default is None
+    """
+    old = config.grab_many(section='services')
+    # check the new file apart from the config in use, so a rejected file
+    # never becomes what the next reload is compared against
+    try:
+        candidate = config.load()
+        intervals = _intervals(candidate)
+        thresholds = _thresholds(candidate)
+        trees = _trees(candidate)
+        new = candidate.grab_many(section='services')
+        index = ServiceIndex(new)
+    except (ConfigParsingError, ValueError) as doh:
+        logger.error('Ignoring changes to config file {0}: {1}'.format(config.config_file, doh))
+        return None
+    config.adopt(candidate)
+    added, removed, changed = diff_services(old, new)
+    table.names = index
+    table.tree = bool(trees)
+    scheduler.update(config.grab('frequency'), intervals)
+    for name in removed:
+        services.pop(name).close()
+        scheduler.remove(name)
+    if resources is not None:
+        resources.update(thresholds, config.grab('threshold_samples'))
+        for name in removed:
+            resources.forget(name)
+    if flaps is not None:
+        flaps.update(config.grab('flap_window'), config.grab('flap_restarts'), config.grab('flap_history'))
+        for name in removed:
+            flaps.forget(name)
+    for name in changed:
+        services[name].update(new[name])
+    # what a service tracks is built for tree mode or not, so a service that
+    # switches modes starts over; otherwise its live workers look dead
+    retree = [x for x in services if (services[x].tree is None) != (trees.get(x) is None)]
+    for name in services:
+        services[name].tree = trees.get(name)
+    if added or retree:
+        table.refresh()
+        for name in retree:
+            services.pop(name).close()
+            services[name] = Service(name=name, processes=new[name], table=table, watcher=watcher, tree=trees.get(name))
+        for name in added:
+            services[name] = Service(name=name, processes=new[name], table=table, watcher=watcher, tree=trees.get(name))
+            scheduler.add(name)
+    events.rate = config.grab('rate') * SEC_TO_MIN
+    events.reset_after = config.grab('reset_after') * SEC_TO_MIN
+    logger.info('Reloaded config file {0}; added {1}, removed {2}, changed {3}'.format(config.config_file,
+                                                                                      sorted(added),
+                                                                                      sorted(removed),
+                                                                                      sorted(changed)))
+    return index
+
+
+def _make_agent(config):
+    """
+    Build and start an Agent, that sends Events to the collector in [aggregate]
+
+    -Returns- Instantiated, running Agent
+    """
+    # Python 3 only, so only import it when asked for
+    from .aggregate import Agent, parse_address
+    agent = Agent(parse_address(config.grab('collector', section='aggregate', cast=False)),
+                  maxsize=config.grab('queue_size', section='aggregate'),
+                  timeout=config.grab('timeout', section='aggregate'))
+    agent.start()
+    return agent
+
+
+def _start_metrics(config, registry):
+    """
+    Export the metrics, if the [metrics] section asks for it
+
+    -Returns- A running MetricsExporter, or None when metrics aren't exported
+    """
+    listen = config.grab('listen', section='metrics', cast=False)
+    textfile = config.grab('textfile', section='metrics', cast=False)
+    if not (listen or textfile):
+        return None
+    from .aggregate import parse_address
+    exporter = MetricsExporter(registry,
+                               listen=parse_address(listen, default_host='127.0.0.1') if listen else None,
+                               textfile=textfile or None,
+                               interval=config.grab('interval', section='metrics'))
+    exporter.start()
+    return exporter
+
+
+def collect(config, logger, metrics=None):
+    """
+    Run as the collector for a fleet of agents, until the process is killed
+
+    @param config
+        An instance of the ConfigReader object
+
+    @param logger
+        A Python logger object
+
+    @param metrics
+        The metrics.Registry for the Dispatcher to record in.
+        Default is None
+    """
+    from .aggregate import Collector, parse_address
+    dispatcher = Dispatcher(config, logger, metrics=metrics)
+    dispatcher.setup()
+    collector = Collector(parse_address(config.grab('listen', section='aggregate', cast=False)),
+                          dispatcher,
+                          logger,
+                          reset_after=config.grab('reset_after') * SEC_TO_MIN,
+                          rate=config.grab('rate') * SEC_TO_MIN)
+    logger.info('Collecting events from agents on {0}:{1}'.format(*collector.address))
+    if collector.address[0] not in ('127.0.0.1', '::1', 'localhost'):
+        logger.warning('Agents are not authenticated; make sure only they can reach port {0}'.format(collector.address[1]))
+    collector.serve_forever()
 
 
 def loop():
@@ -15,73 +372,158 @@ def loop():
     The main loop for monitoring and alerting on services
     """
     # Setup major objects
-    config = get_config('monitor')
+    config = get_config('monitor', schema=SCHEMA, defaults=DEFAULTS)
     logger = get_logger(level=config.grab('level', section='logging'),
                         location=config.grab('location', section='logging'),
                         max_size=config.grab('max_size', section='logging'),
                         rollover_count=config.grab('rollover_count', section='logging')
                         )
-    dispatcher = Dispatcher()
+    mode = config.grab('mode')
+    if mode not in MODES:
+        raise ConfigParsingError('Option mode in section monitor must be one of {0}, not {1!r}'.format(', '.join(MODES), mode))
+    registry = Registry()
+    _start_metrics(config, registry)
+    if mode == 'collector':
+        collect(config, logger, metrics=registry)
+        return
+    metrics = LoopMetrics(registry)
     _monitor = config.grab_many(section='services')
+    index = ServiceIndex(_monitor)
+    trees = _trees(config)
+    table = ProcessTable(names=index, scanner=get_scanner(config.grab('scanner')), tree=bool(trees))
+    if config.grab('exit_watch'):
+        watcher = get_exit_watcher()
+    else:
+        watcher = PollingExitWatcher()
     services = {}
     for member in _monitor:
-        services[_member] = Service(name=_member, processes=monitor[_member])
+        services[member] = Service(name=member, processes=_monitor[member], table=table, watcher=watcher, tree=trees.get(member))
 
     # Setup looping & alerting parmaters
-    events = {}
-    SEC_TO_MIN = 60
-    loop_run_frequency = config.grab('frequency')
+    scheduler = Scheduler(config.grab('frequency'), _intervals(config))
+    resources = ResourceMonitor(_thresholds(config), samples=config.grab('threshold_samples'))
+    flaps = FlapDetector(config.grab('flap_window'), config.grab('flap_restarts'), size=config.grab('flap_history'))
+    for member in services:
+        scheduler.add(member)
     alert_frequency = config.grab('rate') * SEC_TO_MIN
     event_reset_period = config.grab('reset_after') * SEC_TO_MIN
+    journal = None
+    if config.grab('state_file', cast=False):
+        # pick up the open Events from before a restart
+        journal = EventJournal(config.grab('state_file', cast=False), compact_every=config.grab('compact_every'), logger=logger)
+        states = journal.load()
+    events = EventStore(reset_after=event_reset_period, rate=alert_frequency, journal=journal)
+    if journal is not None:
+        logger.info('Restored {0} open events from {1}'.format(events.restore(states), journal.path))
+        journal.start()
+    metrics.watch(events)
+
+    if config.grab('engine') == 'asyncio':
+        # Python 3 only, so only import it when asked for
+        from .engine import Engine
+        if mode == 'agent':
+            dispatcher = _make_agent(config)
+        else:
+            dispatcher = Dispatcher(config, logger, metrics=registry)
+            dispatcher.setup()
+        engine = Engine(config, logger, services, index, table, watcher, events, dispatcher, scheduler,
+                        reload=lambda: _reload(config, logger, services, table, watcher, events, scheduler, resources, flaps),
+                        metrics=metrics, resources=resources, flaps=flaps)
+        engine.run()
+        return
+
+    # Start the dispatcher, or send events to the collector instead
+    if mode == 'agent':
+        outbox = _make_agent(config)
+    else:
+        outbox = EventQueue(maxsize=config.grab('queue_size'), overflow=config.grab('overflow'))
+        # the dispatcher is its own process; its metrics are handed back to this one
+        dispatch_metrics = SharedRegistry()
+        registry.add_source(dispatch_metrics.render)
+        dispatcher = Dispatcher(config, logger, outbox, metrics=dispatch_metrics)
+        dispatcher.start()
+    metrics.watch(events, outbox)
 
-    # Start the dispatcher
-    child_pipe, pipe = Pipe(duplex=False)
-    dispatcher.run(config, logger, child_pipe)
+    # Reload the config on SIGHUP, or when the file changes
+    reload_requested = []
+    def _on_hup(signum, frame):
+        reload_requested.append(signum)
+        # the nap below is retried after a signal (PEP 475), so end it by hand
+        watcher.wake()
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, _on_hup)
 
     # Run monitoring loop
-    start_alert_period = time.time()
+    dropped = 0
     while True:
-        start_run_time = time.time()
-        for member in services:
-            new_pids, dead_pids = member.status()
+        if reload_requested or (config.grab('watch_config') and config.changed()):
+            del reload_requested[:]
+            new_index = _reload(config, logger, services, table, watcher, events, scheduler, resources, flaps)
+            if new_index is not None:
+                index = new_index
+        tick_start = clock()
+        due = [services[x] for x in scheduler.due() if x in services]
+        if due:
+            with metrics.scan.time():
+                table.refresh() # one scan of the process table, shared by every due service
+                found = index.route(table)
+            metrics.processes.set(table.scanned)
+            metrics.checks.inc(len(due))
+        status_start = clock()
+        for member in due:
+            new_pids, dead_pids = member.status(table, current=found.get(member.name, {}))
 
             if dead_pids:
                 for name in dead_pids:
                     for pid in dead_pids[name]:
-                        new_event = Event(member, name, pid)
-                        if new_event in events:
-                            # Event has overriden __hash__; that's why this works
-                            events[new_event].bump() # add occurance to event
-                        else:
-                            pipe.send(new_event) # push to dispatcher for alerting
-
-            if new_pids:
-                for name in dead_pids:
-                    for pid in dead_pids[name]:
-                        # It's spam to notify of a new pid ASAP
-                        new_event = Event(member, name, pid)
-                        events[new_event].bump()
+                        _on_dead(events, outbox, member.name, name, pid, metrics, flaps)
+
+            for name, pids in new_pids.items():
+                detail = flaps.born(member.name, name, len(pids))
+                if detail:
+                    _on_flap(events, outbox, member.name, name, pids[-1], detail, metrics)
+
+            for name, pid, kind, detail in resources.check(member):
+                _on_breach(events, outbox, member.name, name, pid, kind, detail, metrics)
+
+            if member.tree is not None:
+                _on_workers(events, outbox, member, metrics)
+
+            # It's spam to notify of a new pid ASAP, so new_pids are not alerted on
+        if due:
+            metrics.status.observe(clock() - status_start)
 
         # remove events that have been 'green' for long enough
-        for event in events:
-            if time.time() - event.last_event >= event_reset_period:
-                events.pop(event, None)
+        events.expire()
+        flaps.expire()
 
         # Send periodic alerts
-        if time.time() - start_alert_period >= alert_frequency:
-            for event in events:
-                pipe.send(event)
-                start_alert_period = time.time()
+        for event in events.due():
+            outbox.put(event)
 
-        # time to nap
-        ran_for = time.time() - start_run_time
-        delta = loop_run_frequency - ran_for
-        time.sleep(max(0, delta)) # so we don't sleep negitive
+        # move along events that were held back while the dispatcher was behind
+        outbox.flush()
+        if outbox.dropped > dropped:
+            metrics.dropped.inc(outbox.dropped - dropped)
+            logger.warning('Dispatcher is falling behind; dropped {0} events, queue stats: {1}'.format(outbox.dropped - dropped,
+                                                                                                     outbox.stats()))
+            dropped = outbox.dropped
+        metrics.tick.observe(clock() - tick_start)
 
+        # time to nap until the next service is due; wake early to alert on
+        # any watched process that exits
+        deadline = scheduler.clock() + config.grab('frequency')
+        if scheduler.next_due() is not None:
+            deadline = min(deadline, scheduler.next_due())
+        while True:
+            delta = deadline - scheduler.clock()
+            if delta <= 0 or reload_requested:
+                break
+            for key, pid in watcher.wait(delta):
+                service, name = key
+                if service in services and services[service].reap(name, pid):
+                    _on_dead(events, outbox, service, name, pid, metrics, flaps)
 
 
 if __name__ == '__main__':
-    loop(services=services,
-         dispathcer=dispatcher,
-         logger=logger,
-         buffer=config.grab('buffer')
+    loop()
@@ -0,0 +1,291 @@
+# -*- coding: UTF-8 -*-
+"""
+Picking out processes by more than their name, so twenty services that all
+run as 'java' or 'python' can be told apart without wrapper scripts.
+
+A process in [services] can be a plain name, or a selector; a name followed
+by any number of [attribute=value] filters::
+
+    orders = java[cmdline=orders-service.jar]
+    billing = java[cmdline~=billing-\\d+\\.jar][user=billing]
+    api = [exe=/opt/api/bin/python]
+    worker = [name~=worker-[0-9]+][unit=worker.service]
+
+The attributes, cheapest first:
+
+    name~    regex that must match the whole name
+    user     the user that owns the process
+    exe      the full path of the executable
+    cgroup   substring of the cgroup path
+    unit     the systemd unit; the last part of the cgroup path
+    cmdline  substring of the command line, arguments joined with spaces
+    cmdline~ regex to search for in the command line
+
+Every selector is compiled once into a Matcher. The name is checked first,
+against a dictionary of exact names plus one combined regex of every name~
+filter, and the decision is cached per name; the other attributes are only
+read for processes whose name already matched, and only once per process
+no matter how many selectors ask for them. A selector without a name or name~
+has to look at every process, so give one where you can.
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os
+import re
+
+import psutil
+
+# the order the filters are checked in; cheap first
+ATTRIBUTES = ('name~', 'user', 'exe', 'cgroup', 'unit', 'cmdline', 'cmdline~')
+
+_SELECTOR = re.compile(r'^(?P<name>[^\[]*)(?P<filters>(?:\[.*\])?)$')
+_FILTER = re.compile(r'\[(?P<attr>[a-z]+~?)=(?P<value>.*?)\](?=\[|$)')
+
+
+class Selector(object):
+    """
+    One process from [services]; a name, and the filters it must pass.
+
+    @param text
+        The process as written in the config, like 'java[cmdline=orders.jar]'
+    """
+    __slots__ = ('text', 'name', 'filters', 'name_regex', 'cmdline_regex')
+
+    def __init__(self, text):
+        self.text = text
+        match = _SELECTOR.match(text.strip())
+        if match is None:
+            raise ValueError('Malformed process selector {0!r}'.format(text))
+        self.name = match.group('name').strip() or None
+        filters = {}
+        end = 0
+        for found in _FILTER.finditer(match.group('filters')):
+            if found.start() != end:
+                break
+            end = found.end()
+            attr = found.group('attr')
+            if attr not in ATTRIBUTES:
+                raise ValueError('Unknown attribute {0!r} in process selector {1!r}; use one of {2}'.format(attr,
+                                                                                                            text,
+                                                                                                            ', '.join(ATTRIBUTES)))
+            filters[attr] = found.group('value')
+        if end != len(match.group('filters')):
+            raise ValueError('Malformed process selector {0!r}'.format(text))
+        if self.name is None and not filters:
+            raise ValueError('Process selector {0!r} matches nothing'.format(text))
+        try:
+            self.name_regex = re.compile('(?:{0})\\Z'.format(filters['name~'])) if 'name~' in filters else None
+            self.cmdline_regex = re.compile(filters['cmdline~']) if 'cmdline~' in filters else None
+        except re.error as doh:
+            raise ValueError('Bad regex in process selector {0!r}: {1}'.format(text, doh))
+        self.filters = [(x, filters[x]) for x in ATTRIBUTES if x in filters and x != 'name~']
+
+    def __repr__(self):
+        return 'Selector({0})'.format(self.text)
+
+    @property
+    def plain(self):
+        """True when the selector is just a process name"""
+        return self.name_regex is None and not self.filters
+
+    def match_name(self, name):
+        """
+        Can a process with this name pass the selector?
+
+        -Returns- Boolean
+        """
+        if self.name is not None and name != self.name:
+            return False
+        if self.name_regex is not None and self.name_regex.match(name) is None:
+            return False
+        return True
+
+    def matches(self, attrs):
+        """
+        Does a process pass every filter besides its name?
+
+        -Returns- Boolean
+
+        @param attrs
+            An instance of ProcessAttributes for the process
+        """
+        for attr, value in self.filters:
+            found = attrs.get(attr)
+            if found is None:
+                return False
+            if attr == 'cmdline~':
+                if self.cmdline_regex.search(found) is None:
+                    return False
+            elif attr in ('cmdline', 'cgroup', 'unit'):
+                if value not in found:
+                    return False
+            elif found != value:
+                return False
+        return True
+
+    def select(self, table):
+        """
+        Find the processes in a ProcessTable that pass the selector
+
+        -Returns- Set of psutil.Process objects
+        """
+        if self.name is not None:
+            procs = table.lookup(self.name)
+        else:
+            procs = set()
+            for name in table:
+                if self.match_name(name):
+                    procs |= table.lookup(name)
+        return set(x for x in procs if self.matches(ProcessAttributes(x)))
+
+
+class ProcessAttributes(object):
+    """
+    Reads the attributes of a process the first time a selector asks for them,
+    and remembers them; None when the process is gone, or can't be read.
+
+    @param proc
+        A psutil.Process object, or a procfs.ProcRecord
+    """
+    __slots__ = ('proc', '_cache')
+
+    def __init__(self, proc):
+        self.proc = proc
+        self._cache = {}
+
+    def get(self, attr):
+        """The value of an attribute, like 'user' or 'cmdline~'"""
+        attr = attr.rstrip('~')
+        try:
+            return self._cache[attr]
+        except KeyError:
+            pass
+        try:
+            value = getattr(self, '_read_' + attr)()
+        except (psutil.Error, OSError, IOError, KeyError):
+            value = None
+        self._cache[attr] = value
+        return value
+
+    def _read_user(self):
+        return self.proc.username()
+
+    def _read_exe(self):
+        return self.proc.exe() or None
+
+    def _read_cmdline(self):
+        return ' '.join(self.proc.cmdline())
+
+    def _read_cgroup(self):
+        return read_cgroup(self.proc.pid)
+
+    def _read_unit(self):
+        # the unit is the last part of the path, on both cgroup v1 & v2
+        units = set()
+        for line in read_cgroup(self.proc.pid).splitlines():
+            units.add(line.rstrip('/').rpartition('/')[2])
+        return units
+
+
+def read_cgroup(pid, root='/proc'):
+    """
+    The cgroup paths of a process; one per hierarchy
+
+    -Returns- String; one path per line
+
+    -Raises- IOError/OSError when the process is gone, or this isn't Linux
+    """
+    with open(os.path.join(root, str(pid), 'cgroup'), 'rb') as the_file:
+        lines = the_file.read().decode('utf-8', 'replace').splitlines()
+    # each line is hierarchy-ID:controllers:path
+    return '\n'.join(x.split(':', 2)[-1] for x in lines)
+
+
+class Matcher(object):
+    """
+    Every selector from [services], compiled into one matcher.
+
+    @param selectors
+        Iterable of tuples
+            index[0] -> name of service
+            index[1] -> the process, as written in the config
+            index[2] -> a Selector for the process
+
+    @param cache_size
+        How many process names to remember the candidates of; the cache starts
+        over once it's full, so short lived, uniquely named processes don't
+        grow it forever.
+        Default is 10000
+    """
+    def __init__(self, selectors, cache_size=10000):
+        self.cache_size = cache_size
+        self._by_name = {}
+        self._by_regex = []
+        self._any_name = []
+        for route in selectors:
+            selector = route[2]
+            if selector.name is not None:
+                self._by_name.setdefault(selector.name, []).append(route)
+            elif selector.name_regex is not None:
+                self._by_regex.append(route)
+            else:
+                self._any_name.append(route)
+        # one pass of a combined regex rules out most names without trying every name~ filter
+        if self._by_regex:
+            self._prefilter = re.compile('|'.join('(?:{0})'.format(x[2].name_regex.pattern) for x in self._by_regex))
+        else:
+            self._prefilter = None
+        self._candidates = {}
+
+    def __repr__(self):
+        return 'Matcher(selectors={0})'.format(len(self))
+
+    def __len__(self):
+        return len(self._by_regex) + len(self._any_name) + sum(len(x) for x in self._by_name.values())
+
+    def candidates(self, name):
+        """
+        The selectors a process with this name might pass; cached per name
+
+        -Returns- List of tuples, like the selectors param
+        """
+        try:
+            return self._candidates[name]
+        except KeyError:
+            pass
+        found = list(self._by_name.get(name, ()))
+        if self._prefilter is not None and self._prefilter.match(name):
+            found.extend(x for x in self._by_regex if x[2].match_name(name))
+        found.extend(self._any_name)
+        if len(self._candidates) >= self.cache_size:
+            self._candidates.clear()
+        self._candidates[name] = found
+        return found
+
+    def wants(self, name):
+        """Could a process with this name pass any selector?"""
+        return bool(self.candidates(name))
+
+    def route(self, table, found):
+        """
+        Add the processes in a ProcessTable that pass a selector to found
+
+        @param table
+            An instance of ProcessTable
+
+        @param found
+            Dictionary mapping service name to a dictionary of process to a set
+            of psutil.Process objects, like from ServiceIndex.route; updated in place
+        """
+        attrs = {}
+        for name in table:
+            routes = self.candidates(name)
+            if not routes:
+                continue
+            for proc in table.lookup(name):
+                for service, process, selector in routes:
+                    proc_attrs = attrs.get(proc)
+                    if proc_attrs is None:
+                        proc_attrs = attrs[proc] = ProcessAttributes(proc)
+                    if selector.matches(proc_attrs):
+                        found.setdefault(service, {}).setdefault(process, set()).add(proc)
@@ -0,0 +1,455 @@
+# -*- coding: UTF-8 -*-
+"""
+Counters, gauges and histograms about alarmer itself, like how long a tick
+takes or how far behind the dispatcher is, in the Prometheus text format.
+
+Recording a value is a dictionary update under a lock, so the hot paths can
+afford it. The metrics can be served over HTTP for Prometheus to scrape, or
+written to a file for the node_exporter textfile collector.
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os
+import time
+import bisect
+import threading
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+# atomic on POSIX; Python 2 doesn't have os.replace
+_replace = getattr(os, 'replace', os.rename)
+
+clock = getattr(time, 'perf_counter', time.time)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return '{0}'.format(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(key, extra=()):
+    """Format a sorted tuple of (name, value) pairs as {name="value",...}"""
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else '{0}'.format(value)
+
+
+class _Metric(object):
+    """
+    The parts every kind of metric shares. Values are kept per set of labels,
+    which are supplied as keyword arguments when recording a value.
+
+    @param name
+        The name of the metric, like alarmer_tick_seconds
+
+    @param doc
+        What the metric measures; the HELP line
+    """
+    kind = None
+
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def __repr__(self):
+        return '{0}(name={1}, series={2})'.format(self.__class__.__name__, self.name, len(self._values))
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def value(self, **labels):
+        """The current value for a set of labels"""
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        """-Returns- List of lines in the Prometheus text format"""
+        lines = ['# HELP {0} {1}'.format(self.name, self.doc), '# TYPE {0} {1}'.format(self.name, self.kind)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append('{0}{1} {2}'.format(self.name, _labels(key), _number(value)))
+        return lines
+
+
+class Counter(_Metric):
+    """A value that only goes up, like how many processes died"""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, like how deep a queue is"""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    """
+    Counts values into buckets, like how long each tick took
+
+    @param buckets
+        The upper bounds of the buckets, in ascending order.
+        Default is None, which uses DEFAULT_BUCKETS; good for seconds
+    """
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, doc, buckets=None):
+        super(Histogram, self).__init__(name, doc)
+        self.buckets = tuple(buckets or self.DEFAULT_BUCKETS)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # a count per bucket, then one for +Inf, then the sum
+                series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[idx] += 1
+            series[-1] += value
+
+    def time(self, **labels):
+        """
+        Time a block of code
+
+        Example::
+
+          with histogram.time():
+              do_work()
+        """
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        """How many values were observed for a set of labels"""
+        series = self._values.get(self._key(labels))
+        return sum(series[:-1]) if series else 0
+
+    def sum(self, **labels):
+        """The total of the values observed for a set of labels"""
+        series = self._values.get(self._key(labels))
+        return series[-1] if series else 0
+
+    def value(self, **labels):
+        return self.count(**labels)
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.doc), '# TYPE {0} {1}'.format(self.name, self.kind)]
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        for key, series in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                total += count
+                lines.append('{0}_bucket{1} {2}'.format(self.name, _labels(key, [('le', _number(bound))]), total))
+            lines.append('{0}_sum{1} {2}'.format(self.name, _labels(key), _number(series[-1])))
+            lines.append('{0}_count{1} {2}'.format(self.name, _labels(key), total))
+        return lines
+
+
+class _Timer(object):
+    """Context manager for Histogram.time"""
+    __slots__ = ('_histogram', '_labels', '_start')
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(clock() - self._start, **self._labels)
+
+
+class Registry(object):
+    """
+    Holds every metric of a process, and renders them in the Prometheus text format.
+    Asking for a metric that already exists returns the existing one.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._hooks = []
+        self._sources = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Registry(metrics={0})'.format(len(self._metrics))
+
+    def __len__(self):
+        return len(self._metrics)
+
+    def __contains__(self, name):
+        return name in self._metrics
+
+    def __getitem__(self, name):
+        return self._metrics[name]
+
+    def _get(self, cls, name, doc, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, doc, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('Metric {0} is already a {1}'.format(name, metric.kind))
+        return metric
+
+    def counter(self, name, doc):
+        """-Returns- the Counter with the supplied name"""
+        return self._get(Counter, name, doc)
+
+    def gauge(self, name, doc):
+        """-Returns- the Gauge with the supplied name"""
+        return self._get(Gauge, name, doc)
+
+    def histogram(self, name, doc, buckets=None):
+        """-Returns- the Histogram with the supplied name"""
+        return self._get(Histogram, name, doc, buckets=buckets)
+
+    def on_render(self, hook):
+        """
+        Run a callable before every render; for gauges that are cheaper to
+        read when asked for, like the depth of a queue
+
+        @param hook
+            A callable that takes no params
+        """
+        self._hooks.append(hook)
+
+    def add_source(self, source):
+        """
+        Add text from somewhere else to every render, like another Registry
+
+        @param source
+            A callable that takes no params, and returns text in the Prometheus format
+        """
+        self._sources.append(source)
+
+    def render(self):
+        """
+        -Returns- String of every metric, in the Prometheus text format
+        """
+        for hook in self._hooks:
+            hook()
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        text = '\n'.join(lines) + '\n' if lines else ''
+        for source in self._sources:
+            text += source()
+        return text
+
+
+class SharedRegistry(Registry):
+    """
+    A Registry that's filled in by a child process (like the Dispatcher), and
+    rendered by the parent. The child calls push() every so often, and the
+    parent renders whatever was pushed last.
+
+    Create it before starting the child process.
+    """
+    def __init__(self):
+        super(SharedRegistry, self).__init__()
+        self._queue = multiprocessing.Queue(maxsize=1)
+        self._last = ''
+
+    def push(self):
+        """Send the current metrics to the parent; never blocks"""
+        text = Registry.render(self)
+        try:
+            self._queue.get_nowait() # the parent hasn't read the last one; replace it
+        except queue.Empty:
+            pass
+        try:
+            self._queue.put_nowait(text)
+        except queue.Full:
+            pass
+
+    def render(self):
+        """-Returns- The text last pushed by the child"""
+        while True:
+            try:
+                self._last = self._queue.get_nowait()
+            except queue.Empty:
+                break
+        return self._last
+
+
+class LoopMetrics(object):
+    """
+    The metrics recorded by the monitoring loop, or the asyncio Engine
+
+    @param registry
+        The Registry to create the metrics in
+    """
+    def __init__(self, registry):
+        self.registry = registry
+        self.tick = registry.histogram('alarmer_tick_seconds', 'Time spent checking the due services each tick, not counting the nap')
+        self.scan = registry.histogram('alarmer_scan_seconds', 'Time spent reading the process table')
+        self.status = registry.histogram('alarmer_status_seconds', 'Time spent comparing the process table to the known PIDs of the due services')
+        self.processes = registry.gauge('alarmer_scan_processes', 'Processes seen by the last scan of the process table')
+        self.checks = registry.counter('alarmer_service_checks_total', 'Checks of a service')
+        self.deaths = registry.counter('alarmer_process_deaths_total', 'Monitored processes that died')
+        self.workers = registry.gauge('alarmer_workers', 'Workers under the root process of a process tree')
+        self.worker_starts = registry.counter('alarmer_worker_starts_total', 'Workers that started under a process tree')
+        self.worker_exits = registry.counter('alarmer_worker_exits_total', 'Workers that exited under a process tree')
+        self.flaps = registry.counter('alarmer_flapping_total', 'Births & deaths that found a process restarting too often')
+        self.breaches = registry.counter('alarmer_threshold_breaches_total', 'Checks that found a process over its CPU, RSS or FD limit')
+        self.dropped = registry.counter('alarmer_queue_dropped_total', 'Events dropped because the dispatcher was behind')
+        self.open_events = registry.gauge('alarmer_open_events', 'Events that have not gone green yet')
+        self.queue_depth = registry.gauge('alarmer_queue_depth', 'Events waiting for the dispatcher')
+
+    def watch(self, events, outbox=None):
+        """
+        Read the number of open Events, and how deep the queue is, on every render
+
+        @param events
+            An instance of EventStore
+
+        @param outbox
+            An instance of EventQueue (or an Agent).
+            Default is None
+        """
+        def hook():
+            self.open_events.set(len(events))
+            if outbox is not None and outbox.depth is not None:
+                self.queue_depth.set(outbox.depth)
+        self.registry.on_render(hook)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass # don't spam stderr on every scrape
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsExporter(object):
+    """
+    Makes a Registry available outside of alarmer
+
+    @param registry
+        The Registry to export
+
+    @param listen
+        Tuple of (host, port) to serve /metrics on; port 0 picks a free port.
+        Default is None, which doesn't serve HTTP
+
+    @param textfile
+        A file to write the metrics to every interval seconds, for the
+        node_exporter textfile collector.
+        Default is None, which doesn't write a file
+
+    @param interval
+        Seconds between writes of the textfile.
+        Default is 15
+    """
+    def __init__(self, registry, listen=None, textfile=None, interval=15):
+        self.registry = registry
+        self.listen = listen
+        self.textfile = textfile
+        self.interval = interval
+        self._server = None
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def __repr__(self):
+        return 'MetricsExporter(listen={0}, textfile={1})'.format(self.address, self.textfile)
+
+    @property
+    def address(self):
+        """The (host, port) /metrics is served on, or None"""
+        if self._server is None:
+            return None
+        return self._server.server_address[:2]
+
+    def start(self):
+        """Start serving HTTP, and writing the textfile, on daemon threads"""
+        self._stopped.clear()
+        if self.listen is not None:
+            self._server = _Server(self.listen, _Handler)
+            self._server.registry = self.registry
+            self._spawn(self._server.serve_forever, 'metrics-http')
+        if self.textfile:
+            self._spawn(self._write_forever, 'metrics-textfile')
+
+    def _spawn(self, target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def write(self):
+        """Write the textfile; the collector never sees a half written file"""
+        tmp_path = self.textfile + '.tmp'
+        with open(tmp_path, 'w') as the_file:
+            the_file.write(self.registry.render())
+        _replace(tmp_path, self.textfile)
+
+    def _write_forever(self):
+        while not self._stopped.is_set():
+            try:
+                self.write()
+            except (IOError, OSError):
+                pass # try again next interval; the monitoring matters more than its metrics
+            self._stopped.wait(self.interval)
@@ -13,15 +13,45 @@ Objects use in the monitoring loop
 from __future__ import print_function, division, unicode_literals, absolute_import
 
 import time
+import heapq
+import socket
 import datetime
-import smtplib
-from email.mime.text import MIMEText
+import itertools
+import threading
+from collections import deque
+import multiprocessing
 from multiprocessing import Process
 
 import psutil
-import requests
 from netifaces import interfaces, ifaddresses, AF_INET
 
+from . import procfs
+from .metrics import Registry
+from .flapping import FLAPPING
+from .matching import Selector, Matcher
+from .notifiers import load_notifiers, overrides
+from .limits import TokenBucket, Buckets, CircuitBreaker, Held, CLOSED, HALF_OPEN
+from .config import ConfigParsingError
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+# The kind of an Event for a process that died; resource.ResourceMonitor makes
+# Events of other kinds, named after the limit that was broken (i.e. 'rss')
+DIED = 'died'
+# the kind of Event for a process tree with too few, or too many workers
+WORKERS = 'workers'
+# what a process name that isn't in the table maps to; always the same object
+_NO_PROCS = frozenset()
+
 
 class Event(object):
     """
@@ -29,30 +59,78 @@ class Event(object):
 
     Manipulates how Python checks for equality and changes expected behavior of
     inserting into a dictionary.
+
+    Only the most recent PIDs are kept, so a process that flaps for days does
+    not grow the Event without bound.
+
+    @param service
+        The name of the service
+
+    @param process
+        The name of the process
+
+    @param pid
+        The PID of the process that caused the event
+
+    @param now
+        When the event occurred, in EPOC time.
+        Default is None, which uses the current time
+
+    @param kind
+        What happened; a service & process has a separate Event of each kind.
+        Default is DIED
+
+    @param detail
+        More about the most recent occurrence, like how far over a limit it was.
+        Default is None
     """
-    def __init__(self, service, process, pid):
+    __slots__ = ('_service', '_process', '_pid', '_kind', 'detail', 'birth', 'last_event', 'event_count')
+    PID_HISTORY = 16
+
+    def __init__(self, service, process, pid, now=None, kind=DIED, detail=None):
+        if now is None:
+            now = time.time()
         self._service = service
         self._process = process
-        self._pid = [pid]
-        self.birth = time.time()
-        self.last_event = time.time()
+        self._pid = deque([pid], maxlen=self.PID_HISTORY)
+        self._kind = kind
+        self.detail = detail
+        self.birth = now
+        self.last_event = now
         self.event_count = 1
 
     @property
     def pid(self):
-        return self._pid
+        """The most recent PIDs, oldest first"""
+        return list(self._pid)
 
     @property
     def name(self):
-        return '{0} -> {1}'.format(self._service, self._name)
+        if self._kind == DIED:
+            return '{0} -> {1}'.format(self._service, self._process)
+        return '{0} -> {1} ({2})'.format(self._service, self._process, self._kind)
 
-    def bump(self, pid):
+    @property
+    def service(self):
+        return self._service
+
+    @property
+    def process(self):
+        return self._process
+
+    @property
+    def kind(self):
+        return self._kind
+
+    def bump(self, pid, now=None, detail=None):
         """
         Update the Event to account for a re-occurance; i.e. "it happened again"
         """
         self.event_count += 1
         self._pid.append(pid)
-        self.last_event = time.time()
+        self.last_event = time.time() if now is None else now
+        if detail is not None:
+            self.detail = detail
 
     def __repr__(self):
         return 'Event(name={0}, birth={1}, last_event={2}, event_count={3})'.format(self.name,
@@ -65,10 +143,644 @@ class Event(object):
         Allows us to create a new Event instance that has the same hash as an
         existing Event instance; really handy for tracking events in a dictionary.
         """
-        return hash(self._service) ^ hash(self._process)
+        return hash((self._service, self._process, self._kind))
 
     def __eq__(self, other):
-        return hash(self) == hash(other)
+        try:
+            return (self._service, self._process, self._kind) == (other._service, other._process, other._kind)
+        except AttributeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        """Events are sent to the Dispatcher over a pipe; __slots__ need help pickling"""
+        return (self._service, self._process, list(self._pid), self.birth, self.last_event, self.event_count,
+                self._kind, self.detail)
+
+    def __setstate__(self, state):
+        self._service, self._process, pids, self.birth, self.last_event, self.event_count = state[:6]
+        # state saved before Events had kinds is for a process that died
+        self._kind, self.detail = tuple(state[6:8]) if len(state) > 6 else (DIED, None)
+        self._pid = deque(pids, maxlen=self.PID_HISTORY)
+
+
+class EventStore(object):
+    """
+    Holds the open Events, along with two heaps ordered by time; one for when an
+    Event goes 'green' and one for when it's due for another alert. Expiring and
+    re-alerting only touches the Events that are due, not every open Event.
+
+    An Event that is bumped keeps its old spot in the expiry heap, and is pushed
+    back with its new last_event time when that spot comes due.
+
+    @param reset_after
+        How long, in seconds, an Event needs to be quiet before it's removed
+
+    @param rate
+        How often, in seconds, to alert again on an open Event
+
+    @param journal
+        An EventJournal to keep the open Events on disk, so they survive a restart.
+        Default is None, which keeps them in memory only
+    """
+    def __init__(self, reset_after, rate, journal=None):
+        self.reset_after = reset_after
+        self.rate = rate
+        self.journal = journal
+        self._events = {}
+        self._alert_at = {}
+        self._expiry = []
+        self._alerts = []
+        self._counter = itertools.count()
+
+    def __repr__(self):
+        return 'EventStore(events={0}, reset_after={1}, rate={2})'.format(len(self._events),
+                                                                         self.reset_after,
+                                                                         self.rate)
+
+    def __len__(self):
+        return len(self._events)
+
+    def __contains__(self, event):
+        return event in self._events
+
+    def __iter__(self):
+        for event in list(self._events.values()):
+            yield event
+
+    def get(self, service, process, kind=DIED):
+        """
+        Obtain the open Event for a service & process
+
+        -Returns- Event, or None if there isn't one
+        """
+        return self._events.get(Event(service, process, None, kind=kind))
+
+    def record(self, service, process, pid, now=None, kind=DIED, detail=None):
+        """
+        Account for a process dying; opens a new Event, or bumps the existing one.
+
+        -Returns- Tuple
+            index[0] -> the Event
+            index[1] -> Boolean; True if the Event is new
+
+        @param service
+            The name of the service
+
+        @param process
+            The name of the process
+
+        @param pid
+            The PID that died
+
+        @param now
+            When the process died, in EPOC time.
+            Default is None, which uses the current time
+
+        @param kind
+            What happened to the process.
+            Default is DIED
+
+        @param detail
+            More about what happened, for the notification.
+            Default is None
+        """
+        if now is None:
+            now = time.time()
+        new_event = Event(service, process, pid, now=now, kind=kind, detail=detail)
+        event = self._events.get(new_event)
+        if event is not None:
+            event.bump(pid, now=now, detail=detail)
+            if self.journal is not None:
+                self.journal.write(event, self._alert_at[event])
+            return event, False
+        self.add(new_event, now=now)
+        return new_event, True
+
+    def add(self, event, now=None):
+        """
+        Start tracking an existing Event object
+
+        @param event
+            The Event to track
+
+        @param now
+            When the Event was last alerted on, in EPOC time.
+            Default is None, which uses the current time
+        """
+        if now is None:
+            now = time.time()
+        self._track(event, now + self.rate)
+        if self.journal is not None:
+            self.journal.write(event, now + self.rate)
+
+    def _track(self, event, alert_at):
+        self._events[event] = event
+        self._alert_at[event] = alert_at
+        heapq.heappush(self._expiry, (event.last_event, next(self._counter), event))
+        heapq.heappush(self._alerts, (alert_at, next(self._counter), event))
+
+    def restore(self, states, now=None):
+        """
+        Start tracking the Events loaded from an EventJournal, with the alert
+        timers they had. Events that went 'green' in the meantime are skipped,
+        and removed from the journal.
+
+        -Returns- Integer; how many Events were restored
+
+        @param states
+            An iterable of tuples, like from EventJournal.load()
+                index[0] -> the state of an Event, from Event.__getstate__
+                index[1] -> when the Event is due for another alert, in EPOC time
+
+        @param now
+            The current time, in EPOC time.
+            Default is None, which uses the current time
+        """
+        if now is None:
+            now = time.time()
+        restored = 0
+        for state, alert_at in states:
+            event = Event.__new__(Event)
+            event.__setstate__(state)
+            if event.last_event + self.reset_after <= now:
+                if self.journal is not None:
+                    self.journal.remove(event)
+                continue
+            self._track(event, alert_at)
+            restored += 1
+        return restored
+
+    def discard(self, event):
+        """Stop tracking an Event; stale heap entries are skipped when they come due"""
+        if self._events.pop(event, None) is not None:
+            self._alert_at.pop(event, None)
+            if self.journal is not None:
+                self.journal.remove(event)
+
+    def expire(self, now=None):
+        """
+        Remove the Events that have been 'green' for long enough
+
+        -Returns- List of the removed Events
+        """
+        if now is None:
+            now = time.time()
+        expired = []
+        while self._expiry and self._expiry[0][0] + self.reset_after <= now:
+            last_event, _, event = heapq.heappop(self._expiry)
+            if self._events.get(event) is not event:
+                continue # already removed
+            if event.last_event != last_event:
+                # bumped since it was queued; requeue with the new time
+                heapq.heappush(self._expiry, (event.last_event, next(self._counter), event))
+                continue
+            del self._events[event]
+            del self._alert_at[event]
+            if self.journal is not None:
+                self.journal.remove(event)
+            expired.append(event)
+        return expired
+
+    def next_due(self):
+        """
+        When the next Event is due for another alert
+
+        -Returns- EPOC time, or None when there are no Events
+        """
+        while self._alerts and self._events.get(self._alerts[0][2]) is not self._alerts[0][2]:
+            heapq.heappop(self._alerts) # already removed
+        if self._alerts:
+            return self._alerts[0][0]
+        return None
+
+    def due(self, now=None):
+        """
+        Find the Events that are due for another alert, and schedule their next one
+
+        -Returns- List of Events
+        """
+        if now is None:
+            now = time.time()
+        ready = []
+        while self._alerts and self._alerts[0][0] <= now:
+            _, _, event = heapq.heappop(self._alerts)
+            if self._events.get(event) is not event:
+                continue # already removed
+            ready.append(event)
+            self._alert_at[event] = now + self.rate
+            heapq.heappush(self._alerts, (now + self.rate, next(self._counter), event))
+            if self.journal is not None:
+                self.journal.write(event, now + self.rate)
+        return ready
+
+
+def parent_pid(proc):
+    """
+    The parent PID of a psutil.Process, or a ProcRecord
+
+    -Returns- Integer, or None when the process is gone
+    """
+    ppid = getattr(proc, 'ppid', None)
+    if callable(ppid):
+        try:
+            return ppid()
+        except psutil.Error:
+            return None
+    return ppid
+
+
+def get_scanner(kind='auto'):
+    """
+    Pick the backend used to scan the process table.
+
+    -Returns- Callable that returns an iterable of process objects
+
+    -Raises- ValueError for an unknown kind, or if procfs is requested on a
+             machine without it
+
+    @param kind
+        One of 'psutil' (portable), 'procfs' (Linux fast-path), or 'auto'
+        which uses procfs when it's available, and psutil otherwise.
+        Default is 'auto'
+    """
+    if kind not in ('auto', 'psutil', 'procfs'):
+        raise ValueError('Unknown process table scanner: {0}'.format(kind))
+    if kind != 'psutil' and procfs.available():
+        return procfs.ProcScanner()
+    elif kind == 'procfs':
+        raise ValueError('Unable to use procfs scanner; {0} not found'.format(procfs.PROC_ROOT))
+    return psutil.process_iter
+
+
+# bound at import, so tests that mock out psutil still get real classes
+_PROCESS = psutil.Process
+_EXITED = (psutil.STATUS_ZOMBIE, psutil.STATUS_DEAD)
+_GONE = psutil.NoSuchProcess
+_DENIED = psutil.AccessDenied
+
+
+def _zombie(proc):
+    """
+    Has a process exited, and is only waiting on its parent to reap it? The
+    procfs scanner never yields those, so only a psutil.Process is checked.
+
+    -Returns- Boolean
+    """
+    if not isinstance(proc, _PROCESS):
+        return False
+    try:
+        return proc.status() in _EXITED
+    except _GONE:
+        return True
+    except _DENIED:
+        return False
+
+
+class ProcessTable(object):
+    """
+    A point-in-time snapshot of the process table, indexed by process name.
+
+    Built once per tick of the monitoring loop, and shared by every Service so
+    that the cost of scanning grows with the number of processes on the host,
+    not the number of processes multiplied by the number of services.
+
+    A process name whose processes are the same as in the last refresh keeps
+    the same set object, so a Service can tell nothing changed without
+    comparing the processes again.
+
+    @param names
+        A container of process names to keep in the snapshot, like a ServiceIndex.
+        Processes with other names are skipped after reading their name.
+        Default is None, which keeps every process.
+
+    @param scanner
+        A callable that returns an iterable of process objects, like
+        psutil.process_iter or procfs.ProcScanner. See get_scanner.
+        Default is None, which uses psutil.process_iter
+
+    @param tree
+        Set to True to also index every process by its parent PID, from the
+        same scan, for Services that track a process tree. Reads the parent
+        PID of every process, whatever its name.
+        Default is False
+    """
+    def __init__(self, names=None, scanner=None, tree=False):
+        self.names = names
+        self.tree = tree
+        self._scanner = scanner
+        self._children = {}
+        self._table = {}
+        self.scanned = 0
+        self.refresh()
+
+    def __repr__(self):
+        return 'ProcessTable(names={0}, processes={1})'.format(len(self._table), self.size)
+
+    def __len__(self):
+        """How many distinct process names are in the snapshot"""
+        return len(self._table)
+
+    def __contains__(self, name):
+        return name in self._table
+
+    def __iter__(self):
+        """Iterate over the process names in the snapshot"""
+        for name in self._table:
+            yield name
+
+    @property
+    def size(self):
+        """How many processes are in the snapshot"""
+        return sum(len(x) for x in self._table.values())
+
+    def refresh(self):
+        """
+        Walk the process table, and rebuild the name index.
+
+        **Note** Mutates state of object by replacing the snapshot
+        """
+        found = {}
+        names = self.names
+        scanner = self._scanner or psutil.process_iter
+        scanned = 0
+        children = {} if self.tree else None
+        for proc in scanner():
+            scanned += 1
+            if children is not None:
+                if _zombie(proc):
+                    continue
+                parent = parent_pid(proc)
+                if parent is not None:
+                    children.setdefault(parent, []).append(proc)
+            try:
+                proc_name = proc.name()
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            else:
+                if names is None or proc_name in names:
+                    if children is None and _zombie(proc):
+                        continue
+                    found.setdefault(proc_name, []).append(proc)
+        # processes compare on PID & start time, so a reused PID changes the group
+        previous = self._table
+        table = {}
+        for name, procs in found.items():
+            old = previous.get(name)
+            if old is not None and len(old) == len(procs) and all(x in old for x in procs):
+                table[name] = old # unchanged; keep the object so Service.status can skip it
+            else:
+                table[name] = frozenset(procs)
+        self._table = table
+        self._children = children or {}
+        self.scanned = scanned
+
+    def descendants(self, proc):
+        """
+        Obtain every process below a process in the tree, from the snapshot
+
+        -Returns- List of psutil.Process objects; empty unless tree is True
+
+        @param proc
+            The process at the top of the tree
+        """
+        found = []
+        seen = set([proc.pid])
+        stack = [proc.pid]
+        while stack:
+            for child in self._children.get(stack.pop(), ()):
+                if child.pid not in seen:
+                    seen.add(child.pid)
+                    found.append(child)
+                    stack.append(child.pid)
+        return found
+
+    def lookup(self, name):
+        """
+        Obtain the processes that had the supplied name when the snapshot was taken
+
+        -Returns- Frozenset of psutil.Process objects; the same object from one
+                  refresh to the next while no process with the name was born or died
+        """
+        return self._table.get(name, _NO_PROCS)
+
+
+class ServiceIndex(object):
+    """
+    An inverted index of the [services] section of the config; maps the name of
+    a process to every (service, process) pair that tracks it.
+
+    Compiled once at startup so that each process in a ProcessTable is looked
+    at once, and routed straight to every Service that cares about it. A single
+    process name can belong to many services (think 'python' or 'java').
+
+    Processes given as a selector, like 'java[cmdline=orders.jar]', are
+    compiled into one matching.Matcher; see the matching module.
+
+    @param services
+        A dictionary mapping the name of a service to an iterable of process
+        names (or selectors), like the output of ConfigReader.grab_many('services')
+
+    -Raises- ValueError when a selector is malformed
+    """
+    def __init__(self, services):
+        self._routes = {}
+        selectors = []
+        for service in services:
+            if isinstance(services[service], basestring):
+                raise ValueError('processes for service {0} cannot be string, must be iterable like list, tuple, etc'.format(service))
+            for process in services[service]:
+                selector = Selector(process)
+                if selector.plain:
+                    self._routes.setdefault(process, []).append((service, process))
+                else:
+                    selectors.append((service, process, selector))
+        self._matcher = Matcher(selectors) if selectors else None
+
+    def __repr__(self):
+        return 'ServiceIndex(processes={0}, selectors={1})'.format(','.join(sorted(self._routes)), len(self._matcher or ()))
+
+    def __len__(self):
+        """How many distinct process names are indexed"""
+        return len(self._routes)
+
+    def __contains__(self, name):
+        """Could a process with this name belong to a service?"""
+        if name in self._routes:
+            return True
+        return self._matcher is not None and self._matcher.wants(name)
+
+    def __iter__(self):
+        for name in self._routes:
+            yield name
+
+    def services_for(self, name):
+        """
+        Obtain every (service, process) pair that tracks a process name
+
+        -Returns- List of tuples
+        """
+        return list(self._routes.get(name, ()))
+
+    def route(self, table):
+        """
+        Fan out a single ProcessTable to every service in the index.
+
+        -Returns- Dictionary
+            Key   -> name of service
+            Value -> dictionary mapping process name to a set of psutil.Process
+                     objects, suitable for the current param of Service.status
+
+        @param table
+            An instance of ProcessTable
+        """
+        found = {}
+        for name in self._routes:
+            if name not in table:
+                continue
+            procs = table.lookup(name)
+            for service, process in self._routes[name]:
+                found.setdefault(service, {})[process] = procs
+        if self._matcher is not None:
+            self._matcher.route(table, found)
+        return found
+
+
+class Scheduler(object):
+    """
+    Decides which services are due for a check, so each service can be checked
+    at its own interval. The next due time of every service is kept in a heap,
+    so finding what's due only touches the services that are due.
+
+    Uses the monotonic clock where there is one, so changes to the system
+    time don't skip or bunch up checks.
+
+    @param interval
+        The default number of seconds between checks of a service
+
+    @param intervals
+        A dictionary mapping service name to its number of seconds between checks.
+        Default is None, which uses the default interval for every service
+    """
+    clock = staticmethod(getattr(time, 'monotonic', time.time))
+
+    def __init__(self, interval, intervals=None):
+        self.interval = interval
+        self._intervals = dict(intervals or {})
+        self._due = {}
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __repr__(self):
+        return 'Scheduler(interval={0}, services={1})'.format(self.interval, len(self._due))
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, name):
+        return name in self._due
+
+    def update(self, interval, intervals=None):
+        """
+        Change the intervals; takes effect after each service's next check
+
+        @param interval
+            The default number of seconds between checks of a service
+
+        @param intervals
+            A dictionary mapping service name to its number of seconds between checks.
+            Default is None, which uses the default interval for every service
+        """
+        self.interval = interval
+        self._intervals = dict(intervals or {})
+
+    def interval_for(self, name):
+        """Seconds between checks for a service"""
+        return self._intervals.get(name, self.interval)
+
+    def add(self, name, interval=None, now=None):
+        """
+        Schedule a service; it's due right away
+
+        @param name
+            The name of the service
+
+        @param interval
+            Seconds between checks for this service.
+            Default is None, which keeps the service's current interval
+        """
+        if interval is not None:
+            self._intervals[name] = interval
+        if now is None:
+            now = self.clock()
+        self._push(name, now)
+
+    def remove(self, name):
+        """Stop scheduling a service; its heap entry is skipped when it comes due"""
+        self._due.pop(name, None)
+        self._intervals.pop(name, None)
+
+    def _push(self, name, when):
+        self._due[name] = when
+        heapq.heappush(self._heap, (when, next(self._counter), name))
+
+    def due(self, now=None):
+        """
+        Find the services due for a check, and schedule their next one
+
+        -Returns- List of service names, most overdue first
+        """
+        if now is None:
+            now = self.clock()
+        ready = []
+        while self._heap and self._heap[0][0] <= now:
+            when, _, name = heapq.heappop(self._heap)
+            if self._due.get(name) != when:
+                continue # removed, or rescheduled
+            ready.append(name)
+        for name in ready:
+            interval = self.interval_for(name)
+            next_run = self._due[name] + interval
+            if next_run <= now:
+                # fell a whole interval behind; don't try to catch up on missed checks
+                next_run = now + interval
+            self._push(name, next_run)
+        return ready
+
+    def next_due(self):
+        """
+        When the next service is due, on the scheduler's clock
+
+        -Returns- Float, or None when nothing is scheduled
+        """
+        while self._heap and self._due.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+
+def diff_services(old, new):
+    """
+    Compare two [services] mappings, like the output of ConfigReader.grab_many('services')
+
+    -Returns- Tuple of sets of service names
+        index[0] -> added services
+        index[1] -> removed services
+        index[2] -> services whose processes changed
+
+    @param old
+        The mapping of service name to process names currently in use
+
+    @param new
+        The mapping of service name to process names to change to
+    """
+    added = set(new) - set(old)
+    removed = set(old) - set(new)
+    changed = set(x for x in set(old) & set(new) if set(old[x]) != set(new[x]))
+    return added, removed, changed
 
 
 class Service(object):
@@ -89,14 +801,40 @@ class Service(object):
 
         What not to input::
            string -> 'my_process' ; this iterates as 'm', 'y', '_', 'p', 'r', 'o', 'c', 'e', 's', 's'
+
+    @param table
+        An instance of ProcessTable to obtain the initial state of the service from.
+        Default is None, which takes a new snapshot of the process table.
+
+    @param watcher
+        An instance of exitwatch.ExitWatcher. Every process found is handed to
+        the watcher, so exits are reported the moment they happen, between
+        checks; they should be passed back to reap().
+        Default is None, which only finds exits when status is called.
+
+    @param tree
+        Tuple of the (minimum, maximum) expected workers; either can be None.
+        Tracks each process as the root of a process tree, like a master
+        process and its forked workers. Only the roots are tracked by PID; a
+        matching process whose parent also matches is a worker. Workers coming
+        and going are only counted, in the workers attribute, and the count is
+        checked against the bounds by worker_breaches.
+        Default is None, which tracks every matching process by PID
     """
 
-    def __init__(self, name, processes=None):
-        if isinstance(process, str):
+    def __init__(self, name, processes=None, table=None, watcher=None, tree=None):
+        if isinstance(processes, basestring):
             raise ValueError('processes param cannot be string, must be iterable like list, tuple, etc')
         self._name = name
-        self._procs = { k:set() for k in procs }
-        self.status()
+        self.tree = tree
+        # process name -> (worker count, started, exited); only for process trees
+        self.workers = {}
+        self._workers = {}
+        self._procs = { k:set() for k in (processes or ()) }
+        # what status() last saw for each process; the table hands back the same object while nothing changes
+        self._seen = {}
+        self._watcher = watcher
+        self.status(table)
 
     def __repr__(self):
         return 'Service(name={0}, processes={1})'.format(self.name, ','.join(self.processes))
@@ -106,7 +844,7 @@ class Service(object):
         return len(self._procs)
 
     def __iter__(self):
-        """Iterate over the psutil.Process objects"""
+        """Iterate over the names of the tracked processes"""
         for proc in self._procs:
             yield proc
 
@@ -116,180 +854,1076 @@ class Service(object):
 
     @property
     def processes(self):
-        return self._procs.keys()
+        return list(self._procs.keys())
 
     def __getattr__(self, attr):
         """Enables users to get a list of pids for a process name"""
-        return list(self._procs[attr])
+        try:
+            return [x.pid for x in self.__dict__['_procs'][attr]]
+        except KeyError:
+            raise AttributeError(attr)
+
+    def tracked(self):
+        """
+        Iterate over every process the service knows is running
 
-    def _find(self):
+        -Returns- Generator of tuples
+            index[0] -> name of process
+            index[1] -> a psutil.Process object, or a ProcRecord
+        """
+        for name, procs in self._procs.items():
+            for proc in procs:
+                yield name, proc
+
+    def _find(self, table=None):
         """
         Obtain current data about monitored processes
 
         -Returns- Dictionary
             Key   -> name of process
             Value -> set of psutil.Process objects
-        """
-        info = dict.fromkeys(self._procs, set())
-        for proc in psutil.process_iter():
-            try:
-                proc_name = proc.name()
-            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                continue
-            else:
-                if proc_name in info:
-                    info[proc_name].add(proc)
 
-        return info
+        @param table
+            An instance of ProcessTable to look up processes in.
+            Default is None, which takes a new snapshot of the process table.
+        """
+        if table is None:
+            table = ProcessTable()
+        found = {}
+        for name in self._procs:
+            selector = Selector(name)
+            found[name] = table.lookup(name) if selector.plain else selector.select(table)
+        return found
 
-    def status(self):
+    def status(self, table=None, current=None):
         """
         Compairs the current state of the process table with known data about
         the service from the last check of the process table.
 
+        Processes are matched on PID and start time, so a reused PID is a death
+        and a birth, and nothing is polled; a process that isn't in the table
+        anymore is dead. A process whose group in the table is the same object
+        as last time is skipped without comparing, so the cost follows how much
+        changed, not how many processes are tracked.
+
         **Note** Mutates state of object by updating PID info for processes
 
         -Return- Tuple
            index[0] -> dictionary mapping process name to new pids
            index[1] -> dictionary mapping process name to dead pids
+
+        @param table
+            An instance of ProcessTable, shared between all services for a
+            single tick of the monitoring loop.
+            Default is None, which takes a new snapshot of the process table.
+
+        @param current
+            A dictionary mapping process name to a set of psutil.Process objects,
+            as routed to this service by ServiceIndex.route. Processes missing
+            from the dictionary were not found. When supplied, the table param
+            is only used for finding the workers of a process tree.
+            Default is None
         """
-        current = self._find()
+        if current is None:
+            if table is None:
+                table = ProcessTable(tree=self.tree is not None)
+            current = self._find(table)
         new_pids = {}
         dead_pids = {}
-        for name in current:
-            new = current[name] - self._proc[name]
-            new_pids[name] = [x.pid for x in new]
-            self._procs[name] = self._proc[name] | current[name] # Union between both sets
-
-        for name in self._procs:
-            for proc in self._procs[name]:
-                if not proc.is_running():
-                    group = dead_pids.setdefaults(name, [])
-                    group.append(proc.pid)
-                    self._procs[name].remove(proc)
+        for name, known in self._procs.items():
+            procs = current.get(name, _NO_PROCS)
+            if self.tree is not None:
+                procs = self._count_workers(name, procs, table)
+            elif procs is self._seen.get(name):
+                continue # no births or deaths since the last check
+            self._seen[name] = procs
+            new = procs - known
+            if new:
+                new_pids[name] = [x.pid for x in new]
+                if self._watcher is not None:
+                    for proc in new:
+                        self._watcher.watch(proc, key=(self._name, name))
+            dead = known - procs
+            if dead:
+                dead_pids[name] = [x.pid for x in dead]
+                if self._watcher is not None:
+                    for proc in dead:
+                        self._watcher.unwatch(proc.pid, key=(self._name, name))
+            if new or dead:
+                self._procs[name] = set(procs)
 
         return new_pids, dead_pids
 
+    def _count_workers(self, name, procs, table):
+        """
+        Split the processes of a tree into the roots and the workers, and count
+        how many workers started and exited since the last check
+
+        -Returns- Frozenset of the root processes
+        """
+        pids = set(x.pid for x in procs)
+        roots = frozenset(x for x in procs if parent_pid(x) not in pids)
+        workers = set()
+        if table is not None:
+            for root in roots:
+                workers.update(table.descendants(root))
+        before = self._workers.get(name, _NO_PROCS)
+        self.workers[name] = (len(workers), len(workers - before), len(before - workers))
+        self._workers[name] = workers
+        return roots
 
-class Dispatcher(Process):
+    def worker_breaches(self):
+        """
+        Find the process trees with fewer, or more workers than expected
+
+        -Returns- List of tuples
+            index[0] -> name of process
+            index[1] -> PID of the root process
+            index[2] -> String describing the breach, for the notification
+        """
+        if self.tree is None:
+            return []
+        low, high = self.tree
+        breaches = []
+        for name, (count, started, exited) in self.workers.items():
+            roots = self._procs.get(name)
+            if not roots:
+                continue # the root died; that's alerted on by itself
+            if (low is not None and count < low) or (high is not None and count > high):
+                detail = '{0} workers, expected {1} to {2}; {3} started and {4} exited since the last check'.format(count,
+                                                                                                                   low if low is not None else 0,
+                                                                                                                   high if high is not None else 'any',
+                                                                                                                   started,
+                                                                                                                   exited)
+                breaches.append((name, min(x.pid for x in roots), detail))
+        return breaches
+
+    def update(self, processes):
+        """
+        Change which processes make up the service. Processes that are still
+        part of the service keep their known PIDs; processes that were dropped
+        are no longer watched.
+
+        **Note** Mutates state of object by updating PID info for processes
+
+        @param processes
+            The names of all processes that makeup this service; same as
+            the processes param when creating a Service.
+        """
+        if isinstance(processes, basestring):
+            raise ValueError('processes param cannot be string, must be iterable like list, tuple, etc')
+        processes = set(processes)
+        for name in list(self._procs):
+            if name not in processes:
+                self._seen.pop(name, None)
+                self.workers.pop(name, None)
+                self._workers.pop(name, None)
+                for proc in self._procs.pop(name):
+                    if self._watcher is not None:
+                        self._watcher.unwatch(proc.pid, key=(self._name, name))
+        for name in processes:
+            self._procs.setdefault(name, set())
+
+    def close(self):
+        """Stop tracking every process; for when the service is removed"""
+        self.update(())
+
+    def reap(self, name, pid):
+        """
+        Stop tracking a process that an exit watcher reported as dead.
+
+        **Note** Mutates state of object by updating PID info for processes
+
+        -Returns- Boolean; True if the PID was being tracked
+
+        @param name
+            The name of the process
+
+        @param pid
+            The PID that exited
+        """
+        for proc in list(self._procs.get(name, ())):
+            if proc.pid == pid:
+                self._procs[name].remove(proc)
+                return True
+        return False
+
+
+class EventQueue(object):
     """
-    Encapsulates taking an event and notifying someone about it.
+    A bounded queue of Events between the monitoring loop and the Dispatcher.
+    The Dispatcher blocks on get() until there's an Event, instead of polling.
+
+    What happens when the Dispatcher falls behind and the queue fills up is up
+    to the overflow policy:
+      block       -> put() waits for room; backpressure on the monitoring loop
+      drop-oldest -> the oldest queued Event is thrown away to make room
+      coalesce    -> Events wait on the monitoring side, one per service & process,
+                     and are moved over by flush() as room frees up
+
+    @param maxsize
+        How many Events can be in the queue.
+        Default is 1000
+
+    @param overflow
+        One of 'block', 'drop-oldest', or 'coalesce'.
+        Default is 'block'
     """
-    local_ips = {}
+    POLICIES = ('block', 'drop-oldest', 'coalesce')
 
-    @staticmethod
-    def _find_ipaddrs():
+    def __init__(self, maxsize=1000, overflow='block'):
+        if overflow not in self.POLICIES:
+            raise ValueError('Unknown overflow policy: {0}, must be one of {1}'.format(overflow, ', '.join(self.POLICIES)))
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self._queue = multiprocessing.Queue(maxsize=maxsize)
+        self._pending = {}
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __repr__(self):
+        return 'EventQueue(maxsize={0}, overflow={1}, depth={2})'.format(self.maxsize, self.overflow, self.depth)
+
+    @property
+    def depth(self):
+        """
+        Roughly how many Events are queued; None if the platform can't tell (OS X)
+        """
+        try:
+            return self._queue.qsize()
+        except NotImplementedError:
+            return None
+
+    @property
+    def pending(self):
+        """How many coalesced Events are waiting for room in the queue"""
+        return len(self._pending)
+
+    def stats(self):
+        """
+        -Returns- Dictionary of counters about the queue
+        """
+        return {'depth' : self.depth,
+                'pending' : self.pending,
+                'sent' : self.sent,
+                'dropped' : self.dropped,
+                'coalesced' : self.coalesced,
+               }
+
+    def put(self, event):
+        """
+        Send an Event to the Dispatcher
+
+        -Returns- Boolean; False if the Event could not be queued right away
+        """
+        if self.overflow == 'block':
+            self._queue.put(event)
+            self.sent += 1
+            return True
+        if self.overflow == 'coalesce':
+            self.flush()
+            if self._pending:
+                # keep ordering; can't jump ahead of Events already waiting
+                return self._hold(event)
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            if self.overflow == 'coalesce':
+                return self._hold(event)
+            try:
+                self._queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass # the Dispatcher beat us to it
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                self.dropped += 1
+                return False
+        self.sent += 1
+        return True
+
+    def _hold(self, event):
+        if event in self._pending:
+            self.coalesced += 1
+        self._pending[event] = event
+        return False
+
+    def flush(self):
+        """
+        Move coalesced Events into the queue while there's room; never blocks
+
+        -Returns- Integer; how many Events are still pending
+        """
+        for event in list(self._pending):
+            try:
+                self._queue.put_nowait(self._pending[event])
+            except queue.Full:
+                break
+            del self._pending[event]
+            self.sent += 1
+        return len(self._pending)
+
+    def get(self, timeout=None):
+        """
+        Block until an Event is available, or the timeout is reached
+
+        -Returns- Event, or None on timeout
+
+        @param timeout
+            The max number of seconds to block for.
+            Default is None, which blocks forever
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Channel(object):
+    """
+    A bounded queue of messages for one way of notifying someone (email, slack,
+    etc), drained by its own pool of worker threads. A slow or dead channel only
+    backs up its own queue, not the other channels.
+
+    A failed send is retried with exponential backoff; i.e. backoff, 2*backoff,
+    4*backoff, etc seconds between attempts.
+
+    When the channel can send many messages at once, a worker takes whatever
+    else is waiting in the queue (up to batch messages) and sends it together.
+
+    Messages over the rate limit of the channel or of a recipient, or sent
+    while the circuit breaker is open, are held back, and sent as one summary
+    once the channel can send again. See the limits module.
+
+    @param name
+        What kind of notification the channel sends, like 'email'
+
+    @param send
+        A callable that accepts the message and the name of the event
+
+    @param logger
+        A Python logger object
+
+    @param workers
+        How many messages can be sent at the same time.
+        Default is 1
+
+    @param maxsize
+        How many messages can wait in the queue; new messages are dropped
+        (and logged) once the queue is full.
+        Default is 1000
+
+    @param retries
+        How many more times to try a failed send.
+        Default is 3
+
+    @param backoff
+        Seconds to wait before the first retry.
+        Default is 1
+
+    @param metrics
+        The metrics.Registry to record send times and failures in.
+        Default is None, which records them in a Registry of its own
+
+    @param send_batch
+        A callable that accepts a list of (message, event name) tuples.
+        Default is None, which sends every message with send
+
+    @param batch
+        The most messages to hand to send_batch at once.
+        Default is 1
+
+    @param limit
+        A limits.TokenBucket for every message of the channel.
+        Default is None, which doesn't limit the channel
+
+    @param recipient_limit
+        A limits.Buckets for the recipients of the channel.
+        Default is None, which doesn't limit each recipient
+
+    @param recipients
+        Who every message goes to, like the addresses of an email.
+        Default is (), which doesn't limit each recipient
+
+    @param send_to
+        A callable that accepts the message, the name of the event, and a list
+        of some of the recipients; used when a recipient is over their limit.
+        Default is None, which holds back the whole message instead
+
+    @param breaker
+        A limits.CircuitBreaker for the channel.
+        Default is None, which keeps trying a dead channel
+    """
+    def __init__(self, name, send, logger, workers=1, maxsize=1000, retries=3, backoff=1, metrics=None,
+                 send_batch=None, batch=1, limit=None, recipient_limit=None, recipients=(), send_to=None,
+                 breaker=None):
+        self.name = name
+        self.log = logger
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.batch = batch if send_batch is not None else 1
+        self._send = send
+        self._send_batch = send_batch
+        self._send_to = send_to
+        self._limit = limit
+        self._recipient_limit = recipient_limit if recipients else None
+        self._recipients = list(recipients)
+        self._breaker = breaker
+        self._held = Held()
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+        metrics = metrics if metrics is not None else Registry()
+        self._send_seconds = metrics.histogram('alarmer_send_seconds', 'Time spent on each attempt to send a notification')
+        self._failures = metrics.counter('alarmer_send_failures_total', 'Attempts to send a notification that failed')
+        self._dropped = metrics.counter('alarmer_channel_dropped_total', 'Notifications dropped because the channel queue was full')
+        self._depth = metrics.gauge('alarmer_channel_depth', 'Notifications waiting to be sent')
+        self._held_total = metrics.counter('alarmer_channel_held_total', 'Notifications held back by a rate limit or an open circuit')
+        self._open = metrics.gauge('alarmer_channel_open', 'Is the circuit breaker of the channel open (1) or not (0)')
+        metrics.on_render(self._render)
+
+    def __repr__(self):
+        return 'Channel(name={0}, workers={1}, queued={2})'.format(self.name, self.workers, self.depth)
+
+    @property
+    def depth(self):
+        """How many messages are waiting to be sent"""
+        return self._queue.qsize()
+
+    @property
+    def held(self):
+        """How many messages are held back, waiting to go out in a summary"""
+        return len(self._held)
+
+    def _render(self):
+        self._depth.set(self.depth, channel=self.name)
+        if self._breaker is not None:
+            self._open.set(int(self._breaker.state != CLOSED), channel=self.name)
+
+    def start(self):
+        """Spin up the worker threads"""
+        for idx in range(self.workers - len(self._threads)):
+            worker = threading.Thread(target=self._work,
+                                      name='{0}-sender-{1}'.format(self.name, idx))
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+
+    def stop(self):
+        """Wait for queued messages to be sent, then stop the worker threads"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for worker in self._threads:
+            worker.join()
+        self._threads = []
+
+    def put(self, msg, event_name):
+        """
+        Queue a message for sending; never blocks
+
+        -Returns- Boolean; False if the queue was full and the message dropped
+        """
+        try:
+            self._queue.put_nowait((msg, event_name))
+        except queue.Full:
+            self._dropped.inc(channel=self.name)
+            self.log.error('Dropped {0} notification for {1}; queue is full'.format(self.name, event_name))
+            return False
+        return True
+
+    def join(self):
+        """Block until every queued message has been handled"""
+        self._queue.join()
+
+    def _work(self):
+        """Worker thread loop"""
+        while True:
+            try:
+                items = [self._queue.get(timeout=self._held_wait())]
+            except queue.Empty:
+                # nothing new to send; see if the held messages can go out
+                self._send_held()
+                continue
+            # take whatever else is waiting, up to a batch; a stop marker ends the batch
+            while items[-1] is not None and len(items) < self.batch:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                batch = [x for x in items if x is not None]
+                if batch:
+                    self._handle(batch)
+                if items[-1] is None:
+                    self._send_held(final=True)
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+            if items[-1] is None:
+                return
+
+    def _handle(self, items):
+        """Send some messages, holding back the ones over a limit or while the circuit is open"""
+        now = time.time()
+        if self._breaker is not None and not self._breaker.allow(now):
+            self._hold(x[1] for x in items)
+            return
+        probe = self._breaker is not None and self._breaker.state == HALF_OPEN
+        ready = []
+        attempted = False
+        for msg, event_name in items:
+            if self._limit is not None and not self._limit.take(now):
+                self._hold([event_name])
+                continue
+            to = self._allowed(now)
+            if to is None:
+                ready.append((msg, event_name))
+            elif to and self._send_to is not None:
+                self._hold([event_name])
+                self._deliver(msg, event_name, to=to)
+                attempted = True
+            else:
+                self._hold([event_name])
+        if not ready and not attempted:
+            # every message was held back, so the probe never went out
+            if probe:
+                self._breaker.release()
+            return
+        if len(ready) > 1 and self._send_batch is not None:
+            sent = self._deliver_batch(ready)
+        else:
+            sent = False
+            for msg, event_name in ready:
+                sent = self._deliver(msg, event_name) or sent
+        if sent:
+            self._send_held()
+
+    def _allowed(self, now):
+        """
+        The recipients that are under their limit
+
+        -Returns- List, or None when every recipient is
+        """
+        if self._recipient_limit is None:
+            return None
+        to = [x for x in self._recipients if self._recipient_limit.take(x, now=now)]
+        if len(to) == len(self._recipients):
+            return None
+        return to
+
+    def _hold(self, event_names):
+        for event_name in event_names:
+            self._held.add(event_name)
+            self._held_total.inc(channel=self.name)
+
+    def _held_wait(self):
+        """Seconds to wait on the queue before trying to send the held messages"""
+        if not len(self._held):
+            return None
+        waits = [0]
+        if self._breaker is not None:
+            waits.append(self._breaker.wait())
+        if self._limit is not None:
+            waits.append(self._limit.wait())
+        return max(1, max(waits))
+
+    def _send_held(self, final=False):
+        """
+        Send one summary of the held messages, once the channel is under its
+        limit and its circuit is closed (or ready for a probe)
+
+        @param final
+            Set to True when the channel is stopping; ignores the rate limit,
+            and logs the held messages that couldn't be sent.
+            Default is False
+        """
+        if not len(self._held):
+            return
+        now = time.time()
+        if self._breaker is not None and not self._breaker.allow(now):
+            if final:
+                self.log.error('Dropped {0} held {1} notifications; the circuit is open'.format(len(self._held), self.name))
+            return
+        if not final and self._limit is not None and not self._limit.take(now):
+            if self._breaker is not None:
+                self._breaker.release()
+            return
+        taken = self._held.take()
+        if taken is None:
+            if self._breaker is not None:
+                self._breaker.release()
+            return
+        name = '{0} held notifications'.format(sum(taken[0].values()))
+        if not self._attempt(self._send, (self._held.summary(taken, self.name), name), name):
+            self._held.restore(taken)
+
+    def _deliver(self, msg, event_name, to=None):
+        """Send a message, retrying with backoff"""
+        if to is None:
+            sent = self._attempt(self._send, (msg, event_name), event_name)
+        else:
+            sent = self._attempt(self._send_to, (msg, event_name, to), event_name)
+        if sent is None:
+            self._hold([event_name])
+        return sent
+
+    def _deliver_batch(self, items):
+        """Send many messages at once, retrying with backoff"""
+        sent = self._attempt(self._send_batch, (items,), '{0} events'.format(len(items)))
+        if sent is None:
+            self._hold(x[1] for x in items)
+        return sent
+
+    def _attempt(self, send, args, label):
+        """
+        Call a send function, retrying with backoff
+
+        -Returns- True when sent, False when the retries ran out, and None
+                  when the circuit breaker is open
+        """
+        breaker = self._breaker
+        for attempt in range(self.retries + 1):
+            try:
+                with self._send_seconds.time(channel=self.name):
+                    send(*args)
+            except Exception as doh:
+                self._failures.inc(channel=self.name)
+                if breaker is not None:
+                    if breaker.failure():
+                        self.log.error('Circuit opened for {0} notifications after {1} failures in a row; holding them for {2}s: {3}'.format(
+                            self.name, breaker.failures, breaker.cooldown, doh))
+                    if breaker.state != CLOSED:
+                        return None
+                if attempt == self.retries:
+                    self.log.error('Giving up on {0} notification for {1}: {2}'.format(self.name, label, doh))
+                    return False
+                delay = self.backoff * (2 ** attempt)
+                self.log.warning('Failed {0} notification for {1}, retrying in {2}s: {3}'.format(self.name, label, delay, doh))
+                time.sleep(delay)
+            else:
+                if breaker is not None and breaker.success():
+                    self.log.info('Circuit closed for {0} notifications; sending again'.format(self.name))
+                return True
+
+
+class HostInfo(object):
+    """
+    The hostname and IP info of this machine, for adding to the messages we
+    dispatch. Enumerating every interface is slow on hosts with lots of them
+    (like containers hosts with hundreds of veth interfaces), so the info and
+    the rendered text are cached, and only refreshed once they're older than
+    the TTL; in case the IP changes (DHCP...).
+
+    @param ttl
+        How many seconds the info is good for.
+        Default is 300
+
+    @param only
+        An iterable of interface names to report on.
+        Default is None, which reports every interface
+    """
+    def __init__(self, ttl=300, only=None):
+        self.ttl = ttl
+        self.only = set(only) if only else None
+        self._addrs = {}
+        self._msg = ''
+        self._hostname = ''
+        self._expires = 0
+
+    def __repr__(self):
+        return 'HostInfo(hostname={0}, ttl={1}, interfaces={2})'.format(self._hostname,
+                                                                       self.ttl,
+                                                                       ','.join(sorted(self._addrs)))
+
+    def _find_ipaddrs(self):
         """
         So we can add the IP info to the message we dispatch.
         """
         addrs = {}
         for iface_name in interfaces():
-            addrs[iface_name] = [x['addr'] for x in ifaddresses(iface_name).setdefault(AF_INET, {'addr': "no addr"})]
+            if self.only is not None and iface_name not in self.only:
+                continue
+            addrs[iface_name] = [x['addr'] for x in ifaddresses(iface_name).get(AF_INET, [{'addr': 'no addr'}])]
 
         return addrs
 
+    @staticmethod
+    def _ip_info_msg(hostname, ip_dict):
+        """Convert the IP info into something cleaner"""
+        tmp = []
+        for key in sorted(ip_dict):
+            tmp.append('{0}\n\t{1}\n'.format(key, ','.join(ip_dict[key])))
+        return 'Machine {0} IP info:\n{1}'.format(hostname, ''.join(tmp))
+
+    def refresh(self, now=None):
+        """
+        Look up the hostname & IP info, ignoring the TTL
+
+        **Note** Mutates state of object by replacing the cached info
+        """
+        if now is None:
+            now = time.time()
+        self._hostname = socket.gethostname()
+        self._addrs = self._find_ipaddrs()
+        self._msg = self._ip_info_msg(self._hostname, self._addrs)
+        self._expires = now + self.ttl
+
+    def _check(self):
+        if time.time() >= self._expires:
+            self.refresh()
+
+    @property
+    def hostname(self):
+        self._check()
+        return self._hostname
+
+    @property
+    def addrs(self):
+        """Dictionary mapping interface name to a list of IPv4 addresses"""
+        self._check()
+        return self._addrs
+
+    @property
+    def msg(self):
+        """The IP info, rendered for a message"""
+        self._check()
+        return self._msg
+
+
+class Digest(object):
+    """
+    Collects Events over a window of time, grouped by host & service, so a
+    cascading failure turns into one notification per group instead of one per
+    Event. The window opens with the first Event added after a flush.
+
+    @param window
+        How many seconds to collect Events for before they're ready to send
+
+    @param host
+        The name of the host the Events came from.
+        Default is None, which uses the hostname of this machine
+    """
+    def __init__(self, window, host=None):
+        self.window = window
+        self.host = host or socket.gethostname()
+        self._groups = {}
+        self.opened = None
+
+    def __repr__(self):
+        return 'Digest(window={0}, groups={1})'.format(self.window, len(self._groups))
+
+    def __len__(self):
+        """How many groups are waiting to be sent"""
+        return len(self._groups)
+
+    def add(self, event, now=None):
+        """
+        Add an Event to the current window. A newer copy of an Event replaces
+        the older one, so each process shows up once per group.
+
+        @param event
+            An instance of Event
+
+        @param now
+            When the Event was received, in EPOC time.
+            Default is None, which uses the current time
+        """
+        if self.opened is None:
+            self.opened = time.time() if now is None else now
+        host = getattr(event, 'host', None) or self.host
+        group = self._groups.setdefault((host, event.service), {})
+        group[(event.process, event.kind)] = event
+
+    def ready(self, now=None):
+        """
+        Has the current window closed?
+
+        -Returns- Boolean
+        """
+        if self.opened is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now - self.opened >= self.window
+
+    def flush(self):
+        """
+        Empty out the current window
+
+        -Returns- Dictionary
+            Key   -> Tuple of (host, service)
+            Value -> List of Events, sorted by process name
+        """
+        groups = {}
+        for key, group in self._groups.items():
+            groups[key] = [group[x] for x in sorted(group)]
+        self._groups = {}
+        self.opened = None
+        return groups
+
+
+class Dispatcher(Process):
+    """
+    Encapsulates taking an event and notifying someone about it.
+
+    Runs as a pipeline; the intake loop pulls Events off the queue, formats them
+    and hands the message to a Channel per kind of notification. Each Channel
+    sends on its own worker threads, with its own retries.
+
+    @param config
+        An instance of the ConfigReader object
+
+    @param logger
+        A Python logger object
+
+    @param events
+        An instance of EventQueue, that Events are sent over
+
+    @param metrics
+        The metrics.Registry to record in; a metrics.SharedRegistry when the
+        Dispatcher runs as its own process, so the metrics reach the parent.
+        Default is None, which records in a Registry of its own
+    """
+    def __init__(self, config=None, logger=None, events=None, metrics=None):
+        super(Dispatcher, self).__init__()
+        self.daemon = True
+        self.config = config
+        self.log = logger
+        self.events = events
+        self.metrics = metrics if metrics is not None else Registry()
+        self.metrics_interval = 15
+        self._dispatched = self.metrics.counter('alarmer_dispatch_events_total', 'Events handed to the dispatcher')
+        self.channels = {}
+        self.notifiers = {}
+        self.digest = None
+        self.host_info = HostInfo()
+
     def _format_msg(self, event):
         """
         Generate a message string from an Event object
         """
-        # Update for every message in case the IP changes (DHCP...)
-        self.local_ips = self._find_ipaddrs()
-
         birth_time = self._format_timestamp(event.birth)
         recent_time = self._format_timestamp(event.last_event)
-        ip_msg = self._ip_info_msg(self.local_ips)
+        ip_msg = self.host_info.msg
 
-        if birth_time == recent_time:
+        if event.kind == DIED and birth_time == recent_time:
            # first message for the event
            msg = 'Service {0} went offline at {1}\n'.format(event.name,
                                                             birth_time)
-           msg += ip_msg
         else:
-           msg = 'Service {0} went offline {1} times since {2}'.format(event.name,
-                                                                       event.count,
-                                                                       birth_time)
-           msg += ip_msg
+           msg = 'Service {0} {1} since {2}\n'.format(event.name,
+                                                      self._describe(event),
+                                                      birth_time)
+        msg += ip_msg
+        hosts = getattr(event, 'hosts', None)
+        if hosts:
+            # a FleetEvent, merged from many hosts by a Collector
+            msg += 'Reported by {0} hosts: {1}\n'.format(len(hosts), ', '.join(sorted(hosts)))
         return msg
 
     @staticmethod
-    def _ip_info_msg(ip_dict):
-        """Convert the IP info into something cleaner"""
-        tmp = []
-        for key in ip_dict:
-            tmp.append('{0}\n\t{1}'.format(key, ','.join(ip_dict[key])))
-        return 'Machine IP info:\n{0}'.format(''.join(tmp))
+    def _describe(event):
+        """
+        What happened to the process of an Event, and how many times; the
+        same wording goes in a message, and in a line of a digest
+        """
+        if event.kind == WORKERS:
+            return 'has the wrong number of workers; {0}. Seen {1} times'.format(event.detail, event.event_count)
+        if event.kind == FLAPPING:
+            return 'keeps restarting; {0}. Seen flapping {1} times'.format(event.detail, event.event_count)
+        if event.kind != DIED:
+            return 'is over its {0} limit; {1}. Over the limit {2} times'.format(event.kind, event.detail, event.event_count)
+        return 'went offline {0} times'.format(event.event_count)
+
+    def _format_digest(self, name, events):
+        """
+        Generate one message string for many Event objects of a service
+
+        @param name
+            Who the events are for, like 'webserver on host1'
+
+        @param events
+            A list of Event objects
+        """
+        total = sum(x.event_count for x in events)
+        since = self._format_timestamp(min(x.birth for x in events))
+        if all(x.kind == DIED for x in events):
+            msg = 'Service {0} had {1} processes go offline {2} times since {3}\n'.format(name,
+                                                                                       len(events),
+                                                                                       total,
+                                                                                       since)
+        else:
+            msg = 'Service {0} had {1} problems, seen {2} times since {3}\n'.format(name,
+                                                                                  len(events),
+                                                                                  total,
+                                                                                  since)
+        for event in events:
+            label = event.process if event.kind == DIED else '{0} ({1})'.format(event.process, event.kind)
+            msg += '\t{0} {1}, PIDs {2}\n'.format(label,
+                                                   self._describe(event),
+                                                   ','.join(str(x) for x in event.pid))
+            if getattr(event, 'hosts', None):
+                msg += '\t\ton hosts {0}\n'.format(', '.join(sorted(event.hosts)))
+        msg += self.host_info.msg
+        return msg
 
     @staticmethod
     def _format_timestamp(time_val):
         """Turns EPOC time into human time"""
-        return datetime.datetime.formtimestamp(int(time_val)).strftime('%Y-%m-%d %H:%M:%S')
+        return datetime.datetime.fromtimestamp(int(time_val)).strftime('%Y-%m-%d %H:%M:%S')
 
-    def run(self, config, logger, pipe):
+    def _make_channels(self):
         """
-        Loop for new events to notify about
+        Build a Channel for every enabled kind of notification
 
-        @param config
-            An instance of the ConfigReader object
+        -Returns- Dictionary
+            Key   -> name of channel
+            Value -> Channel object
+        """
+        notifiers = load_notifiers(self.config.grab('plugins', section='dispatch', cast=False))
+        channels = {}
+        for name in sorted(notifiers):
+            if self._setting('enable_{0}'.format(name), False) is not True:
+                continue
+            notifier = self.notifiers[name] = notifiers[name](self.config, self.log, name)
+            limit, recipient_limit, breaker = self._make_limits(name)
+            channels[name] = Channel(name=name,
+                                     send=notifier.send,
+                                     send_batch=notifier.send_batch,
+                                     batch=notifier.batch,
+                                     limit=limit,
+                                     recipient_limit=recipient_limit,
+                                     recipients=notifier.recipients,
+                                     send_to=notifier.send_to if overrides(notifier, 'send_to') else None,
+                                     breaker=breaker,
+                                     logger=self.log,
+                                     workers=self._setting('{0}_workers'.format(name), 1),
+                                     maxsize=self.config.grab('queue_size', section='dispatch'),
+                                     retries=self.config.grab('retries', section='dispatch'),
+                                     backoff=self.config.grab('retry_backoff', section='dispatch'),
+                                     metrics=self.metrics,
+                                     )
+        return channels
 
-        @param logger
-            A Python logger object
+    def _make_limits(self, name):
+        """
+        Build the rate limits and circuit breaker of a channel. The rate_limit
+        and rate_burst of [dispatch] can be set per channel, as
+        <name>_rate_limit and <name>_rate_burst.
 
-        @param pipe
-            An instantiated Event object
+        -Returns- Tuple; a TokenBucket, Buckets and CircuitBreaker, each None when turned off
         """
-        self.config = config
-        self.log = logger
-        alerts = []
-        while True:
-            if pipe.poll():
-                # if there's something in the pipe, pull everything out of it
-                # prevents periodic alerting from blocking the monitoring loop
-                while pipe.poll():
-                    tmp = pipe.recv()
-                    alerts.append(tmp)
-
-                for event in alerts:
-                    msg = self._format_msg(event)
-
-                    if self.email_on:
-                        self._send_email(msg, event.name)
-
-                    if self.slack_on:
-                        self._send_slack(msg, event.name)
-
-                    if not (self.email_on or self.slack_on):
-                        msg = 'Unable to send event for {0} because all notifications are disabled'
-                        self.log.error(msg)
-                alerts = []
-            else:
-                time.sleep(0.5)
+        rate = self._setting('{0}_rate_limit'.format(name), self._setting('rate_limit', 0))
+        burst = self._setting('{0}_rate_burst'.format(name), self._setting('rate_burst', 1))
+        recipient_rate = self._setting('recipient_rate_limit', 0)
+        failures = self._setting('breaker_failures', 0)
+        limit = TokenBucket(rate, burst) if rate else None
+        recipient_limit = Buckets(recipient_rate, self._setting('recipient_burst', 1)) if recipient_rate else None
+        breaker = CircuitBreaker(failures, self._setting('breaker_cooldown', 60)) if failures else None
+        return limit, recipient_limit, breaker
+
+    def _setting(self, item, default):
+        """Read an item from [dispatch] that a plugin notifier might not have"""
+        try:
+            return self.config.grab(item, section='dispatch')
+        except ConfigParsingError:
+            return default
 
-    def _send_email(self, msg, event_name):
+    def stop_channels(self):
         """
-        Opens a connection to the SMTP mail server, and sends the
-        event email.
+        Send what's queued on every Channel, then release the connections of
+        every notifier. Only useful where the Channels run; i.e. in process, or
+        in the Dispatcher process itself. Not named close, since that's
+        multiprocessing.Process.close for the parent.
+        """
+        for channel in self.channels.values():
+            channel.stop()
+        for notifier in self.notifiers.values():
+            notifier.close()
 
-        @param msg
-            The message to relay to someone
-            -Type- string
+    def dispatch(self, event):
+        """
+        Format an Event and queue it on every Channel; never blocks on sending
 
-        @param event_name
-            Provides some meta data in email subject line
-            -Type- string
+        @param event
+            An instance of Event
         """
-        email = MIMEText(msg)
-        email['Subject'] = 'Alarmer Event for {0}'.format(event_name)
-        email['From'] = 'NoReply'
-        email['To'] = self.config.grab('email_to'.split(','))
+        self._dispatched.inc()
+        if not self.channels:
+            msg = 'Unable to send event for {0} because all notifications are disabled'
+            self.log.error(msg.format(event.name))
+        elif self.digest is not None:
+            self.digest.add(event)
+        else:
+            self._queue(self._format_msg(event), event.name)
 
-        host = self.config.grab('email_server_host')
-        port = self.config.grab('email_server_port')
-        mail_server = smtplib.SMTP(host, port)
-        mail_server.sendmail(email.as_string())
-        mail_server.quit()
+    def flush_digest(self, force=False):
+        """
+        Send one message per group in the digest, once its window has closed
+
+        @param force
+            Set to True to send the digest even if the window is still open.
+            Default is False
+        """
+        if self.digest is None or not (force or self.digest.ready()):
+            return
+        groups = self.digest.flush()
+        for host, service in sorted(groups):
+            name = '{0} on {1}'.format(service, host)
+            self._queue(self._format_digest(name, groups[(host, service)]), name)
+
+    def _queue(self, msg, event_name):
+        """Hand a message to every Channel"""
+        for channel in self.channels.values():
+            channel.put(msg, event_name)
 
-    def _send_slack(self, msg, event_name):
+    def setup(self):
         """
-        TODO
+        Build and start the Channels, digest and host info from the config.
+        Called by run(); call it directly to use the Dispatcher in the same
+        process as the monitoring loop, via dispatch() and flush_digest().
         """
-        pass
+        self.channels = self._make_channels()
+        only = self.config.grab('report_interfaces', section='dispatch', cast=False)
+        self.host_info = HostInfo(ttl=self.config.grab('ip_cache_ttl', section='dispatch'),
+                                  only=[x.strip() for x in only.split(',') if x.strip()] or None)
+        self.metrics_interval = self.config.grab('interval', section='metrics')
+        window = self.config.grab('digest_window', section='dispatch')
+        if window:
+            self.digest = Digest(window)
+        for channel in self.channels.values():
+            channel.start()
+
+    def digest_due(self):
+        """
+        Seconds until the digest needs to be sent
+
+        -Returns- Float, or None when there's nothing waiting in the digest
+        """
+        if self.digest is None or not len(self.digest):
+            return None
+        return max(0, self.digest.window - (time.time() - self.digest.opened))
+
+    def run(self):
+        """
+        Loop for new events to notify about
+        """
+        self.setup()
+        push = getattr(self.metrics, 'push', None)
+        next_push = time.time()
+        while True:
+            # wake up in time to send the digest
+            timeout = self.digest_due()
+            if push is not None:
+                # and to hand the metrics to the parent process
+                if time.time() >= next_push:
+                    push()
+                    next_push = time.time() + self.metrics_interval
+                wait = max(0, next_push - time.time())
+                timeout = wait if timeout is None else min(timeout, wait)
+            event = self.events.get(timeout=timeout)
+            if event is not None:
+                self.dispatch(event)
+            self.flush_digest()
@@ -0,0 +1,381 @@
+# -*- coding: UTF-8 -*-
+"""
+The ways alarmer can notify someone. Each Notifier is handed to a Channel by
+the Dispatcher, which calls it from the Channel's worker threads, so a slow
+notifier never holds up the Dispatcher.
+
+Notifiers are found by name, from the built in ones below, the
+'alarmer.notifiers' entry point group of installed packages, and the plugins
+option of [dispatch] (name=module:Class, comma separated). A notifier is only
+used when enable_<name> is true in [dispatch]; it reads the rest of its
+settings from [dispatch] too, as <name>_<setting>.
+
+A plugin subclasses Notifier, and implements send (and optionally send_batch,
+when it can deliver many messages in one go).
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import socket
+import smtplib
+import importlib
+import threading
+from email.mime.text import MIMEText
+
+import requests
+from requests.adapters import HTTPAdapter
+
+ENTRY_POINT_GROUP = 'alarmer.notifiers'
+
+
+class Notifier(object):
+    """
+    Sends messages one way, like email or Slack.
+
+    @param config
+        An instance of the ConfigReader object
+
+    @param logger
+        A Python logger object
+
+    @param name
+        The name the notifier was registered under; its settings in [dispatch]
+        start with it
+    """
+    # how many messages send_batch can take at once; 1 means send is always used
+    batch = 1
+    # who every message goes to, for rate limiting each of them; without its
+    # own send_to, a message is held back whole while any of them is limited
+    recipients = ()
+
+    def __init__(self, config, logger, name):
+        self.config = config
+        self.log = logger
+        self.name = name
+
+    def __repr__(self):
+        return '{0}(name={1})'.format(type(self).__name__, self.name)
+
+    def setting(self, item, cast=True):
+        """Read <name>_<item> from the [dispatch] section"""
+        return self.config.grab('{0}_{1}'.format(self.name, item), section='dispatch', cast=cast)
+
+    def send(self, msg, event_name):
+        """
+        Deliver one message; raise an exception on failure, so it's retried
+
+        @param msg
+            The message to relay to someone
+
+        @param event_name
+            What the message is about, like 'web -> nginx'
+        """
+        raise NotImplementedError
+
+    def send_to(self, msg, event_name, recipients):
+        """
+        Deliver one message to only some of the recipients, like when the
+        others are over their rate limit. Optional; see the recipients attribute
+
+        @param recipients
+            List of some of the recipients attribute
+        """
+        raise NotImplementedError
+
+    def send_batch(self, items):
+        """
+        Deliver many messages; raise an exception on failure, so they're retried
+
+        @param items
+            List of (msg, event_name) tuples; no more than the batch attribute
+        """
+        for msg, event_name in items:
+            self.send(msg, event_name)
+
+    def close(self):
+        """Release any connections"""
+        pass
+
+
+class SMTPPool(object):
+    """
+    Keeps connections to the SMTP mail server open between messages, so a burst
+    of alerts doesn't pay for a TCP and SMTP handshake per message. An idle
+    connection is checked with NOOP before it's reused, and replaced if the
+    server has hung up on it.
+
+    Safe to share between the worker threads of a Channel.
+
+    @param host
+        The SMTP mail server
+
+    @param port
+        The port of the SMTP mail server
+
+    @param size
+        The max number of idle connections to keep open.
+        Default is 1
+
+    @param timeout
+        Seconds to wait on the mail server before giving up.
+        Default is 10
+    """
+    def __init__(self, host, port, size=1, timeout=10):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'SMTPPool(host={0}, port={1}, idle={2})'.format(self.host, self.port, len(self._idle))
+
+    def _connect(self):
+        return smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+    @staticmethod
+    def _alive(conn):
+        """Is the connection still usable?"""
+        try:
+            return conn.noop()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, socket.error):
+            conn.close()
+
+    def acquire(self):
+        """
+        Obtain a working connection; reuses an idle one when possible
+
+        -Returns- smtplib.SMTP object
+        """
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                return self._connect()
+            if self._alive(conn):
+                return conn
+            self._discard(conn)
+
+    def release(self, conn):
+        """Hand a connection back to the pool, or close it if the pool is full"""
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        self._discard(conn)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """
+        Send a message over a pooled connection. If the server hung up between
+        the NOOP check and sending, the message is sent once more over a new
+        connection.
+        """
+        conn = self.acquire()
+        try:
+            conn.sendmail(from_addr, to_addrs, msg)
+        except smtplib.SMTPServerDisconnected:
+            self._discard(conn)
+            conn = self._connect()
+            try:
+                conn.sendmail(from_addr, to_addrs, msg)
+            except Exception:
+                self._discard(conn)
+                raise
+        except Exception:
+            self._discard(conn)
+            raise
+        self.release(conn)
+
+    def close(self):
+        """Close every idle connection"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+
+class EmailNotifier(Notifier):
+    """
+    Sends one email per message, over a pool of SMTP connections.
+
+    Settings: email_server_host, email_server_port, email_to, email_timeout
+    and email_workers (the size of the pool).
+    """
+    def __init__(self, config, logger, name='email'):
+        super(EmailNotifier, self).__init__(config, logger, name)
+        self.to = self.setting('to', cast=False)
+        self.recipients = [x.strip() for x in self.to.split(',') if x.strip()]
+        self.pool = SMTPPool(host=self.setting('server_host', cast=False),
+                             port=self.setting('server_port'),
+                             size=self.setting('workers'),
+                             timeout=self.setting('timeout'),
+                            )
+
+    def send(self, msg, event_name):
+        """
+        Sends the event email over a pooled connection to the SMTP mail server.
+
+        @param msg
+            The message to relay to someone
+            -Type- string
+
+        @param event_name
+            Provides some meta data in email subject line
+            -Type- string
+        """
+        self.send_to(msg, event_name, self.recipients)
+
+    def send_to(self, msg, event_name, recipients):
+        email = MIMEText(msg)
+        email['Subject'] = 'Alarmer Event for {0}'.format(event_name)
+        email['From'] = 'NoReply'
+        email['To'] = ', '.join(recipients)
+
+        self.pool.sendmail(email['From'], recipients, email.as_string())
+
+    def close(self):
+        self.pool.close()
+
+
+class WebhookNotifier(Notifier):
+    """
+    POSTs messages as JSON to a URL, many at a time, over a shared
+    requests.Session; the connections are kept alive and pooled between
+    posts, one per worker of the Channel.
+
+    The body is {"events": [{"event": <event_name>, "message": <msg>}, ...]}
+
+    Settings: <name>_url, <name>_timeout, <name>_workers and <name>_batch
+    (the most messages to put in one post).
+    """
+    def __init__(self, config, logger, name='webhook'):
+        super(WebhookNotifier, self).__init__(config, logger, name)
+        self.url = self.setting('url', cast=False)
+        if not self.url:
+            raise ValueError('Notifier {0} needs a {0}_url in [dispatch]'.format(name))
+        self.timeout = self.setting('timeout')
+        self.batch = max(1, self.setting('batch'))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, self.setting('workers')))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def payload(self, items):
+        """
+        Build the JSON body for some messages
+
+        -Returns- Dictionary
+
+        @param items
+            List of (msg, event_name) tuples
+        """
+        return {'events' : [{'event' : name, 'message' : msg} for msg, name in items]}
+
+    def send(self, msg, event_name):
+        self.send_batch([(msg, event_name)])
+
+    def send_batch(self, items):
+        resp = self.session.post(self.url, json=self.payload(items), timeout=self.timeout)
+        resp.raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+
+class SlackNotifier(WebhookNotifier):
+    """
+    POSTs messages to a Slack incoming webhook; a batch of messages is sent
+    as one Slack message.
+
+    Settings: slack_url, slack_timeout, slack_workers and slack_batch.
+    """
+    def __init__(self, config, logger, name='slack'):
+        super(SlackNotifier, self).__init__(config, logger, name)
+
+    def payload(self, items):
+        return {'text' : '\n'.join('*{0}*\n{1}'.format(name, msg) for msg, name in items)}
+
+
+def overrides(notifier, method):
+    """
+    Does a Notifier implement a method itself, instead of using the one from
+    the Notifier class?
+
+    -Returns- Boolean
+    """
+    mine = getattr(type(notifier), method)
+    base = getattr(Notifier, method)
+    # unbound methods on Python 2 wrap the function
+    return getattr(mine, '__func__', mine) is not getattr(base, '__func__', base)
+
+
+NOTIFIERS = {'email' : EmailNotifier,
+             'slack' : SlackNotifier,
+             'webhook' : WebhookNotifier,
+            }
+
+
+def _entry_points(group):
+    """The entry points of installed packages in a group"""
+    try:
+        from importlib import metadata
+    except ImportError:
+        try:
+            import pkg_resources
+        except ImportError:
+            return []
+        return list(pkg_resources.iter_entry_points(group))
+    found = metadata.entry_points()
+    if hasattr(found, 'select'):
+        return list(found.select(group=group))
+    return list(found.get(group, ()))
+
+
+def import_notifier(path):
+    """
+    Import a Notifier class from a 'module:Class' string
+
+    -Raises- ValueError when the string is malformed, or the class can't be imported
+    """
+    module, sep, attr = path.strip().partition(':')
+    if not (module and sep and attr):
+        raise ValueError('Notifier must be module:Class, not {0!r}'.format(path))
+    try:
+        return getattr(importlib.import_module(module), attr)
+    except (ImportError, AttributeError) as doh:
+        raise ValueError('Unable to import notifier {0}: {1}'.format(path, doh))
+
+
+def load_notifiers(plugins=''):
+    """
+    Find every Notifier by name; the built in ones, then entry points, then
+    the plugins from the config. A later one replaces an earlier one of the
+    same name.
+
+    -Returns- Dictionary mapping name to a Notifier class
+
+    -Raises- ValueError when a plugin can't be loaded
+
+    @param plugins
+        A comma separated string of name=module:Class, like the plugins option
+        of [dispatch].
+        Default is ''
+    """
+    notifiers = dict(NOTIFIERS)
+    for entry in _entry_points(ENTRY_POINT_GROUP):
+        notifiers[entry.name] = entry.load()
+    for plugin in (plugins or '').split(','):
+        if not plugin.strip():
+            continue
+        name, sep, path = plugin.partition('=')
+        if not sep or not name.strip():
+            raise ValueError('Plugin must be name=module:Class, not {0!r}'.format(plugin))
+        notifiers[name.strip()] = import_notifier(path)
+    return notifiers
@@ -0,0 +1,300 @@
+# -*- coding: UTF-8 -*-
+"""
+A Linux only scanner for the process table, which reads /proc/<pid>/stat
+directly instead of building a psutil.Process object (and making several
+syscalls) for every PID on the host.
+
+Yields ProcRecord objects, which quack enough like psutil.Process for the
+ProcessTable and Service objects; i.e. name(), pid and is_running().
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os
+import errno
+try:
+    import pwd
+except ImportError:
+    pwd = None # not on Windows, which has no procfs anyway
+
+
+PROC_ROOT = '/proc'
+# the kernel truncates the 'comm' of a process to this many characters
+COMM_LENGTH = 15
+# for turning the times & sizes in a stat file into seconds & bytes
+CLOCK_TICKS = os.sysconf(str('SC_CLK_TCK')) if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf(str('SC_PAGE_SIZE')) if hasattr(os, 'sysconf') else 4096
+# the states in a stat file of a process that has exited; zombie & dead
+_EXITED = (b'Z', b'X', b'x')
+
+
+def available(root=PROC_ROOT):
+    """
+    Can the process table be read from procfs on this machine?
+
+    -Returns- Boolean
+    """
+    return os.path.isfile(os.path.join(root, 'self', 'stat'))
+
+
+class ProcRecord(object):
+    """
+    A compact, read-only record of a process found in /proc.
+
+    Two records are equal when they share a PID and start time, so a PID that
+    was reused by the kernel is not mistaken for the original process.
+
+    @param pid
+        The process ID
+
+    @param name
+        The name of the process
+
+    @param ppid
+        The process ID of the parent process
+
+    @param start_time
+        When the process started, in clock ticks since boot
+
+    @param scanner
+        The ProcScanner that found the process; used to check if it's still running
+    """
+    __slots__ = ('pid', 'ppid', 'start_time', '_name', '_scanner')
+
+    def __init__(self, pid, name, ppid, start_time, scanner):
+        self.pid = pid
+        self.ppid = ppid
+        self.start_time = start_time
+        self._name = name
+        self._scanner = scanner
+
+    def __repr__(self):
+        return 'ProcRecord(pid={0}, name={1}, ppid={2}, start_time={3})'.format(self.pid,
+                                                                              self._name,
+                                                                              self.ppid,
+                                                                              self.start_time)
+
+    def __hash__(self):
+        return hash((self.pid, self.start_time))
+
+    def __eq__(self, other):
+        try:
+            return self.pid == other.pid and self.start_time == other.start_time
+        except AttributeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def name(self):
+        """Same as psutil.Process.name"""
+        return self._name
+
+    def is_running(self):
+        """
+        Same as psutil.Process.is_running; safe against PID reuse
+
+        -Raises- OSError/IOError when the stat file can't be read for a reason
+                 other than the process being gone; like running out of file
+                 descriptors
+        """
+        stat = self._scanner.read_stat(self.pid, strict=True)
+        return stat is not None and stat[2] == self.start_time
+
+    def cmdline(self):
+        """Same as psutil.Process.cmdline"""
+        with open(os.path.join(self._scanner.root, str(self.pid), 'cmdline'), 'rb') as the_file:
+            data = the_file.read()
+        return [x.decode('utf-8', 'replace') for x in data.split(b'\x00') if x]
+
+    def exe(self):
+        """Same as psutil.Process.exe"""
+        return os.readlink(os.path.join(self._scanner.root, str(self.pid), 'exe'))
+
+    def username(self):
+        """Same as psutil.Process.username"""
+        uid = os.stat(os.path.join(self._scanner.root, str(self.pid))).st_uid
+        try:
+            return pwd.getpwuid(uid).pw_name
+        except KeyError:
+            return str(uid)
+
+    def usage(self, fds=False):
+        """
+        How much of the machine the process is using
+
+        -Returns- Tuple, or None if the process is gone
+            index[0] -> CPU time used, user + system, in seconds
+            index[1] -> resident set size, in bytes
+            index[2] -> number of open file descriptors, or None when not asked for
+
+        @param fds
+            Set to True to count the open file descriptors; that's a directory
+            listing, so it's skipped unless needed.
+            Default is False
+        """
+        return self._scanner.read_usage(self.pid, self.start_time, fds)
+
+
+class ProcScanner(object):
+    """
+    Walks /proc and yields a ProcRecord for every process. Calling the object
+    is a drop in replacement for psutil.process_iter.
+
+    The read buffer is reused between scans, and so are the records of processes
+    that are still alive, which keeps allocations per tick to a minimum.
+
+    @param root
+        Where procfs is mounted.
+        Default is /proc
+
+    @param bufsize
+        The size, in bytes, of the buffer for reading a stat file.
+        Default is 1024; a stat file is normally ~300 bytes
+    """
+    def __init__(self, root=PROC_ROOT, bufsize=1024):
+        self._root = root
+        self._buf = bytearray(bufsize)
+        self._records = {}
+
+    def __repr__(self):
+        return 'ProcScanner(root={0})'.format(self._root)
+
+    @property
+    def root(self):
+        """Where procfs is mounted"""
+        return self._root
+
+    def __call__(self):
+        records = {}
+        try:
+            entries = os.listdir(self._root)
+        except OSError:
+            entries = []
+        for entry in entries:
+            if not entry.isdigit():
+                continue
+            pid = int(entry)
+            stat = self.read_stat(pid)
+            if stat is None:
+                continue # exited while we were scanning
+            name, ppid, start_time = stat
+            record = self._records.get(pid)
+            if record is None or record.start_time != start_time:
+                if len(name) >= COMM_LENGTH:
+                    name = self._full_name(pid, name)
+                record = ProcRecord(pid, name, ppid, start_time, self)
+            records[pid] = record
+            yield record
+        self._records = records
+
+    def _read(self, path):
+        """
+        Read a file into the reusable buffer
+
+        -Returns- Integer; the number of bytes read
+
+        -Raises- OSError/IOError when the file cannot be read
+        """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            count = _readinto(fd, self._buf)
+        finally:
+            os.close(fd)
+        return count
+
+    def read_stat(self, pid, strict=False):
+        """
+        Parse the name, parent PID and start time out of /proc/<pid>/stat
+
+        -Returns- Tuple, or None if the process does not exist, or is a zombie
+            index[0] -> name of process
+            index[1] -> parent PID
+            index[2] -> start time of process, in clock ticks since boot
+
+        -Raises- OSError/IOError when strict, and the stat file can't be read
+                 for a reason other than the process being gone
+
+        @param strict
+            Set to True to only return None when the process is gone, and
+            raise on any other error (like EMFILE).
+            Default is False
+        """
+        try:
+            count = self._read(os.path.join(self._root, str(pid), 'stat'))
+        except (OSError, IOError) as doh:
+            if strict and doh.errno not in (errno.ENOENT, errno.ESRCH):
+                raise
+            return None
+        buf = self._buf
+        # the name can contain spaces and parens, so find the outer most pair
+        lparen = buf.find(b'(', 0, count)
+        rparen = buf.rfind(b')', 0, count)
+        if lparen == -1 or rparen == -1:
+            return None
+        name = bytes(buf[lparen + 1:rparen]).decode('utf-8', 'replace')
+        # fields after the name start at field #3 (state); ppid is #4, starttime is #22
+        fields = bytes(buf[rparen + 2:count]).split(b' ', 20)
+        # a zombie has exited, it's just waiting on its parent to reap it
+        if fields[0] in _EXITED:
+            return None
+        try:
+            return name, int(fields[1]), int(fields[19])
+        except (IndexError, ValueError):
+            return None
+
+    def read_usage(self, pid, start_time, fds=False):
+        """
+        Parse the CPU time and RSS out of /proc/<pid>/stat, and optionally count
+        the entries in /proc/<pid>/fd; same as ProcRecord.usage.
+
+        -Returns- Tuple, or None if the process does not exist, or the PID now
+                  belongs to a different process
+        """
+        try:
+            count = self._read(os.path.join(self._root, str(pid), 'stat'))
+        except (OSError, IOError):
+            return None
+        buf = self._buf
+        rparen = buf.rfind(b')', 0, count)
+        if rparen == -1:
+            return None
+        # utime is field #14, stime is #15, starttime is #22 and rss is #24
+        fields = bytes(buf[rparen + 2:count]).split(b' ', 22)
+        try:
+            if int(fields[19]) != start_time:
+                return None
+            cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            rss = int(fields[21]) * PAGE_SIZE
+        except (IndexError, ValueError):
+            return None
+        open_fds = None
+        if fds:
+            try:
+                open_fds = len(os.listdir(os.path.join(self._root, str(pid), 'fd')))
+            except OSError:
+                return None
+        return cpu, rss, open_fds
+
+    def _full_name(self, pid, name):
+        """
+        The kernel truncates names; mirror psutil and use the command line instead
+        when it looks like the full version of the truncated name.
+        """
+        try:
+            count = self._read(os.path.join(self._root, str(pid), 'cmdline'))
+        except (OSError, IOError):
+            return name
+        argv0 = bytes(self._buf[:count]).split(b'\x00', 1)[0]
+        candidate = os.path.basename(argv0.decode('utf-8', 'replace'))
+        if candidate.startswith(name):
+            return candidate
+        return name
+
+
+def _readinto(fd, buf):
+    """Fill buf from a file descriptor without allocating a new bytes object"""
+    if hasattr(os, 'readv'):
+        return os.readv(fd, [buf])
+    data = os.read(fd, len(buf))
+    buf[:len(data)] = data
+    return len(data)
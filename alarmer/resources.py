@@ -0,0 +1,283 @@
+# -*- coding: UTF-8 -*-
+"""
+Watching how much CPU, memory and file descriptors the processes of a service
+use, so a runaway process is reported before it takes the service down.
+
+Every tracked process is sampled once per check of its service, in one go
+(a single read of /proc/<pid>/stat, or one psutil oneshot), and the samples are
+kept in small fixed size windows backed by arrays of doubles. A process is only
+reported once every sample in its window is over the limit, so a short spike
+doesn't page anyone.
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import time
+from array import array
+
+import psutil
+
+CPU = 'cpu'
+RSS = 'rss'
+FDS = 'fds'
+KINDS = (CPU, RSS, FDS)
+
+_SUFFIXES = {'K' : 1024, 'M' : 1024 ** 2, 'G' : 1024 ** 3}
+
+
+def parse_thresholds(items):
+    """
+    Parse the limits for a service, like from the [thresholds] section of the ini
+
+    -Returns- Dictionary mapping kind (cpu, rss or fds) to the limit; cpu is a
+              percent of one core, rss is in bytes
+
+    -Raises- ValueError when an item is malformed, or the kind is unknown
+
+    @param items
+        Iterable of strings, like ['cpu:90', 'rss:512M', 'fds:1000']. A size
+        for rss can end with K, M or G.
+    """
+    limits = {}
+    for item in items:
+        kind, sep, value = item.strip().partition(':')
+        kind = kind.strip().lower()
+        value = value.strip().upper()
+        if not sep or kind not in KINDS or not value:
+            raise ValueError('Threshold must be one of {0} as kind:limit, not {1!r}'.format(', '.join(KINDS), item))
+        scale = 1
+        if kind == RSS and value[-1] in _SUFFIXES:
+            scale = _SUFFIXES[value[-1]]
+            value = value[:-1]
+        try:
+            limit = float(value) * scale
+        except ValueError:
+            raise ValueError('Threshold for {0} must be a number, not {1!r}'.format(kind, item))
+        if limit <= 0:
+            raise ValueError('Threshold for {0} must be positive, not {1!r}'.format(kind, item))
+        limits[kind] = limit
+    return limits
+
+
+def format_value(kind, value):
+    """
+    Make a sample readable for a notification
+
+    -Returns- String
+
+    @param kind
+        One of cpu, rss or fds
+
+    @param value
+        The sample, in the units from parse_thresholds
+    """
+    if kind == CPU:
+        return '{0:.1f}%'.format(value)
+    elif kind == RSS:
+        return '{0:.1f}MB'.format(value / _SUFFIXES['M'])
+    return '{0:d}'.format(int(value))
+
+
+class Ring(object):
+    """
+    A fixed size window of the latest samples, backed by an array of doubles.
+
+    @param size
+        How many samples to keep
+    """
+    __slots__ = ('_values', '_next', '_count')
+
+    def __init__(self, size):
+        self._values = array(str('d'), [0.0]) * size
+        self._next = 0
+        self._count = 0
+
+    def __repr__(self):
+        return 'Ring(size={0}, count={1})'.format(len(self._values), self._count)
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value):
+        """Add a sample, dropping the oldest once the window is full"""
+        self._values[self._next] = value
+        self._next = (self._next + 1) % len(self._values)
+        self._count = min(self._count + 1, len(self._values))
+
+    @property
+    def full(self):
+        return self._count == len(self._values)
+
+    @property
+    def last(self):
+        """The newest sample, or None when empty"""
+        if not self._count:
+            return None
+        return self._values[self._next - 1]
+
+    def min(self):
+        """The smallest sample in the window, or None when empty"""
+        if not self._count:
+            return None
+        if self.full:
+            return min(self._values)
+        return min(self._values[:self._count])
+
+    def count_at_least(self, value):
+        """How many samples in the window are greater than or equal to value"""
+        values = self._values if self.full else self._values[:self._count]
+        return sum(1 for x in values if x >= value)
+
+    def mean(self):
+        """The average of the window, or None when empty"""
+        if not self._count:
+            return None
+        if self.full:
+            return sum(self._values) / self._count
+        return sum(self._values[:self._count]) / self._count
+
+
+class _Usage(object):
+    """The windows for one process, and its last CPU time for working out the percent"""
+    __slots__ = ('windows', 'cpu_time', 'when')
+
+    def __init__(self, kinds, samples):
+        self.windows = {kind : Ring(samples) for kind in kinds}
+        self.cpu_time = None
+        self.when = None
+
+
+def sample(proc, fds=False):
+    """
+    Read the usage of a process in one go
+
+    -Returns- Tuple, or None when the process is gone (or can't be read)
+        index[0] -> CPU time used, user + system, in seconds
+        index[1] -> resident set size, in bytes
+        index[2] -> number of open file descriptors, or None when not asked for
+
+    @param proc
+        A ProcRecord, or psutil.Process object
+
+    @param fds
+        Set to True to count the open file descriptors.
+        Default is False
+    """
+    if hasattr(proc, 'usage'):
+        return proc.usage(fds)
+    try:
+        with proc.oneshot():
+            times = proc.cpu_times()
+            rss = proc.memory_info().rss
+            open_fds = proc.num_fds() if fds else None
+    except psutil.Error:
+        return None
+    return times.user + times.system, rss, open_fds
+
+
+class ResourceMonitor(object):
+    """
+    Checks the processes of services against their CPU, RSS and FD limits.
+
+    @param thresholds
+        Dictionary mapping service name to the limits for the service, like
+        from parse_thresholds. Services without limits are not sampled.
+
+    @param samples
+        How many checks in a row a process must be over a limit, before it's
+        reported.
+        Default is 3
+    """
+    def __init__(self, thresholds, samples=3):
+        self.thresholds = {}
+        self.samples = samples
+        self.sampled = 0
+        self._usage = {}
+        self.update(thresholds, samples)
+
+    def __repr__(self):
+        return 'ResourceMonitor(services={0}, samples={1})'.format(len(self.thresholds), self.samples)
+
+    def __contains__(self, service):
+        return service in self.thresholds
+
+    def update(self, thresholds, samples=None):
+        """
+        Change the limits, like after the config file was reloaded. The windows
+        of a service are reset when its limits or the window size change.
+
+        @param thresholds
+            Same as the thresholds param when creating a ResourceMonitor
+
+        @param samples
+            Same as the samples param when creating a ResourceMonitor.
+            Default is None, which keeps the current window size
+        """
+        if samples is not None and samples != self.samples:
+            self.samples = samples
+            self._usage.clear()
+        for name in list(self._usage):
+            if thresholds.get(name) != self.thresholds.get(name):
+                del self._usage[name]
+        self.thresholds = dict(thresholds)
+
+    def check(self, service, now=None):
+        """
+        Sample every process the service tracks, and find the ones that have
+        been over a limit for the whole window.
+
+        **Note** Processes that are no longer tracked are forgotten
+
+        -Returns- List of tuples
+            index[0] -> name of process
+            index[1] -> PID
+            index[2] -> kind of limit; cpu, rss or fds
+            index[3] -> String describing the breach, for the notification
+
+        @param service
+            An instance of Service
+
+        @param now
+            The time of the check, in EPOC time.
+            Default is None, which uses the current time
+        """
+        limits = self.thresholds.get(service.name)
+        if not limits:
+            return []
+        if now is None:
+            now = time.time()
+        want_fds = FDS in limits
+        previous = self._usage.get(service.name, {})
+        current = {}
+        breaches = []
+        for name, proc in service.tracked():
+            reading = sample(proc, want_fds)
+            if reading is None:
+                continue # exited; the next status() call will notice
+            self.sampled += 1
+            usage = previous.get(proc)
+            if usage is None:
+                usage = _Usage(limits, self.samples)
+            current[proc] = usage
+            cpu_time, rss, fds = reading
+            if CPU in limits:
+                if usage.when is not None and now > usage.when:
+                    usage.windows[CPU].append((cpu_time - usage.cpu_time) / (now - usage.when) * 100)
+                usage.cpu_time, usage.when = cpu_time, now
+            if RSS in limits:
+                usage.windows[RSS].append(rss)
+            if want_fds:
+                usage.windows[FDS].append(fds)
+            for kind, limit in limits.items():
+                window = usage.windows[kind]
+                if window.full and window.min() > limit:
+                    detail = '{0} at {1} for the last {2} checks; the limit is {3}'.format(kind,
+                                                                                           format_value(kind, window.last),
+                                                                                           len(window),
+                                                                                           format_value(kind, limit))
+                    breaches.append((name, proc.pid, kind, detail))
+        self._usage[service.name] = current
+        return breaches
+
+    def forget(self, service):
+        """Drop the windows of a service, like when it's removed from the config"""
+        self._usage.pop(service, None)
@@ -0,0 +1,5 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmarks for what a tick of the monitoring loop costs; run with
+python -m benchmarks.run --help
+"""
@@ -0,0 +1,190 @@
+# -*- coding: UTF-8 -*-
+"""
+Stand-ins for the process table, the config and the SMTP server, so a tick can
+be timed at any size without touching the real machine. The tests use the SMTP
+server too.
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import random
+import itertools
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from alarmer.config import ConfigParsingError
+
+
+class FakeProc(object):
+    """A process from the fake process table, like psutil.Process"""
+    __slots__ = ('pid', '_name', 'alive')
+
+    def __init__(self, pid, name):
+        self.pid = pid
+        self._name = name
+        self.alive = True
+
+    def __repr__(self):
+        return 'FakeProc(pid={0}, name={1})'.format(self.pid, self._name)
+
+    def name(self):
+        return self._name
+
+    def is_running(self):
+        return self.alive
+
+
+class FakeScanner(object):
+    """
+    A synthetic process table; call it like psutil.process_iter.
+
+    Makes services * per_service monitored process names, each running
+    instances times, and pads the table with unrelated processes up to the
+    requested size.
+
+    @param processes
+        How many processes are in the table
+
+    @param services
+        How many services to make
+
+    @param per_service
+        How many process names make up each service.
+        Default is 3
+
+    @param instances
+        How many processes run under each monitored name.
+        Default is 2
+
+    @param seed
+        Seed for picking which processes die in churn().
+        Default is 0
+    """
+    def __init__(self, processes, services, per_service=3, instances=2, seed=0):
+        self.services = {}
+        for idx in range(services):
+            self.services['service{0}'.format(idx)] = ['svc{0}-proc{1}'.format(idx, x) for x in range(per_service)]
+        self._pids = itertools.count(1)
+        self._random = random.Random(seed)
+        self.procs = {}
+        self.monitored = []
+        for names in self.services.values():
+            for name in names:
+                for _ in range(instances):
+                    self.monitored.append(self._spawn(name))
+        if len(self.procs) > processes:
+            raise ValueError('{0} processes is too few for {1} services'.format(processes, services))
+        while len(self.procs) < processes:
+            self._spawn('other{0}'.format(len(self.procs)))
+
+    def __repr__(self):
+        return 'FakeScanner(processes={0}, services={1})'.format(len(self.procs), len(self.services))
+
+    def __call__(self):
+        return list(self.procs.values())
+
+    def _spawn(self, name):
+        proc = FakeProc(next(self._pids), name)
+        self.procs[proc.pid] = proc
+        return proc
+
+    def churn(self, fraction):
+        """
+        Kill some monitored processes, and start a replacement for each
+
+        -Returns- List of the killed FakeProc objects
+
+        @param fraction
+            How many of the monitored processes to kill, from 0 to 1
+        """
+        count = int(len(self.monitored) * fraction)
+        killed = []
+        for idx in self._random.sample(range(len(self.monitored)), count):
+            proc = self.monitored[idx]
+            proc.alive = False
+            del self.procs[proc.pid]
+            self.monitored[idx] = self._spawn(proc.name())
+            killed.append(proc)
+        return killed
+
+
+class FakeConfig(object):
+    """
+    Stands in for ConfigReader, with the settings the Dispatcher reads
+
+    @param settings
+        A dictionary of settings that override the defaults
+    """
+    DEFAULTS = {'enable_email' : True,
+                'enable_slack' : False,
+                'email_server_host' : '127.0.0.1',
+                'email_server_port' : 25,
+                'email_to' : 'root@localhost',
+                'email_timeout' : 10,
+                'email_workers' : 2,
+                'slack_workers' : 1,
+                'enable_webhook' : False,
+                'plugins' : '',
+                'queue_size' : 100000,
+                'retries' : 0,
+                'retry_backoff' : 0,
+                'rate_limit' : 0,
+                'rate_burst' : 1,
+                'recipient_rate_limit' : 0,
+                'recipient_burst' : 1,
+                'breaker_failures' : 0,
+                'breaker_cooldown' : 60,
+                'digest_window' : 0,
+                'ip_cache_ttl' : 300,
+                'report_interfaces' : '',
+                'interval' : 15,
+               }
+
+    def __init__(self, settings=None):
+        self.settings = dict(self.DEFAULTS)
+        self.settings.update(settings or {})
+
+    def grab(self, item, section=None, cast=True):
+        try:
+            return self.settings[item]
+        except KeyError:
+            raise ConfigParsingError('No option {0} in section: {1}'.format(item, section))
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP to accept mail, and count the sessions & messages"""
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        self.server.sessions += 1
+        self.reply('220 localhost fake smtp')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.strip().split(b' ')[0].upper()
+            if verb == b'DATA':
+                self.reply('354 go ahead')
+                while self.rfile.readline().rstrip(b'\r\n') != b'.':
+                    pass
+                self.server.messages += 1
+                self.reply('250 ok')
+            elif verb == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """A local SMTP server, on a free port"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeSMTPHandler)
+        self.sessions = 0
+        self.messages = 0
@@ -0,0 +1,272 @@
+# -*- coding: UTF-8 -*-
+"""
+Times each part of a tick of the monitoring loop against a synthetic process
+table, and reports the results as JSON so they can be compared between runs.
+
+Example::
+
+  python -m benchmarks.run --processes 50000 --services 1000 --output new.json
+  python -m benchmarks.run --compare old.json
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import sys
+import json
+import platform
+import argparse
+import threading
+from timeit import default_timer as timer
+
+from alarmer.monitoring import Event, EventStore, ProcessTable, ServiceIndex, Service, Dispatcher
+
+from .fakes import FakeScanner, FakeConfig, FakeSMTPServer
+
+
+class Bench(object):
+    """
+    The fake process table, and the objects built from it, shared by every benchmark
+
+    @param args
+        The parsed command line arguments
+    """
+    def __init__(self, args):
+        self.args = args
+        self.scanner = FakeScanner(processes=args.processes,
+                                   services=args.services,
+                                   per_service=args.per_service,
+                                   instances=args.instances)
+        self.index = ServiceIndex(self.scanner.services)
+        self.table = ProcessTable(names=self.index, scanner=self.scanner)
+        self.services = [Service(name, procs, table=self.table) for name, procs in sorted(self.scanner.services.items())]
+        self.owners = {}
+        for service, names in self.scanner.services.items():
+            for name in names:
+                self.owners[name] = service
+        self.events = [Event(owner, name, idx) for idx, (name, owner) in enumerate(sorted(self.owners.items()))][:args.messages]
+
+
+def measure(job, repeat, setup=None):
+    """
+    Time a job
+
+    -Returns- List of the seconds each run took
+
+    @param job
+        A callable that takes no params
+
+    @param repeat
+        How many times to run the job
+
+    @param setup
+        A callable to run before every run, that isn't timed.
+        Default is None
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = timer()
+        job()
+        times.append(timer() - start)
+    return times
+
+
+def summarize(times, ops, unit):
+    """
+    -Returns- Dictionary of stats about a benchmark
+
+    @param times
+        The seconds each run took, from measure()
+
+    @param ops
+        How many things a single run handles, like processes or messages
+
+    @param unit
+        What a single op is
+    """
+    ordered = sorted(times)
+    best = ordered[0]
+    return {'ops' : ops,
+            'unit' : unit,
+            'runs' : len(times),
+            'best' : best,
+            'median' : ordered[len(ordered) // 2],
+            'worst' : ordered[-1],
+            'per_op_us' : best / ops * 1e6 if ops else None,
+            'ops_per_sec' : ops / best if best else None,
+           }
+
+
+def bench_scan(bench):
+    """Read the process table, and route it to every service"""
+    def job():
+        bench.table.refresh()
+        bench.index.route(bench.table)
+    return summarize(measure(job, bench.args.repeat), len(bench.scanner.procs), 'process')
+
+
+def bench_find(bench):
+    """Service._find for every service, against one snapshot"""
+    def job():
+        for service in bench.services:
+            service._find(bench.table)
+    return summarize(measure(job, bench.args.repeat), len(bench.services), 'service')
+
+
+def bench_status(bench):
+    """Service.status for every service, after some processes died and restarted"""
+    found = {}
+    def setup():
+        bench.scanner.churn(bench.args.churn)
+        bench.table.refresh()
+        found.update(bench.index.route(bench.table))
+    def job():
+        for service in bench.services:
+            service.status(current=found.get(service.name, {}))
+    return summarize(measure(job, bench.args.repeat, setup), len(bench.services), 'service')
+
+
+def bench_events(bench):
+    """The Event bookkeeping of a tick; record the dead, expire, and re-alert"""
+    frequency = 30
+    events = EventStore(reset_after=frequency * 5, rate=frequency * 2)
+    state = {'now' : 0, 'killed' : []}
+    def setup():
+        state['now'] += frequency
+        state['killed'] = [(bench.owners[x.name()], x.name(), x.pid) for x in bench.scanner.churn(bench.args.churn)]
+    def job():
+        now = state['now']
+        for service, name, pid in state['killed']:
+            events.record(service, name, pid, now=now)
+        events.expire(now=now)
+        events.due(now=now)
+    result = summarize(measure(job, bench.args.repeat, setup), max(1, len(state['killed'])), 'death')
+    result['open_events'] = len(events)
+    return result
+
+
+def bench_format(bench):
+    """Dispatcher._format_msg for a batch of Events"""
+    dispatcher = Dispatcher(config=FakeConfig())
+    def job():
+        for event in bench.events:
+            dispatcher._format_msg(event)
+    return summarize(measure(job, bench.args.repeat), len(bench.events), 'message')
+
+
+def bench_dispatch(bench):
+    """Format, queue and send a batch of Events as email, to a local SMTP server"""
+    server = FakeSMTPServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    dispatcher = Dispatcher(config=FakeConfig({'email_server_port' : server.server_address[1],
+                                               'email_workers' : bench.args.workers}))
+    dispatcher.setup()
+    def job():
+        for event in bench.events:
+            dispatcher.dispatch(event)
+        for channel in dispatcher.channels.values():
+            channel.join()
+    try:
+        result = summarize(measure(job, bench.args.repeat), len(bench.events), 'message')
+    finally:
+        dispatcher.stop_channels()
+        server.shutdown()
+        server.server_close()
+    result['delivered'] = server.messages
+    return result
+
+
+BENCHMARKS = [('scan', bench_scan),
+              ('find', bench_find),
+              ('status', bench_status),
+              ('events', bench_events),
+              ('format', bench_format),
+              ('dispatch', bench_dispatch),
+             ]
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results to an older run
+
+    -Returns- List of the names of benchmarks that got slower than the threshold
+
+    @param results
+        The results of this run
+
+    @param baseline
+        The results of an older run, as written by --output
+
+    @param threshold
+        How many times slower than the baseline counts as a regression, like 1.25
+    """
+    regressions = []
+    for name in results:
+        if name not in baseline.get('results', {}):
+            continue
+        # per op, so runs of different sizes can still be compared
+        ratio = results[name]['per_op_us'] / baseline['results'][name]['per_op_us']
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('{0:10} {1:8.2f}x baseline per {2}{3}'.format(name, ratio, results[name]['unit'], flag), file=sys.stderr)
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Time a tick of the alarmer monitoring loop')
+    parser.add_argument('--processes', type=int, default=10000, help='Processes in the fake process table')
+    parser.add_argument('--services', type=int, default=100, help='Services to monitor')
+    parser.add_argument('--per-service', type=int, default=3, help='Process names per service')
+    parser.add_argument('--instances', type=int, default=2, help='Processes running under each monitored name')
+    parser.add_argument('--churn', type=float, default=0.01, help='Fraction of monitored processes that die each tick')
+    parser.add_argument('--messages', type=int, default=500, help='Events to format and send')
+    parser.add_argument('--workers', type=int, default=2, help='Email worker threads')
+    parser.add_argument('--repeat', type=int, default=5, help='Times to run each benchmark; the best run is reported')
+    parser.add_argument('--only', default='', help='Comma separated benchmarks to run: ' + ','.join(x[0] for x in BENCHMARKS))
+    parser.add_argument('--output', default='-', help='Where to write the JSON results; - is stdout')
+    parser.add_argument('--compare', default=None, help='JSON results of an older run to compare to')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Slowdown vs --compare that fails the run')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Run the benchmarks
+
+    -Returns- Integer; the exit code, 1 if --compare found a regression
+    """
+    args = parse_args(argv)
+    only = set(x.strip() for x in args.only.split(',') if x.strip())
+    bench = Bench(args)
+    results = {}
+    for name, func in BENCHMARKS:
+        if only and name not in only:
+            continue
+        results[name] = func(bench)
+        print('{0:10} {1:12.3f} us/{2}'.format(name, results[name]['per_op_us'], results[name]['unit']), file=sys.stderr)
+    report = {'python' : platform.python_version(),
+              'implementation' : platform.python_implementation(),
+              'platform' : platform.platform(),
+              'params' : vars(args),
+              'results' : results,
+             }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as the_file:
+            the_file.write(text + '\n')
+    if args.compare:
+        with open(args.compare) as the_file:
+            baseline = json.load(the_file)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
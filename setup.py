@@ -14,7 +14,7 @@ DATAFILES = [('alarmer', ['datafiles/alarmer.ini'])]
 setup(name='alarmer',
       author='Nicholas Willhite',
       version=VERSION,
-      packages=find_packages(),
+      packages=find_packages(exclude=['benchmarks']),
       data_files = DATAFILES,
       description='A process monitoring tool',
       url='https://github.com/willnx/alarmer',
@@ -0,0 +1,14 @@
+# -*- coding: UTF-8 -*-
+"""
+Stand-ins shared by the test modules. The SMTP server lives with the other
+fakes in benchmarks.fakes, since the benchmarks send mail too.
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+
+class FakeProc(object):
+    '''For testing'''
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, str(k), v)
@@ -0,0 +1,276 @@
+# -*- coding: UTF-8 -*-
+"""
+Test logic for sending Events from agents to a collector
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+import time
+import socket
+import unittest
+from mock import MagicMock
+
+from alarmer.monitoring import Event
+from alarmer.aggregate import Agent, Collector, FleetEvent, encode, decode, parse_address
+
+
+def make_record(host='host1', service='web', process='nginx', pid=1, birth=100, last_event=None, event_count=1):
+    """Build a record, like from decode()"""
+    return {'host' : host,
+            'service' : service,
+            'process' : process,
+            'pid' : [pid],
+            'birth' : birth,
+            'last_event' : birth if last_event is None else last_event,
+            'event_count' : event_count,
+            'kind' : 'died',
+            'detail' : None,
+           }
+
+
+class TestWireFormat(unittest.TestCase):
+    """
+    Test suite for encoding Events, and parsing addresses
+    """
+
+    def test_encode_decode(self):
+        """
+        decode undoes encode
+        """
+        event = Event('web', 'nginx', 42, now=100)
+        event.bump(43, now=110)
+
+        record = decode(encode(event, 'host1'))
+
+        self.assertEqual(record, {'host' : 'host1',
+                                  'service' : 'web',
+                                  'process' : 'nginx',
+                                  'pid' : [42, 43],
+                                  'birth' : 100,
+                                  'last_event' : 110,
+                                  'event_count' : 2,
+                                  'kind' : 'died',
+                                  'detail' : None})
+
+    def test_encode_one_line(self):
+        """
+        encode makes exactly one line per Event
+        """
+        line = encode(Event('web', 'nginx', 42), 'host1')
+
+        self.assertEqual(line.count(b'\n'), 1)
+        self.assertTrue(line.endswith(b'\n'))
+
+    def test_decode_malformed(self):
+        """
+        decode raises ValueError for a bad record
+        """
+        self.assertRaises(ValueError, decode, b'not json')
+        self.assertRaises(ValueError, decode, b'{"h":"host1"}')
+
+    def test_decode_wrong_types(self):
+        """
+        decode raises ValueError for a record with a field of the wrong type
+        """
+        good = {'h' : '"host1"', 's' : '"web"', 'p' : '"nginx"', 'pid' : '[42]', 'b' : '100',
+                'l' : '110.5', 'n' : '2', 'k' : '"died"', 'd' : 'null'}
+        bad = {'h' : '["x"]', 's' : '{}', 'p' : '7', 'pid' : '[[1]]', 'b' : '"100"', 'l' : 'true',
+               'n' : '1.5', 'k' : 'null', 'd' : '["x"]'}
+        def line(fields):
+            return ('{' + ','.join('"{0}":{1}'.format(k, v) for k, v in fields.items()) + '}').encode('utf-8')
+
+        self.assertEqual(decode(line(good))['last_event'], 110.5)
+        for key, value in bad.items():
+            fields = dict(good)
+            fields[key] = value
+            self.assertRaises(ValueError, decode, line(fields))
+
+    def test_parse_address(self):
+        """
+        parse_address splits host:port strings
+        """
+        self.assertEqual(parse_address('localhost:7117'), ('localhost', 7117))
+        self.assertEqual(parse_address(':7117'), ('0.0.0.0', 7117))
+        self.assertEqual(parse_address('[::1]:7117'), ('::1', 7117))
+        self.assertRaises(ValueError, parse_address, 'localhost')
+
+
+class TestFleetEvent(unittest.TestCase):
+    """
+    Test suite for the FleetEvent object
+    """
+
+    def test_fleet_event_merge_hosts(self):
+        """
+        FleetEvent totals the event_count across hosts
+        """
+        event = FleetEvent(make_record(host='host1', birth=100))
+
+        self.assertTrue(event.merge(make_record(host='host2', birth=90, event_count=3)))
+
+        self.assertEqual(event.event_count, 4)
+        self.assertEqual(event.birth, 90)
+        self.assertEqual(sorted(event.hosts), ['host1', 'host2'])
+
+    def test_fleet_event_repeat_record(self):
+        """
+        FleetEvent doesn't count the same record twice
+        """
+        event = FleetEvent(make_record(event_count=2))
+
+        self.assertFalse(event.merge(make_record(event_count=2)))
+        self.assertEqual(event.event_count, 2)
+
+    def test_fleet_event_new_host_event(self):
+        """
+        FleetEvent keeps the count from a host's older Event, when the host opens a new one
+        """
+        event = FleetEvent(make_record(birth=100, event_count=2))
+
+        event.merge(make_record(birth=200, event_count=1))
+
+        self.assertEqual(event.event_count, 3)
+
+    def test_fleet_event_same_as_event(self):
+        """
+        FleetEvent is equal to an Event for the same service & process
+        """
+        self.assertEqual(FleetEvent(make_record()), Event('web', 'nginx', None))
+
+
+class TestCollector(unittest.TestCase):
+    """
+    Test suite for the Collector object
+    """
+
+    def setUp(self):
+        self.dispatcher = MagicMock()
+        self.dispatcher.digest_due.return_value = None
+        self.collector = Collector(('127.0.0.1', 0), self.dispatcher, MagicMock(), reset_after=60, rate=60)
+
+    def tearDown(self):
+        self.collector.close()
+
+    def test_collector_dedupes_hosts(self):
+        """
+        Collector sends one Event when many hosts report the same service & process
+        """
+        now = time.time()
+        for host in ('host1', 'host2', 'host3'):
+            self.collector.receive(make_record(host=host, birth=now), now=now)
+
+        self.assertEqual(self.dispatcher.dispatch.call_count, 1)
+        event = self.dispatcher.dispatch.call_args[0][0]
+        self.assertEqual(sorted(event.hosts), ['host1', 'host2', 'host3'])
+
+    def test_collector_stale_record(self):
+        """
+        Collector ignores a periodic alert for an Event that has already gone 'green'
+        """
+        now = time.time()
+
+        event = self.collector.receive(make_record(birth=now - 100), now=now)
+
+        self.assertTrue(event is None)
+        self.assertFalse(self.dispatcher.dispatch.called)
+
+    def test_collector_many_agents(self):
+        """
+        Collector merges the Events streamed by many Agents over TCP
+        """
+        agents = [Agent(self.collector.address, host='host{0}'.format(x)) for x in range(5)]
+        for agent in agents:
+            agent.start()
+            agent.put(Event('web', 'nginx', 42))
+            agent.put(Event('db', 'postgres', 7))
+
+        deadline = time.time() + 5
+        while self.collector.received < 10 and time.time() < deadline:
+            self.collector.serve_once(timeout=0.05)
+        for agent in agents:
+            agent.stop()
+
+        self.assertEqual(self.collector.received, 10)
+        self.assertEqual(self.dispatcher.dispatch.call_count, 2)
+        self.assertEqual(len(self.collector.events.get('web', 'nginx').hosts), 5)
+
+    def test_collector_bad_record(self):
+        """
+        Collector counts malformed records, and keeps going
+        """
+        sock = socket.create_connection(self.collector.address)
+        sock.sendall(b'garbage\n' + encode(Event('web', 'nginx', 42), 'host1'))
+
+        deadline = time.time() + 5
+        while self.collector.received < 1 and time.time() < deadline:
+            self.collector.serve_once(timeout=0.05)
+        sock.close()
+
+        self.assertEqual(self.collector.malformed, 1)
+        self.assertEqual(self.collector.received, 1)
+
+    def test_collector_wrong_types(self):
+        """
+        Collector drops records with fields of the wrong type, or that can't be merged, and keeps going
+        """
+        self.collector.receive = MagicMock(side_effect=[TypeError('doh'), None])
+        good = encode(Event('web', 'nginx', 42), 'host1')
+        sock = socket.create_connection(self.collector.address)
+        sock.sendall(good.replace(b'"host1"', b'["x"]') + good.replace(b'"web"', b'7') + good + good)
+
+        deadline = time.time() + 5
+        while self.collector.receive.call_count < 2 and time.time() < deadline:
+            self.collector.serve_once(timeout=0.05)
+        sock.close()
+
+        self.assertEqual(self.collector.receive.call_count, 2)
+        self.assertEqual(self.collector.malformed, 3)
+        self.assertEqual(len(self.collector), 1)
+
+
+class TestAgent(unittest.TestCase):
+    """
+    Test suite for the Agent object
+    """
+
+    def test_agent_drops_oldest(self):
+        """
+        Agent drops the oldest records when its buffer is full
+        """
+        agent = Agent(('127.0.0.1', 1), host='host1', maxsize=2)
+
+        for pid in range(3):
+            agent.put(Event('web', 'nginx', pid))
+
+        self.assertEqual(agent.depth, 2)
+        self.assertEqual(agent.dropped, 1)
+
+    def test_agent_buffers_while_down(self):
+        """
+        Agent keeps records while the collector is down, and sends them once it's up
+        """
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        address = listener.getsockname()
+        listener.close() # nothing listening yet
+        agent = Agent(address, host='host1', backoff=0.05)
+        agent.start()
+        agent.put(Event('web', 'nginx', 42))
+        time.sleep(0.1)
+        self.assertEqual(agent.depth, 1)
+
+        dispatcher = MagicMock()
+        dispatcher.digest_due.return_value = None
+        collector = Collector(address, dispatcher, MagicMock(), reset_after=60, rate=60)
+        deadline = time.time() + 5
+        while collector.received < 1 and time.time() < deadline:
+            collector.serve_once(timeout=0.05)
+        agent.stop()
+        collector.close()
+
+        self.assertEqual(collector.received, 1)
+        self.assertEqual(agent.sent, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: UTF-8 -*-
+"""
+Test logic for the benchmark suite; just enough to know it still runs
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from benchmarks import run
+from benchmarks.fakes import FakeScanner
+
+
+class TestFakeScanner(unittest.TestCase):
+    """
+    Test suite for the fake process table
+    """
+
+    def test_fake_scanner_size(self):
+        """
+        FakeScanner makes the requested number of processes and services
+        """
+        scanner = FakeScanner(processes=100, services=5, per_service=2, instances=3)
+
+        self.assertEqual(len(scanner()), 100)
+        self.assertEqual(len(scanner.services), 5)
+        self.assertEqual(len(scanner.monitored), 30)
+
+    def test_fake_scanner_churn(self):
+        """
+        FakeScanner.churn replaces dead processes with new ones of the same name
+        """
+        scanner = FakeScanner(processes=100, services=5)
+
+        killed = scanner.churn(0.5)
+
+        self.assertEqual(len(killed), 15)
+        self.assertFalse(any(x.is_running() for x in killed))
+        self.assertEqual(len(scanner()), 100)
+
+    def test_fake_scanner_too_small(self):
+        """
+        FakeScanner raises ValueError when the services don't fit in the table
+        """
+        self.assertRaises(ValueError, FakeScanner, processes=10, services=5)
+
+
+class TestRun(unittest.TestCase):
+    """
+    Test suite for running the benchmarks
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_writes_json(self):
+        """
+        run.main writes the results of every benchmark as JSON
+        """
+        output = os.path.join(self.tmpdir, 'results.json')
+
+        code = run.main(['--processes', '200', '--services', '10', '--messages', '5',
+                         '--repeat', '1', '--output', output])
+
+        with open(output) as the_file:
+            report = json.load(the_file)
+        self.assertEqual(code, 0)
+        self.assertEqual(sorted(report['results']), sorted(x[0] for x in run.BENCHMARKS))
+        self.assertEqual(report['results']['dispatch']['delivered'], 5)
+
+    def test_run_compare_regression(self):
+        """
+        run.main returns 1 when a benchmark is slower than the baseline
+        """
+        baseline = os.path.join(self.tmpdir, 'baseline.json')
+        with open(baseline, 'w') as the_file:
+            json.dump({'results' : {'scan' : {'per_op_us' : 1e-9}}}, the_file)
+
+        code = run.main(['--processes', '200', '--services', '10', '--repeat', '1', '--only', 'scan',
+                         '--output', os.path.join(self.tmpdir, 'out.json'), '--compare', baseline])
+
+        self.assertEqual(code, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
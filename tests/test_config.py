@@ -6,11 +6,11 @@ from __future__ import print_function, division, unicode_literals
 #TODO add absolute_import
 
 
+import os
 import sys
-import logging
 import os.path
+import tempfile
 import unittest
-import ConfigParser
 from mock import patch, MagicMock
 
 import alarmer.config
@@ -75,24 +75,28 @@ class TestConfig(unittest.TestCase):
 
         self.assertTrue(isinstance(config, alarmer.config.ConfigReader))
 
+    def make_reader(self, text, section='test_section', schema=None, defaults=None):
+        """Write an ini file, and load it"""
+        fd, path = tempfile.mkstemp(suffix='.ini')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as the_file:
+            the_file.write(text)
+        return alarmer.config.ConfigReader(path, section, schema=schema, defaults=defaults)
+
     def test_config_reader_parse_error1(self):
         """
-        NoOptionError is reraised as ConfigParsingError
+        Missing option is raised as ConfigParsingError
         """
-        config = alarmer.config.ConfigReader('/some/path', 'test_section')
-        config._config.grab = MagicMock()
-        config._config.grab.side_effect = ConfigParser.NoOptionError('test', 'test')
+        config = self.make_reader('[test_section]\nother = 1\n')
 
         self.assertRaises(alarmer.config.ConfigParsingError,
                           config.grab , 'test_item')
 
     def test_config_reader_parse_error2(self):
         """
-        NoSectionError is reraised as ConfigParsingError
+        Missing section is raised as ConfigParsingError
         """
-        config = alarmer.config.ConfigReader('/some/path', 'test_section')
-        config._config.grab = MagicMock()
-        config._config.grab.side_effect = ConfigParser.NoSectionError('test')
+        config = self.make_reader('[other_section]\ntest_item = 1\n')
 
         self.assertRaises(alarmer.config.ConfigParsingError,
                           config.grab , 'test_item')
@@ -101,21 +105,17 @@ class TestConfig(unittest.TestCase):
         """
         ConfigReader.grab is able to cast to integers
         """
-        config = alarmer.config.ConfigReader('/some/path', 'test_section')
-        config._config.grab = MagicMock()
-        config._config.grab.return_value = '1'
+        config = self.make_reader('[test_section]\ntest = 1\n')
 
         data = config.grab('test', cast=True)
 
-        self.assertTrue(data is 1)
+        self.assertEqual(data, 1)
 
     def test_config_reader_get_cast_to_boolean(self):
         """
         ConfigReader.grab is able to cast to booleans
         """
-        config = alarmer.config.ConfigReader('/some/path', 'test_section')
-        config._config.grab = MagicMock()
-        config._config.grab.return_value = 'true'
+        config = self.make_reader('[test_section]\ntest = true\n')
 
         data = config.grab('test', cast=True)
 
@@ -125,13 +125,11 @@ class TestConfig(unittest.TestCase):
         """
         ConfigReader.grab is able to return strings when casting
         """
-        config = alarmer.config.ConfigReader('/some/path', 'test_section')
-        config._config.grab = MagicMock()
-        config._config.grab.return_value = 'mystring'
+        config = self.make_reader('[test_section]\ntest = mystring\n')
 
         data = config.grab('test', cast=True)
 
-        self.assertTrue(data is 'mystring')
+        self.assertEqual(data, 'mystring')
 
     def test_config_reader_get_cast_with_func(self):
         """
@@ -140,25 +138,21 @@ class TestConfig(unittest.TestCase):
         def some_func():
             print('failure')
 
-        config = alarmer.config.ConfigReader('/some/path', 'test_section')
-        config._config.grab = MagicMock()
-        config._config.grab.return_value = 'some_func'
+        config = self.make_reader('[test_section]\ntest = some_func\n')
 
         data = config.grab('test', cast=True)
 
-        self.assertTrue(data is 'some_func')
+        self.assertEqual(data, 'some_func')
 
     def test_config_reader_get_cast_with_lambda(self):
         """
         ConfigReader.grab doesn't cast lambda functions
         """
-        config = alarmer.config.ConfigReader('/some/path', 'test_section')
-        config._config.grab = MagicMock()
-        config._config.grab.return_value = 'lambda: "failure"'
+        config = self.make_reader('[test_section]\ntest = lambda: "failure"\n')
 
         data = config.grab('test', cast=True)
 
-        self.assertTrue(data is 'lambda: "failure"')
+        self.assertEqual(data, 'lambda: "failure"')
 
     def test_config_reader_get_cast_with_class(self):
         """
@@ -167,37 +161,210 @@ class TestConfig(unittest.TestCase):
         class SomeClass(object):
             pass
 
-        config = alarmer.config.ConfigReader('/some/path', 'test_section')
-        config._config.grab = MagicMock()
-        config._config.grab.return_value = 'SomeClass'
+        config = self.make_reader('[test_section]\ntest = SomeClass\n')
 
         data = config.grab('test', cast=True)
 
-        self.assertTrue(data, 'SomeClass')
+        self.assertEqual(data, 'SomeClass')
 
     def test_config_reader_get_no_cast(self):
         """
         ConfigReader.grab return data when not casting
         """
-        config = alarmer.config.ConfigReader('/some/path', 'test_section')
-        config._config.grab = MagicMock()
-        config._config.grab.return_value = 'some_value'
+        config = self.make_reader('[test_section]\ntest = 1\n')
 
         data = config.grab('test', cast=False)
 
-        self.assertTrue(data, 'some_value')
+        self.assertEqual(data, '1')
 
     def test_config_reader_get_different_section(self):
         """
         ConfigReader.grab called with a different section supplied
         """
-        config = alarmer.config.ConfigReader('/some/path', 'test_section')
-        config._config.grab = MagicMock()
-        config._config.grab.return_value = 'some_value'
+        config = self.make_reader('[test_section]\n[other_section]\ntest = some_value\n')
 
         data = config.grab('test', section='other_section', cast=False)
 
-        self.assertTrue(data, 'some_value')
+        self.assertEqual(data, 'some_value')
+
+    def test_config_reader_inline_comment(self):
+        """
+        ConfigReader strips inline comments
+        """
+        config = self.make_reader('[test_section]\ntest = some_value    # a comment\n')
+
+        data = config.grab('test')
+
+        self.assertEqual(data, 'some_value')
+
+    def test_config_reader_does_not_reparse(self):
+        """
+        ConfigReader.grab never touches the parser
+        """
+        config = self.make_reader('[test_section]\ntest = 1\n')
+        config._config = MagicMock()
+
+        config.grab('test')
+        config.grab_many()
+
+        self.assertFalse(config._config.method_calls)
+
+    def test_config_reader_reload(self):
+        """
+        ConfigReader.reload picks up changes to the file
+        """
+        config = self.make_reader('[test_section]\ntest = 1\n')
+        with open(config.config_file, 'w') as the_file:
+            the_file.write('[test_section]\ntest = 2\n')
+
+        config.reload()
+
+        self.assertEqual(config.grab('test'), 2)
+
+    def test_config_reader_reload_bad_schema(self):
+        """
+        ConfigReader.reload keeps the old values when the new file is invalid
+        """
+        config = self.make_reader('[test_section]\ntest = 1\n', schema={'test_section': {'test': int}})
+        with open(config.config_file, 'w') as the_file:
+            the_file.write('[test_section]\ntest = soon\n')
+
+        self.assertRaises(alarmer.config.ConfigParsingError, config.reload)
+        self.assertEqual(config.grab('test'), 1)
+
+    def test_config_reader_changed(self):
+        """
+        ConfigReader.changed notices when the file is modified
+        """
+        config = self.make_reader('[test_section]\ntest = 1\n')
+
+        self.assertFalse(config.changed())
+        os.utime(config.config_file, (0, 0))
+        self.assertTrue(config.changed())
+
+    def test_config_snapshot_attributes(self):
+        """
+        ConfigReader.snapshot has typed, attribute access to settings
+        """
+        config = self.make_reader('[test_section]\nfrequency = 30\nname = thing\n')
+
+        self.assertEqual(config.snapshot.test_section.frequency, 30)
+        self.assertEqual(config.snapshot['test_section']['name'], 'thing')
+
+    def test_config_snapshot_read_only(self):
+        """
+        ConfigReader.snapshot can't be changed
+        """
+        config = self.make_reader('[test_section]\nfrequency = 30\n')
+
+        with self.assertRaises(AttributeError):
+            config.snapshot.test_section.frequency = 1
+
+    def test_config_schema_valid(self):
+        """
+        ConfigReader accepts settings that match the schema
+        """
+        schema = {'test_section': {'frequency': int, 'enabled': bool}}
+
+        config = self.make_reader('[test_section]\nfrequency = 30\nenabled = true\n', schema=schema)
+
+        self.assertEqual(config.grab('frequency'), 30)
+
+    def test_config_schema_wrong_type(self):
+        """
+        ConfigReader rejects settings with the wrong type
+        """
+        schema = {'test_section': {'frequency': int}}
+
+        self.assertRaises(alarmer.config.ConfigParsingError,
+                          self.make_reader, '[test_section]\nfrequency = soon\n', schema=schema)
+
+    def test_config_schema_bool_not_int(self):
+        """
+        ConfigReader doesn't accept a boolean for a number
+        """
+        schema = {'test_section': {'frequency': int}}
+
+        self.assertRaises(alarmer.config.ConfigParsingError,
+                          self.make_reader, '[test_section]\nfrequency = true\n', schema=schema)
+
+    def test_config_schema_missing(self):
+        """
+        ConfigReader rejects a file missing settings from the schema
+        """
+        schema = {'test_section': {'frequency': int}}
+
+        self.assertRaises(alarmer.config.ConfigParsingError,
+                          self.make_reader, '[test_section]\n', schema=schema)
+
+    def test_config_shipped_ini_matches_schema(self):
+        """
+        The ini file shipped with alarmer passes the schema
+        """
+        path = os.path.join(os.path.dirname(__file__), '..', 'datafiles', 'alarmer.ini')
+
+        alarmer.config.ConfigReader(path, 'monitor', schema=alarmer.config.SCHEMA)
+
+    def test_config_defaults_fill_missing(self):
+        """
+        ConfigReader fills in settings the file leaves out, but keeps the ones it has
+        """
+        schema = {'test_section': {'frequency': int, 'engine': str}}
+        defaults = {'test_section': {'frequency': '30', 'engine': 'loop'}, 'extra': {'item': 'x'}}
+
+        config = self.make_reader('[test_section]\nfrequency = 5\n', schema=schema, defaults=defaults)
+
+        self.assertEqual(config.grab('frequency'), 5)
+        self.assertEqual(config.grab('engine'), 'loop')
+        self.assertEqual(config.grab('item', section='extra', cast=False), 'x')
+
+    def test_config_old_ini_upgrades(self):
+        """
+        An ini file from before the newer settings still loads with DEFAULTS
+        """
+        fd, path = tempfile.mkstemp(suffix='.ini')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as the_file:
+            the_file.write(OLD_INI)
+
+        config = alarmer.config.ConfigReader(path, 'monitor', schema=alarmer.config.SCHEMA,
+                                             defaults=alarmer.config.DEFAULTS)
+
+        self.assertEqual(config.grab('frequency'), 30)
+        self.assertEqual(config.grab('scanner'), 'auto')
+        self.assertEqual(config.grab('email_server_port', section='dispatch'), 24)
+        self.assertEqual(config.grab('breaker_failures', section='dispatch'), 5)
+
+    def test_config_defaults_match_shipped_ini(self):
+        """
+        DEFAULTS has every setting of the ini file shipped with alarmer
+        """
+        path = os.path.join(os.path.dirname(__file__), '..', 'datafiles', 'alarmer.ini')
+        config = alarmer.config.ConfigReader(path, 'monitor')
+
+        for section in ('monitor', 'dispatch', 'aggregate', 'metrics', 'logging'):
+            self.assertEqual(sorted(config.grab_many(section=section)), sorted(alarmer.config.DEFAULTS[section]))
+
+
+# the ini file shipped before [monitor] & [dispatch] grew more settings
+OLD_INI = """[monitor]
+frequency = 30
+rate = 30
+reset_after = 90
+
+[services]
+
+[dispatch]
+enable_email = true
+email_server_host = 0.0.0.0
+email_server_port = 24
+
+[logging]
+level = INFO
+location = /tmp
+rollover_count = 5
+max_size = 10
+"""
 
 
 if __name__ == '__main__':
@@ -0,0 +1,448 @@
+# -*- coding: UTF-8 -*-
+"""
+Test logic for the Dispatcher and Channel objects
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+import time
+import socket
+import smtplib
+import threading
+import unittest
+from mock import patch, MagicMock
+
+import alarmer.monitoring
+from alarmer.monitoring import Channel, Digest, Dispatcher, Event, EventQueue, HostInfo, WORKERS
+from alarmer.flapping import FLAPPING
+from alarmer.notifiers import SMTPPool
+from benchmarks.fakes import FakeSMTPServer
+
+
+class TestEventQueue(unittest.TestCase):
+    """
+    Test suite for the EventQueue object
+    """
+
+    def test_event_queue_round_trip(self):
+        """
+        EventQueue hands Events to the other side
+        """
+        events = EventQueue(maxsize=10)
+        event = Event('svc', 'proc', 1)
+
+        events.put(event)
+
+        self.assertEqual(events.get(timeout=5), event)
+        self.assertEqual(events.sent, 1)
+
+    def test_event_queue_get_timeout(self):
+        """
+        EventQueue.get returns None on timeout
+        """
+        events = EventQueue(maxsize=10)
+
+        self.assertTrue(events.get(timeout=0.01) is None)
+
+    def test_event_queue_bad_policy(self):
+        """
+        EventQueue rejects unknown overflow policies
+        """
+        self.assertRaises(ValueError, EventQueue, overflow='explode')
+
+    def test_event_queue_drop_oldest(self):
+        """
+        EventQueue drops the oldest Event when full
+        """
+        events = EventQueue(maxsize=2, overflow='drop-oldest')
+        for idx in range(3):
+            events.put(Event('svc', 'proc{0}'.format(idx), idx))
+            time.sleep(0.05) # let the feeder thread catch up
+
+        found = [events.get(timeout=5).process for _ in range(2)]
+
+        self.assertEqual(found, ['proc1', 'proc2'])
+        self.assertEqual(events.dropped, 1)
+
+    def test_event_queue_coalesce(self):
+        """
+        EventQueue holds one Event per service & process while full
+        """
+        events = EventQueue(maxsize=1, overflow='coalesce')
+        events.put(Event('svc', 'proc0', 0))
+        for idx in range(5):
+            events.put(Event('svc', 'proc1', idx))
+
+        self.assertEqual(events.pending, 1)
+        self.assertEqual(events.coalesced, 4)
+        events.get(timeout=5)
+        self.assertEqual(events.flush(), 0)
+        self.assertEqual(events.get(timeout=5).pid, [4])
+
+
+class TestChannel(unittest.TestCase):
+    """
+    Test suite for the Channel object
+    """
+
+    def test_channel_sends(self):
+        """
+        Channel sends queued messages on its worker threads
+        """
+        send = MagicMock()
+        channel = Channel('test', send, MagicMock())
+        channel.start()
+
+        channel.put('msg', 'event')
+        channel.join()
+        channel.stop()
+
+        send.assert_called_once_with('msg', 'event')
+
+    @patch.object(alarmer.monitoring.time, 'sleep')
+    def test_channel_retries(self, mocked_sleep):
+        """
+        Channel retries a failed send with exponential backoff
+        """
+        send = MagicMock(side_effect=[IOError('doh'), IOError('doh'), None])
+        channel = Channel('test', send, MagicMock(), retries=3, backoff=2)
+        channel.start()
+
+        channel.put('msg', 'event')
+        channel.join()
+        channel.stop()
+
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual([x[0][0] for x in mocked_sleep.call_args_list], [2, 4])
+
+    @patch.object(alarmer.monitoring.time, 'sleep')
+    def test_channel_gives_up(self, mocked_sleep):
+        """
+        Channel logs an error once it runs out of retries
+        """
+        send = MagicMock(side_effect=IOError('doh'))
+        logger = MagicMock()
+        channel = Channel('test', send, logger, retries=2)
+        channel.start()
+
+        channel.put('msg', 'event')
+        channel.join()
+        channel.stop()
+
+        self.assertEqual(send.call_count, 3)
+        self.assertTrue(logger.error.called)
+
+    def test_channel_full(self):
+        """
+        Channel drops messages once its queue is full
+        """
+        channel = Channel('test', MagicMock(), MagicMock(), maxsize=1)
+
+        self.assertTrue(channel.put('msg', 'event'))
+        self.assertFalse(channel.put('msg', 'event'))
+
+    def test_channel_workers_concurrent(self):
+        """
+        Channel sends with many workers at the same time
+        """
+        barrier = threading.Semaphore(0)
+        running = []
+        def send(msg, event_name):
+            running.append(msg)
+            barrier.acquire()
+        channel = Channel('test', send, MagicMock(), workers=3)
+        channel.start()
+
+        for idx in range(3):
+            channel.put(idx, 'event')
+        for _ in range(100):
+            if len(running) == 3:
+                break
+            time.sleep(0.01)
+        for _ in range(3):
+            barrier.release()
+        channel.join()
+        channel.stop()
+
+        self.assertEqual(sorted(running), [0, 1, 2])
+
+
+class TestDispatcher(unittest.TestCase):
+    """
+    Test suite for the Dispatcher object
+    """
+
+    def test_dispatch_fans_out(self):
+        """
+        Dispatcher.dispatch queues the message on every channel
+        """
+        dispatcher = Dispatcher(config=MagicMock(), logger=MagicMock())
+        dispatcher._format_msg = MagicMock(return_value='msg')
+        dispatcher.channels = {'email': MagicMock(), 'slack': MagicMock()}
+        event = Event('svc', 'proc', 1)
+
+        dispatcher.dispatch(event)
+
+        dispatcher.channels['email'].put.assert_called_once_with('msg', event.name)
+        dispatcher.channels['slack'].put.assert_called_once_with('msg', event.name)
+
+    def test_dispatch_dead_channel_does_not_block(self):
+        """
+        A channel that hangs does not hold up the other channels
+        """
+        hang = threading.Event()
+        slow = Channel('slow', lambda msg, name: hang.wait(), MagicMock())
+        fast_send = MagicMock()
+        fast = Channel('fast', fast_send, MagicMock())
+        dispatcher = Dispatcher(config=MagicMock(), logger=MagicMock())
+        dispatcher._format_msg = MagicMock(return_value='msg')
+        dispatcher.channels = {'slow': slow, 'fast': fast}
+        slow.start()
+        fast.start()
+
+        for idx in range(5):
+            dispatcher.dispatch(Event('svc', 'proc{0}'.format(idx), 1))
+        fast.join()
+        hang.set()
+        slow.join()
+
+        self.assertEqual(fast_send.call_count, 5)
+
+    def test_dispatch_no_channels(self):
+        """
+        Dispatcher.dispatch logs an error when all notifications are disabled
+        """
+        logger = MagicMock()
+        dispatcher = Dispatcher(config=MagicMock(), logger=logger)
+
+        dispatcher.dispatch(Event('svc', 'proc', 1))
+
+        self.assertTrue(logger.error.called)
+
+    def test_stop_channels(self):
+        """
+        Dispatcher.stop_channels stops every Channel and notifier, and leaves Process.close alone
+        """
+        dispatcher = Dispatcher(config=MagicMock(), logger=MagicMock())
+        dispatcher.channels = {'email': MagicMock()}
+        dispatcher.notifiers = {'email': MagicMock()}
+
+        dispatcher.stop_channels()
+
+        self.assertTrue(dispatcher.channels['email'].stop.called)
+        self.assertTrue(dispatcher.notifiers['email'].close.called)
+        self.assertEqual(Dispatcher.close, getattr(alarmer.monitoring.Process, 'close', None))
+
+
+class TestDigest(unittest.TestCase):
+    """
+    Test suite for the Digest object
+    """
+
+    def test_digest_groups_by_service(self):
+        """
+        Digest groups Events by host & service
+        """
+        digest = Digest(window=10, host='host1')
+        for idx in range(50):
+            digest.add(Event('web', 'worker{0}'.format(idx), idx), now=0)
+        digest.add(Event('db', 'postgres', 1), now=0)
+
+        groups = digest.flush()
+
+        self.assertEqual(sorted(groups), [('host1', 'db'), ('host1', 'web')])
+        self.assertEqual(len(groups[('host1', 'web')]), 50)
+        self.assertEqual(len(digest), 0)
+
+    def test_digest_newer_event_replaces(self):
+        """
+        Digest keeps one Event per process
+        """
+        digest = Digest(window=10, host='host1')
+        event = Event('web', 'nginx', 1)
+        digest.add(event, now=0)
+        event.bump(2)
+        digest.add(event, now=1)
+
+        groups = digest.flush()
+
+        self.assertEqual(groups[('host1', 'web')], [event])
+
+    def test_digest_window(self):
+        """
+        Digest is ready once the window has closed
+        """
+        digest = Digest(window=10, host='host1')
+
+        self.assertFalse(digest.ready(now=100))
+        digest.add(Event('web', 'nginx', 1), now=100)
+        self.assertFalse(digest.ready(now=109))
+        self.assertTrue(digest.ready(now=110))
+
+    def test_dispatcher_digest_one_message(self):
+        """
+        Dispatcher sends one message per group in digest mode
+        """
+        dispatcher = Dispatcher(config=MagicMock(), logger=MagicMock())
+        dispatcher.host_info = MagicMock(msg='')
+        dispatcher.channels = {'email': MagicMock()}
+        dispatcher.digest = Digest(window=10, host='host1')
+        for idx in range(50):
+            dispatcher.dispatch(Event('web', 'worker{0}'.format(idx), idx))
+
+        dispatcher.flush_digest(force=True)
+
+        self.assertEqual(dispatcher.channels['email'].put.call_count, 1)
+        msg, name = dispatcher.channels['email'].put.call_args[0]
+        self.assertEqual(name, 'web on host1')
+        self.assertTrue('50 processes' in msg)
+
+    def test_dispatcher_digest_kinds(self):
+        """
+        Dispatcher describes every event in a digest by its kind, same as a single message
+        """
+        dispatcher = Dispatcher(config=MagicMock(), logger=MagicMock())
+        dispatcher.host_info = MagicMock(msg='')
+        events = [Event('web', 'nginx', 1, now=0),
+                  Event('web', 'nginx', 2, now=0, kind=FLAPPING, detail='restarted 5 times in 60s'),
+                  Event('web', 'gunicorn', 3, now=0, kind=WORKERS, detail='1 workers, expected 2 to 4'),
+                  Event('web', 'gunicorn', 3, now=0, kind='rss', detail='600MB over 500MB')]
+
+        lines = dispatcher._format_digest('web on host1', events).splitlines()
+
+        self.assertTrue(lines[0].startswith('Service web on host1 had 4 problems, seen 4 times since'))
+        self.assertEqual(lines[1:], ['\tnginx went offline 1 times, PIDs 1',
+                                     '\tnginx (flapping) keeps restarting; restarted 5 times in 60s. Seen flapping 1 times, PIDs 2',
+                                     '\tgunicorn (workers) has the wrong number of workers; 1 workers, expected 2 to 4. Seen 1 times, PIDs 3',
+                                     '\tgunicorn (rss) is over its rss limit; 600MB over 500MB. Over the limit 1 times, PIDs 3'])
+        self.assertTrue(dispatcher._format_msg(events[1]).startswith('Service web -> nginx (flapping) keeps restarting; restarted 5 times in 60s. Seen flapping 1 times since'))
+
+
+class TestHostInfo(unittest.TestCase):
+    """
+    Test suite for the HostInfo object
+    """
+
+    @patch.object(alarmer.monitoring, 'ifaddresses')
+    @patch.object(alarmer.monitoring, 'interfaces')
+    def test_host_info_cached(self, mocked_interfaces, mocked_ifaddresses):
+        """
+        HostInfo only enumerates interfaces once per TTL
+        """
+        mocked_interfaces.return_value = ['lo']
+        mocked_ifaddresses.return_value = {alarmer.monitoring.AF_INET: [{'addr': '127.0.0.1'}]}
+        host_info = HostInfo(ttl=300)
+
+        for _ in range(10):
+            host_info.msg
+
+        self.assertEqual(mocked_interfaces.call_count, 1)
+        self.assertTrue('127.0.0.1' in host_info.msg)
+
+    @patch.object(alarmer.monitoring, 'ifaddresses')
+    @patch.object(alarmer.monitoring, 'interfaces')
+    def test_host_info_expires(self, mocked_interfaces, mocked_ifaddresses):
+        """
+        HostInfo refreshes once the TTL has passed
+        """
+        mocked_interfaces.return_value = ['lo']
+        mocked_ifaddresses.return_value = {}
+        host_info = HostInfo(ttl=0)
+
+        host_info.msg
+        host_info.msg
+
+        self.assertEqual(mocked_interfaces.call_count, 2)
+
+    @patch.object(alarmer.monitoring, 'ifaddresses')
+    @patch.object(alarmer.monitoring, 'interfaces')
+    def test_host_info_only(self, mocked_interfaces, mocked_ifaddresses):
+        """
+        HostInfo only reports on the requested interfaces
+        """
+        mocked_interfaces.return_value = ['eth0', 'veth1', 'veth2']
+        mocked_ifaddresses.return_value = {}
+        host_info = HostInfo(only=['eth0'])
+
+        self.assertEqual(host_info.addrs, {'eth0': ['no addr']})
+        self.assertEqual(mocked_ifaddresses.call_count, 1)
+
+
+class TestSMTPPool(unittest.TestCase):
+    """
+    Test suite for the SMTPPool object, against a local SMTP stand-in
+    """
+
+    def setUp(self):
+        self.server = FakeSMTPServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.host, self.port = self.server.server_address
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_smtp_pool_reuses_session(self):
+        """
+        SMTPPool sends many messages over one session
+        """
+        pool = SMTPPool(self.host, self.port)
+
+        for _ in range(5):
+            pool.sendmail('NoReply', ['root@localhost'], 'Subject: hi\r\n\r\nbody')
+        pool.close()
+
+        self.assertEqual(self.server.messages, 5)
+        self.assertEqual(self.server.sessions, 1)
+
+    def test_smtp_pool_reconnects_stale(self):
+        """
+        SMTPPool replaces a connection that fails the NOOP check
+        """
+        pool = SMTPPool(self.host, self.port)
+        pool.sendmail('NoReply', ['root@localhost'], 'body')
+        # the server hung up on us while the connection sat idle
+        pool._idle[0].sock.shutdown(socket.SHUT_RDWR)
+
+        pool.sendmail('NoReply', ['root@localhost'], 'body')
+        pool.close()
+
+        self.assertEqual(self.server.messages, 2)
+        self.assertEqual(self.server.sessions, 2)
+
+    def test_smtp_pool_discards_failed_retry(self):
+        """
+        SMTPPool closes the new connection when the retry after a hang up fails too
+        """
+        pool = SMTPPool(self.host, self.port)
+        stale = MagicMock()
+        stale.noop.return_value = (250, b'ok')
+        stale.sendmail.side_effect = smtplib.SMTPServerDisconnected('gone')
+        fresh = MagicMock()
+        fresh.sendmail.side_effect = smtplib.SMTPDataError(554, b'nope')
+        pool._idle.append(stale)
+        pool._connect = MagicMock(return_value=fresh)
+
+        self.assertRaises(smtplib.SMTPDataError, pool.sendmail, 'NoReply', ['root@localhost'], 'body')
+        fresh.quit.assert_called_once_with()
+        self.assertEqual(pool._idle, [])
+
+    def test_smtp_pool_size(self):
+        """
+        SMTPPool closes connections beyond its size
+        """
+        pool = SMTPPool(self.host, self.port, size=1)
+        conn1 = pool.acquire()
+        conn2 = pool.acquire()
+
+        pool.release(conn1)
+        pool.release(conn2)
+
+        self.assertEqual(len(pool._idle), 1)
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# -*- coding: UTF-8 -*-
+"""
+Test logic for the asyncio engine
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+import os
+import time
+import signal
+import asyncio
+import unittest
+from mock import MagicMock
+
+from alarmer.engine import Engine
+from alarmer.exitwatch import PollingExitWatcher
+from alarmer.monitoring import EventStore, Scheduler
+
+
+class TestEngine(unittest.TestCase):
+    """
+    Test suite for the Engine object
+    """
+
+    def make_engine(self, services=None, frequency=0.1, scheduler=None):
+        config = MagicMock()
+        config.grab.side_effect = lambda item, **kwargs: {'frequency': frequency, 'watch_config': False}[item]
+        dispatcher = MagicMock()
+        dispatcher.digest_due.return_value = None
+        return Engine(config=config,
+                      logger=MagicMock(),
+                      services=services or {},
+                      index=MagicMock(route=lambda table: {}),
+                      table=MagicMock(),
+                      watcher=PollingExitWatcher(),
+                      events=EventStore(reset_after=60, rate=60),
+                      dispatcher=dispatcher,
+                      scheduler=scheduler)
+
+    def run_for(self, engine, seconds):
+        """Run the engine for a while, then stop it"""
+        async def runner():
+            try:
+                await asyncio.wait_for(engine.main(), seconds)
+            except asyncio.TimeoutError:
+                pass
+        asyncio.run(runner())
+
+    def test_engine_dispatches_dead(self):
+        """
+        Engine sends new Events to the Dispatcher, in the same process
+        """
+        service = MagicMock()
+        service.name = 'web'
+        service.status.return_value = ({}, {'nginx': [42]})
+        engine = self.make_engine(services={'web': service})
+
+        self.run_for(engine, 0.05)
+
+        event = engine.dispatcher.dispatch.call_args[0][0]
+        self.assertEqual(event.name, 'web -> nginx')
+        self.assertEqual(engine.dispatcher.dispatch.call_count, 1)
+
+    def test_engine_periodic_no_drift(self):
+        """
+        Engine.periodic schedules from when a run was due, not when it finished
+        """
+        engine = self.make_engine()
+        runs = []
+        async def job():
+            runs.append(time.time())
+            await asyncio.sleep(0.05)
+
+        async def runner():
+            try:
+                await asyncio.wait_for(engine.periodic(job, lambda: 0.1), 0.55)
+            except asyncio.TimeoutError:
+                pass
+        asyncio.run(runner())
+
+        self.assertEqual(len(runs), 6)
+
+    def test_engine_reload_between_scans(self):
+        """
+        Engine reloads after a SIGHUP once the scan in progress is done, not during it
+        """
+        calls = []
+        def refresh():
+            calls.append('refresh start')
+            time.sleep(0.05)
+            calls.append('refresh end')
+        def reload():
+            calls.append('reload')
+            return None
+        service = MagicMock()
+        service.name = 'web'
+        service.status.return_value = ({}, {})
+        engine = self.make_engine(services={'web': service}, frequency=10)
+        engine.table.refresh.side_effect = refresh
+        engine._reload = reload
+
+        async def runner():
+            task = asyncio.ensure_future(engine.main())
+            await asyncio.sleep(0.01)
+            os.kill(os.getpid(), signal.SIGHUP)
+            await asyncio.sleep(0.1)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        asyncio.run(runner())
+
+        self.assertEqual(calls, ['refresh start', 'refresh end', 'reload'])
+
+    def test_engine_service_intervals(self):
+        """
+        Engine checks each service at the interval the Scheduler gives it
+        """
+        services = {}
+        for name in ('fast', 'slow'):
+            services[name] = MagicMock()
+            services[name].name = name
+            services[name].status.return_value = ({}, {})
+        scheduler = Scheduler(1, intervals={'fast': 0.05})
+        for name in services:
+            scheduler.add(name)
+        engine = self.make_engine(services=services, frequency=1, scheduler=scheduler)
+
+        self.run_for(engine, 0.28)
+
+        self.assertTrue(services['fast'].status.call_count >= 5)
+        self.assertEqual(services['slow'].status.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
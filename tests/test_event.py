@@ -5,8 +5,9 @@ Logic for testing our Event object
 from __future__ import print_function, division, unicode_literals
 #TODO add absolute_import
 
+import pickle
 import unittest
-from alarmer.monitoring import Event
+from alarmer.monitoring import Event, EventStore
 
 
 class TestEvent(unittest.TestCase):
@@ -18,9 +19,9 @@ class TestEvent(unittest.TestCase):
         """
         Format of Event.__repr__
         """
-        event = Event('test_event')
+        event = Event('test_service', 'test_process', 1)
 
-        expected = 'Event(name=test_event, birth={0}, last_event={0}, event_count=1)'.format(event.birth)
+        expected = 'Event(name=test_service -> test_process, birth={0}, last_event={0}, event_count=1)'.format(event.birth)
 
         self.assertEqual(expected, str(event))
 
@@ -28,7 +29,7 @@ class TestEvent(unittest.TestCase):
         """
         Event has birth addr
         """
-        event = Event('test_event')
+        event = Event('test_service', 'test_process', 1)
 
         self.assertTrue(hasattr(event, 'birth'))
 
@@ -36,7 +37,7 @@ class TestEvent(unittest.TestCase):
         """
         Event count can increment
         """
-        event = Event('test_event')
+        event = Event('test_service', 'test_process', 1)
 
         #Obj is born with 1 count of an event
         event.event_count += 1
@@ -48,10 +49,143 @@ class TestEvent(unittest.TestCase):
         """
         Event has birth addr
         """
-        event = Event('test_event')
+        event = Event('test_service', 'test_process', 1)
 
         self.assertTrue(hasattr(event, 'last_event'))
 
 
+    def test_event_pid_history_bounded(self):
+        """
+        Event only keeps the most recent PIDs
+        """
+        event = Event('test_service', 'test_process', 0)
+
+        for pid in range(1, 100):
+            event.bump(pid)
+
+        self.assertEqual(len(event.pid), Event.PID_HISTORY)
+        self.assertEqual(event.pid[-1], 99)
+        self.assertEqual(event.event_count, 100)
+
+    def test_event_slots(self):
+        """
+        Event has no __dict__
+        """
+        event = Event('test_service', 'test_process', 1)
+
+        self.assertFalse(hasattr(event, '__dict__'))
+
+    def test_event_equality(self):
+        """
+        Events for the same service & process are equal
+        """
+        event1 = Event('test_service', 'test_process', 1)
+        event2 = Event('test_service', 'test_process', 2)
+        event3 = Event('test_service', 'other_process', 1)
+
+        self.assertEqual(event1, event2)
+        self.assertNotEqual(event1, event3)
+
+    def test_event_pickle(self):
+        """
+        Event survives being sent over a pipe
+        """
+        event = Event('test_service', 'test_process', 1)
+        event.bump(2)
+
+        copy = pickle.loads(pickle.dumps(event, 2))
+
+        self.assertEqual(copy, event)
+        self.assertEqual(copy.pid, [1, 2])
+        self.assertEqual(copy.event_count, 2)
+
+
+class TestEventStore(unittest.TestCase):
+    """
+    Test suite for our EventStore object
+    """
+
+    def test_event_store_record_new(self):
+        """
+        EventStore.record opens a new Event
+        """
+        store = EventStore(reset_after=60, rate=30)
+
+        event, is_new = store.record('svc', 'proc', 1, now=0)
+
+        self.assertTrue(is_new)
+        self.assertTrue(event in store)
+
+    def test_event_store_record_bump(self):
+        """
+        EventStore.record bumps an existing Event
+        """
+        store = EventStore(reset_after=60, rate=30)
+        store.record('svc', 'proc', 1, now=0)
+
+        event, is_new = store.record('svc', 'proc', 2, now=5)
+
+        self.assertFalse(is_new)
+        self.assertEqual(event.event_count, 2)
+        self.assertEqual(len(store), 1)
+
+    def test_event_store_expire(self):
+        """
+        EventStore.expire removes quiet Events
+        """
+        store = EventStore(reset_after=60, rate=30)
+        event, _ = store.record('svc', 'proc', 1, now=0)
+
+        self.assertEqual(store.expire(now=59), [])
+        self.assertEqual(store.expire(now=60), [event])
+        self.assertEqual(len(store), 0)
+
+    def test_event_store_expire_bumped(self):
+        """
+        EventStore.expire keeps Events that were bumped recently
+        """
+        store = EventStore(reset_after=60, rate=30)
+        event, _ = store.record('svc', 'proc', 1, now=0)
+        store.record('svc', 'proc', 2, now=50)
+
+        self.assertEqual(store.expire(now=60), [])
+        self.assertEqual(store.expire(now=110), [event])
+
+    def test_event_store_due(self):
+        """
+        EventStore.due returns Events at the alert rate
+        """
+        store = EventStore(reset_after=600, rate=30)
+        event, _ = store.record('svc', 'proc', 1, now=0)
+
+        self.assertEqual(store.due(now=29), [])
+        self.assertEqual(store.due(now=30), [event])
+        self.assertEqual(store.due(now=31), [])
+        self.assertEqual(store.due(now=60), [event])
+
+    def test_event_store_due_after_expire(self):
+        """
+        EventStore.due skips Events that expired
+        """
+        store = EventStore(reset_after=10, rate=30)
+        store.record('svc', 'proc', 1, now=0)
+        store.expire(now=10)
+
+        self.assertEqual(store.due(now=30), [])
+
+
+    def test_event_store_next_due(self):
+        """
+        EventStore.next_due is when the next alert is due
+        """
+        store = EventStore(reset_after=10, rate=30)
+
+        self.assertTrue(store.next_due() is None)
+        store.record('svc', 'proc', 1, now=0)
+        self.assertEqual(store.next_due(), 30)
+        store.expire(now=10)
+        self.assertTrue(store.next_due() is None)
+
+
 if __name__ == '__main__':
     unittest.main()
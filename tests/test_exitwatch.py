@@ -0,0 +1,232 @@
+# -*- coding: UTF-8 -*-
+"""
+Test logic for the event driven exit watchers
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+import time
+import errno
+import signal
+import unittest
+import subprocess
+
+import psutil
+from mock import patch, MagicMock
+
+import alarmer.exitwatch
+import alarmer.monitoring
+from alarmer.procfs import ProcScanner
+from alarmer.exitwatch import ExitWatcher, PollingExitWatcher
+from fakes import FakeProc
+
+
+@unittest.skipUnless(ExitWatcher.available(), 'pidfd_open not supported')
+class TestExitWatcher(unittest.TestCase):
+    """
+    Test suite for the ExitWatcher object
+    """
+
+    def setUp(self):
+        self.watcher = ExitWatcher()
+        self.child = subprocess.Popen(['sleep', '60'])
+
+    def tearDown(self):
+        if self.child.poll() is None:
+            self.child.kill()
+        self.child.wait()
+        self.watcher.close()
+
+    def test_exit_watcher_reports_exit(self):
+        """
+        ExitWatcher.wait returns the key and PID of an exited process
+        """
+        self.watcher.watch(psutil.Process(self.child.pid), key=('svc', 'sleep'))
+
+        self.child.kill()
+        start = time.time()
+        exited = self.watcher.wait(5)
+
+        self.assertEqual(exited, [(('svc', 'sleep'), self.child.pid)])
+        self.assertTrue(time.time() - start < 1)
+        self.assertFalse(self.watcher.watching(self.child.pid))
+
+    def test_exit_watcher_timeout(self):
+        """
+        ExitWatcher.wait returns nothing when no process exits
+        """
+        self.watcher.watch(psutil.Process(self.child.pid))
+
+        self.assertEqual(self.watcher.wait(0.01), [])
+        self.assertTrue(self.watcher.watching(self.child.pid))
+
+    def test_exit_watcher_pid_reused(self):
+        """
+        ExitWatcher reports a process that is no longer running when watched
+        """
+        proc = FakeProc(pid=self.child.pid, is_running=lambda: False)
+
+        self.watcher.watch(proc, key='key')
+
+        self.assertEqual(self.watcher.wait(0), [('key', self.child.pid)])
+        self.assertEqual(len(self.watcher), 0)
+
+    def _records(self):
+        """The child as a psutil.Process, and as a procfs.ProcRecord"""
+        scanner = ProcScanner()
+        record = [x for x in scanner() if x.pid == self.child.pid][0]
+        return psutil.Process(self.child.pid), record
+
+    def test_exit_watcher_out_of_fds(self):
+        """
+        ExitWatcher leaves a live process unwatched when there are no file descriptors for a pidfd
+        """
+        for errnum in (errno.EMFILE, errno.ENFILE):
+            for proc in self._records():
+                with patch.object(alarmer.exitwatch.os, 'pidfd_open', side_effect=OSError(errnum, 'doh')):
+                    self.watcher.watch(proc, key='key')
+
+                self.assertEqual(self.watcher.wait(0), [])
+                self.assertFalse(self.watcher.watching(self.child.pid))
+
+    def test_exit_watcher_is_running_fails(self):
+        """
+        ExitWatcher leaves a live process unwatched when it can't tell if it's running
+        """
+        _, record = self._records()
+        is_running = MagicMock(side_effect=OSError(errno.EMFILE, 'doh'))
+        proc = FakeProc(pid=self.child.pid, is_running=is_running)
+
+        with patch.object(record._scanner, '_read', side_effect=OSError(errno.EMFILE, 'doh')):
+            self.watcher.watch(record, key='key')
+        self.watcher.watch(proc, key='key')
+
+        self.assertEqual(self.watcher.wait(0), [])
+        self.assertFalse(self.watcher.watching(self.child.pid))
+        self.assertTrue(is_running.called)
+
+    def test_exit_watcher_many_keys(self):
+        """
+        ExitWatcher reports the exit to every key watching a process
+        """
+        proc = psutil.Process(self.child.pid)
+        self.watcher.watch(proc, key=('web', 'python'))
+        self.watcher.watch(proc, key=('worker', 'python'))
+
+        self.child.kill()
+        exited = self.watcher.wait(5)
+
+        self.assertEqual(sorted(exited), [(('web', 'python'), self.child.pid),
+                                          (('worker', 'python'), self.child.pid)])
+
+    def test_exit_watcher_unwatch_key(self):
+        """
+        ExitWatcher keeps watching a process while it has other keys
+        """
+        proc = psutil.Process(self.child.pid)
+        self.watcher.watch(proc, key='first')
+        self.watcher.watch(proc, key='second')
+
+        self.watcher.unwatch(self.child.pid, key='first')
+
+        self.assertTrue(self.watcher.watching(self.child.pid))
+        self.watcher.unwatch(self.child.pid, key='second')
+        self.assertFalse(self.watcher.watching(self.child.pid))
+
+
+class TestServiceWatcher(unittest.TestCase):
+    """
+    Test suite for a Service using an exit watcher
+    """
+
+    def test_service_watched_procs_not_polled(self):
+        """
+        Service.status does not poll is_running for watched processes
+        """
+        is_running = MagicMock(return_value=True)
+        proc = FakeProc(pid=1, is_running=is_running)
+        watcher = MagicMock()
+        watcher.watching.return_value = True
+        service = alarmer.monitoring.Service('svc', ['proc'], watcher=watcher,
+                                             table=MagicMock(lookup=lambda name: set([proc])))
+
+        service.status(current={'proc': set([proc])})
+
+        watcher.watch.assert_called_once_with(proc, key=('svc', 'proc'))
+        self.assertFalse(is_running.called)
+
+    def test_service_reap(self):
+        """
+        Service.reap stops tracking a PID
+        """
+        proc = FakeProc(pid=1, is_running=lambda: True)
+        service = alarmer.monitoring.Service('svc', ['proc'],
+                                             table=MagicMock(lookup=lambda name: set([proc])))
+
+        self.assertTrue(service.reap('proc', 1))
+        self.assertFalse(service.reap('proc', 1))
+        self.assertEqual(service.proc, [])
+
+    def test_polling_watcher_never_reports(self):
+        """
+        PollingExitWatcher never reports an exit
+        """
+        self.assertEqual(PollingExitWatcher().wait(0), [])
+
+
+@unittest.skipUnless(hasattr(signal, 'setitimer'), 'needs signal.setitimer')
+class TestWake(unittest.TestCase):
+    """
+    Test suite for waking an exit watcher from a signal handler
+    """
+
+    def setUp(self):
+        self.old = signal.getsignal(signal.SIGALRM)
+
+    def tearDown(self):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self.old)
+
+    def _wait_after_signal(self, watcher):
+        """Seconds a wait(5) takes when a signal handler wakes the watcher 0.1s in"""
+        signal.signal(signal.SIGALRM, lambda signum, frame: watcher.wake())
+        signal.setitimer(signal.ITIMER_REAL, 0.1)
+        start = time.time()
+        exited = watcher.wait(5)
+        took = time.time() - start
+        watcher.close()
+        self.assertEqual(exited, [])
+        return took
+
+    @unittest.skipUnless(ExitWatcher.available(), 'pidfd_open not supported')
+    def test_exit_watcher_wake(self):
+        """
+        ExitWatcher.wait returns as soon as a signal handler calls wake
+        """
+        self.assertTrue(self._wait_after_signal(ExitWatcher()) < 1)
+
+    def test_polling_watcher_wake(self):
+        """
+        PollingExitWatcher.wait returns as soon as a signal handler calls wake
+        """
+        self.assertTrue(self._wait_after_signal(PollingExitWatcher()) < 1)
+
+    def test_wake_before_wait(self):
+        """
+        A wake before the wait still ends it, and only once
+        """
+        watcher = PollingExitWatcher()
+        for _ in range(3):
+            watcher.wake()
+
+        start = time.time()
+        watcher.wait(5)
+        self.assertTrue(time.time() - start < 1)
+        start = time.time()
+        watcher.wait(0.05)
+        self.assertTrue(time.time() - start >= 0.04)
+        watcher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
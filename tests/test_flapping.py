@@ -0,0 +1,129 @@
+# -*- coding: UTF-8 -*-
+"""
+Test logic for spotting processes that keep restarting
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+import unittest
+
+from mock import MagicMock
+
+import alarmer.main
+from alarmer.monitoring import Event, EventStore, Dispatcher
+from alarmer.flapping import FlapDetector, FLAPPING
+
+
+class TestFlapDetector(unittest.TestCase):
+    """
+    Test suite for the FlapDetector object
+    """
+
+    def restart(self, flaps, now):
+        flaps.died('web', 'nginx', now=now)
+        return flaps.born('web', 'nginx', now=now + 1)
+
+    def test_flapping(self):
+        """
+        FlapDetector reports once a process restarts enough times in the window
+        """
+        flaps = FlapDetector(window=60, restarts=3)
+
+        self.assertEqual(self.restart(flaps, 0), None)
+        self.assertEqual(self.restart(flaps, 10), None)
+        detail = self.restart(flaps, 20)
+
+        self.assertTrue(detail.startswith('restarted 3 times in the last 1.0 minutes'))
+        self.assertEqual(flaps.rate('web', 'nginx', now=21), 3)
+
+    def test_slow_restarts(self):
+        """
+        FlapDetector ignores restarts that are spread out over more than the window
+        """
+        flaps = FlapDetector(window=60, restarts=3)
+
+        for now in (0, 100, 200, 300):
+            detail = self.restart(flaps, now)
+
+        self.assertEqual(detail, None)
+        self.assertEqual(flaps.rate('web', 'nginx', now=301), 1)
+
+    def test_death_without_birth(self):
+        """
+        FlapDetector doesn't call a process that stays dead flapping
+        """
+        flaps = FlapDetector(window=60, restarts=2)
+        flaps.born('web', 'nginx', now=0)
+
+        for now in (1, 2, 3):
+            detail = flaps.died('web', 'nginx', now=now)
+
+        self.assertEqual(detail, None)
+
+    def test_bounded_history(self):
+        """
+        FlapDetector keeps a fixed number of births & deaths, however long the storm
+        """
+        flaps = FlapDetector(window=1000, restarts=3, size=4)
+
+        for now in range(0, 1000, 2):
+            detail = self.restart(flaps, now)
+
+        self.assertTrue(detail is not None)
+        self.assertEqual(flaps.rate('web', 'nginx', now=1000), 4)
+
+    def test_expire(self):
+        """
+        FlapDetector.expire forgets processes that have been quiet for the window
+        """
+        flaps = FlapDetector(window=60, restarts=3)
+        self.restart(flaps, 0)
+
+        self.assertEqual(flaps.expire(now=30), 0)
+        self.assertEqual(flaps.expire(now=100), 1)
+        self.assertEqual(len(flaps), 0)
+
+    def test_disabled(self):
+        """
+        FlapDetector keeps no history when restarts is zero
+        """
+        flaps = FlapDetector(window=60, restarts=0)
+
+        self.assertEqual(self.restart(flaps, 0), None)
+        self.assertEqual(len(flaps), 0)
+
+
+class TestOnDead(unittest.TestCase):
+    """
+    Test suite for alerting on flapping from the monitoring loop
+    """
+
+    def test_on_dead_flapping(self):
+        """
+        _on_dead sends a flapping Event, apart from the death
+        """
+        events = EventStore(reset_after=60, rate=60)
+        outbox = MagicMock()
+        flaps = FlapDetector(window=60, restarts=1)
+        flaps.born('web', 'nginx')
+
+        alarmer.main._on_dead(events, outbox, 'web', 'nginx', 5, flaps=flaps)
+
+        kinds = [x[0][0].kind for x in outbox.put.call_args_list]
+        self.assertEqual(kinds, ['died', FLAPPING])
+
+    def test_format_flapping(self):
+        """
+        Dispatcher says a flapping process keeps restarting
+        """
+        event = Event('web', 'nginx', 1, now=100, kind=FLAPPING, detail='restarted 5 times in the last 5.0 minutes')
+        dispatcher = Dispatcher(MagicMock(), MagicMock())
+        dispatcher.host_info = MagicMock(msg='')
+
+        msg = dispatcher._format_msg(event)
+
+        self.assertTrue(msg.startswith('Service web -> nginx (flapping) keeps restarting; restarted 5 times'))
+
+
+if __name__ == '__main__':
+    unittest.main()
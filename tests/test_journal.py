@@ -0,0 +1,244 @@
+# -*- coding: UTF-8 -*-
+"""
+Test logic for keeping Events on disk
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+import os
+import time
+import errno
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, MagicMock
+
+import alarmer.journal
+from alarmer.monitoring import Event, EventStore
+from alarmer.journal import EventJournal
+
+
+class TestEventJournal(unittest.TestCase):
+    """
+    Test suite for the EventJournal object
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'events.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_journal_load_nothing(self):
+        """
+        EventJournal.load returns nothing when there are no files yet
+        """
+        self.assertEqual(EventJournal(self.path).load(), [])
+
+    def test_journal_round_trip(self):
+        """
+        EventJournal.load returns the last state written for every Event
+        """
+        journal = EventJournal(self.path)
+        journal.start()
+        event = Event('web', 'nginx', 42, now=100)
+        journal.write(event, 200)
+        event.bump(43, now=110)
+        journal.write(event, 200)
+        journal.stop()
+
+        states = EventJournal(self.path).load()
+
+        self.assertEqual(states, [(('web', 'nginx', [42, 43], 100, 110, 2, 'died', None), 200)])
+
+    def test_journal_remove(self):
+        """
+        EventJournal.load skips Events that were removed
+        """
+        journal = EventJournal(self.path)
+        journal.start()
+        journal.write(Event('web', 'nginx', 42, now=100), 200)
+        journal.write(Event('db', 'postgres', 7, now=100), 200)
+        journal.remove(Event('web', 'nginx', None))
+        journal.stop()
+
+        states = EventJournal(self.path).load()
+
+        self.assertEqual([x[0][0] for x in states], ['db'])
+
+    def test_journal_compact(self):
+        """
+        EventJournal writes a snapshot, and starts a new log, after compact_every changes
+        """
+        journal = EventJournal(self.path, compact_every=3, fsync=False)
+        journal.start()
+        for pid in range(4):
+            journal.write(Event('web', 'nginx', pid, now=100), 200)
+        journal.stop()
+
+        self.assertEqual(journal.compactions, 1)
+        self.assertTrue(os.path.exists(journal.snapshot_path))
+        with open(self.path, 'rb') as the_file:
+            self.assertTrue(len(the_file.readlines()) < 4)
+        states = EventJournal(self.path).load()
+        self.assertEqual(states[0][0][2], [3])
+
+    def test_journal_torn_write(self):
+        """
+        EventJournal.load skips a line cut short by a crash
+        """
+        journal = EventJournal(self.path)
+        journal.start()
+        journal.write(Event('web', 'nginx', 42, now=100), 200)
+        journal.stop()
+        with open(self.path, 'ab') as the_file:
+            the_file.write(b'{"e":["db","postg')
+
+        states = EventJournal(self.path).load()
+
+        self.assertEqual(len(states), 1)
+
+    def test_journal_write_fails(self):
+        """
+        EventJournal logs a failed write, and retries it once the disk works again
+        """
+        logger = MagicMock()
+        # stop() ends the backoff, so the retry only happens once the disk is back
+        journal = EventJournal(self.path, fsync=False, logger=logger, backoff=60)
+        journal.start()
+        log = journal._log
+        def write(data):
+            # half a line makes it to disk, then the disk fills up
+            log.write(data[:10])
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        journal._log = MagicMock(write=MagicMock(side_effect=write))
+        journal.write(Event('web', 'nginx', 42, now=100), 200)
+        deadline = time.time() + 5
+        while not journal.failures and time.time() < deadline:
+            time.sleep(0.01)
+        journal._log = log
+        journal.write(Event('db', 'postgres', 7, now=100), 200)
+        journal.stop()
+
+        self.assertEqual(journal.failures, 1)
+        self.assertTrue(logger.error.called)
+        self.assertEqual(sorted(x[0][0] for x in EventJournal(self.path).load()), ['db', 'web'])
+
+    def test_journal_compact_fails(self):
+        """
+        EventJournal keeps writing after a snapshot fails
+        """
+        journal = EventJournal(self.path, compact_every=1, fsync=False, logger=MagicMock(), backoff=0.01)
+        journal.start()
+        with patch.object(alarmer.journal, '_replace', side_effect=OSError(errno.EIO, 'doh')):
+            journal.write(Event('web', 'nginx', 42, now=100), 200)
+            deadline = time.time() + 5
+            while not journal.failures and time.time() < deadline:
+                time.sleep(0.01)
+        journal.write(Event('db', 'postgres', 7, now=100), 200)
+        journal.stop()
+
+        self.assertTrue(journal.failures >= 1)
+        self.assertTrue(journal.compactions >= 1)
+        self.assertEqual(sorted(x[0][0] for x in EventJournal(self.path).load()), ['db', 'web'])
+
+    def test_journal_buffer_capped(self):
+        """
+        EventJournal drops the oldest changes, and counts them, once its buffer is full
+        """
+        journal = EventJournal(self.path, maxsize=2)
+
+        for pid in range(3):
+            journal.write(Event('web', 'nginx', pid, now=100), 200)
+
+        self.assertEqual(journal.pending, 2)
+        self.assertEqual(journal.dropped, 1)
+
+
+class TestEventStoreJournal(unittest.TestCase):
+    """
+    Test suite for an EventStore that keeps its Events in an EventJournal
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'events.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def restart(self, journal, now):
+        """Stop a journal, and load a new EventStore from its files"""
+        journal.stop()
+        journal = EventJournal(self.path)
+        events = EventStore(reset_after=60, rate=30, journal=journal)
+        events.restore(journal.load(), now=now)
+        return events
+
+    def test_event_store_warm_restart(self):
+        """
+        EventStore picks up event counts and alert timers after a restart
+        """
+        journal = EventJournal(self.path)
+        journal.start()
+        events = EventStore(reset_after=60, rate=30, journal=journal)
+        events.record('web', 'nginx', 42, now=100)
+        events.record('web', 'nginx', 43, now=110)
+
+        events = self.restart(journal, now=120)
+
+        event = events.get('web', 'nginx')
+        self.assertEqual(event.event_count, 2)
+        self.assertEqual(event.pid, [42, 43])
+        self.assertEqual(events.next_due(), 130)
+        self.assertEqual(events.due(now=125), [])
+
+    def test_event_store_restore_skips_green(self):
+        """
+        EventStore.restore skips Events that went 'green' while alarmer was down
+        """
+        journal = EventJournal(self.path)
+        journal.start()
+        events = EventStore(reset_after=60, rate=30, journal=journal)
+        events.record('web', 'nginx', 42, now=100)
+
+        events = self.restart(journal, now=200)
+
+        self.assertEqual(len(events), 0)
+
+    def test_event_store_restore_forgets_green(self):
+        """
+        EventStore.restore removes the Events it skips from the journal, so they aren't loaded again
+        """
+        journal = EventJournal(self.path)
+        journal.start()
+        events = EventStore(reset_after=60, rate=30, journal=journal)
+        events.record('web', 'nginx', 42, now=100)
+        events = self.restart(journal, now=200)
+        events.journal.start()
+        events.journal.stop()
+        events.journal.compact()
+
+        self.assertEqual(events.journal._state, {})
+        self.assertEqual(EventJournal(self.path).load(), [])
+
+    def test_event_store_journal_expire(self):
+        """
+        EventStore removes expired Events from the journal
+        """
+        journal = EventJournal(self.path)
+        journal.start()
+        events = EventStore(reset_after=60, rate=30, journal=journal)
+        events.record('web', 'nginx', 42, now=100)
+        events.record('db', 'postgres', 7, now=150)
+        events.expire(now=170)
+
+        events = self.restart(journal, now=180)
+
+        self.assertEqual([x.service for x in events], ['db'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,272 @@
+# -*- coding: UTF-8 -*-
+"""
+Test logic for rate limiting and circuit breaking the notification channels
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+import unittest
+
+from mock import patch, MagicMock
+
+import alarmer.monitoring
+from alarmer.monitoring import Channel
+from alarmer.limits import TokenBucket, Buckets, CircuitBreaker, Held, CLOSED, OPEN, HALF_OPEN
+
+
+class TestTokenBucket(unittest.TestCase):
+    """
+    Test suite for the TokenBucket and Buckets objects
+    """
+
+    def test_burst(self):
+        """
+        TokenBucket allows a burst, then holds back until it refills
+        """
+        bucket = TokenBucket(rate=60, burst=3, now=0)
+
+        taken = [bucket.take(now=0) for _ in range(5)]
+
+        self.assertEqual(taken, [True, True, True, False, False])
+        self.assertEqual(bucket.wait(now=0), 1)
+        self.assertTrue(bucket.take(now=1))
+        self.assertFalse(bucket.take(now=1))
+
+    def test_refill_capped(self):
+        """
+        TokenBucket never holds more than the burst, however long it's quiet
+        """
+        bucket = TokenBucket(rate=60, burst=2, now=0)
+
+        taken = [bucket.take(now=1000) for _ in range(3)]
+
+        self.assertEqual(taken, [True, True, False])
+
+    def test_buckets_per_key(self):
+        """
+        Buckets limits every key on its own
+        """
+        buckets = Buckets(rate=1, burst=1)
+
+        self.assertTrue(buckets.take('alice', now=0))
+        self.assertFalse(buckets.take('alice', now=0))
+        self.assertTrue(buckets.take('bob', now=0))
+        self.assertEqual(len(buckets), 2)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """
+    Test suite for the CircuitBreaker object
+    """
+
+    def test_opens(self):
+        """
+        CircuitBreaker opens after enough failures in a row
+        """
+        breaker = CircuitBreaker(failures=3, cooldown=60)
+
+        self.assertFalse(breaker.failure(now=0))
+        breaker.success()
+        self.assertFalse(breaker.failure(now=0))
+        self.assertFalse(breaker.failure(now=0))
+        self.assertTrue(breaker.failure(now=0))
+
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow(now=30))
+        self.assertEqual(breaker.wait(now=30), 30)
+
+    def test_probe(self):
+        """
+        CircuitBreaker lets one probe through after the cooldown
+        """
+        breaker = CircuitBreaker(failures=1, cooldown=60)
+        breaker.failure(now=0)
+
+        self.assertTrue(breaker.allow(now=60))
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertFalse(breaker.allow(now=60))
+        self.assertTrue(breaker.success())
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_failed_probe(self):
+        """
+        CircuitBreaker opens again when the probe fails
+        """
+        breaker = CircuitBreaker(failures=1, cooldown=60)
+        breaker.failure(now=0)
+        breaker.allow(now=60)
+
+        self.assertTrue(breaker.failure(now=61))
+        self.assertFalse(breaker.allow(now=100))
+        self.assertTrue(breaker.allow(now=121))
+
+    def test_release(self):
+        """
+        CircuitBreaker lets another probe through when the first one is handed back
+        """
+        breaker = CircuitBreaker(failures=1, cooldown=60)
+        breaker.failure(now=0)
+        breaker.allow(now=60)
+
+        breaker.release()
+
+        self.assertEqual(breaker.state, OPEN)
+        self.assertTrue(breaker.allow(now=61))
+        self.assertEqual(breaker.state, HALF_OPEN)
+
+
+class TestHeld(unittest.TestCase):
+    """
+    Test suite for the Held object
+    """
+
+    def test_summary(self):
+        """
+        Held counts messages per event, busiest first
+        """
+        held = Held(most=2)
+        for name in ('web', 'db', 'web', 'cache', 'web', 'db'):
+            held.add(name, now=0)
+
+        taken = held.take()
+        summary = held.summary(taken, 'email')
+
+        self.assertEqual(len(held), 0)
+        self.assertTrue(summary.startswith('6 email notifications were held back'))
+        self.assertEqual(summary.splitlines()[1:], ['    web: 3', '    db: 2', '    ...and 1 more from 1 other events'])
+
+    def test_restore(self):
+        """
+        Held puts back messages when the summary couldn't be sent
+        """
+        held = Held()
+        held.add('web', now=5)
+        taken = held.take()
+        held.add('web', now=10)
+
+        held.restore(taken)
+
+        self.assertEqual(held.take(), ({'web' : 2}, 5, 10))
+
+
+class TestChannelLimits(unittest.TestCase):
+    """
+    Test suite for holding back messages on a Channel
+    """
+
+    def test_rate_limit(self):
+        """
+        Channel holds back messages over its rate, and sends a summary once it has a token
+        """
+        send = MagicMock()
+        limit = TokenBucket(rate=60, burst=2)
+        channel = Channel('test', send, MagicMock(), limit=limit)
+
+        channel._handle([('msg{0}'.format(x), 'web') for x in range(5)])
+
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(channel.held, 3)
+
+        limit._updated -= 1
+        channel._send_held()
+
+        self.assertEqual(channel.held, 0)
+        msg, name = send.call_args[0]
+        self.assertEqual(name, '3 held notifications')
+        self.assertTrue('    web: 3' in msg)
+
+    @patch.object(alarmer.monitoring.time, 'sleep')
+    def test_breaker(self, mocked_sleep):
+        """
+        Channel stops retrying once the circuit opens, fast fails while it's
+        open, and sends a summary after the probe works
+        """
+        send = MagicMock(side_effect=[IOError('doh'), IOError('doh'), None, None])
+        breaker = CircuitBreaker(failures=2, cooldown=60)
+        channel = Channel('test', send, MagicMock(), retries=5, breaker=breaker)
+
+        channel._handle([('down', 'web')])
+        channel._handle([('down', 'db')])
+
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(channel.held, 2)
+
+        breaker._opened -= 60
+        channel._handle([('up', 'web')])
+
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(send.call_count, 4)
+        msg = send.call_args[0][0]
+        self.assertTrue(msg.startswith('2 test notifications were held back'))
+        self.assertEqual(channel.held, 0)
+
+    def test_rate_limited_probe(self):
+        """
+        Channel hands back a probe that the rate limit held, and the next one closes the circuit
+        """
+        send = MagicMock(side_effect=[IOError('doh'), None, None])
+        limit = TokenBucket(rate=60, burst=1)
+        breaker = CircuitBreaker(failures=1, cooldown=60)
+        channel = Channel('test', send, MagicMock(), retries=0, limit=limit, breaker=breaker)
+
+        channel._handle([('down', 'web')])
+        breaker._opened -= 60
+        channel._handle([('down', 'db')])
+
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(channel.held, 2)
+
+        channel._send_held()
+
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(breaker.state, OPEN)
+
+        limit._updated -= 1
+        channel._handle([('up', 'web')])
+
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(channel.held, 2)
+        limit._updated -= 1
+        channel._send_held()
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(channel.held, 0)
+
+    def test_recipient_limit(self):
+        """
+        Channel only sends to the recipients under their limit
+        """
+        send = MagicMock()
+        send_to = MagicMock()
+        recipient_limit = Buckets(rate=1, burst=1)
+        recipient_limit.take('bob')
+        channel = Channel('test', send, MagicMock(), recipient_limit=recipient_limit,
+                          recipients=['alice', 'bob'], send_to=send_to)
+
+        channel._handle([('down', 'web')])
+
+        send_to.assert_called_once_with('down', 'web', ['alice'])
+        self.assertEqual(send.call_count, 0)
+        self.assertEqual(channel.held, 1)
+
+    def test_stop_sends_held(self):
+        """
+        Channel sends the held messages when it stops
+        """
+        send = MagicMock()
+        channel = Channel('test', send, MagicMock(), limit=TokenBucket(rate=1, burst=1))
+
+        for idx in range(3):
+            channel.put('msg{0}'.format(idx), 'web')
+        channel.start()
+        channel.join()
+        channel.stop()
+
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(send.call_args[0][1], '2 held notifications')
+
+
+if __name__ == '__main__':
+    unittest.main()
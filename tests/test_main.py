@@ -0,0 +1,182 @@
+# -*- coding: UTF-8 -*-
+"""
+Test logic for the monitoring loop helpers
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+import os
+import tempfile
+import unittest
+from mock import MagicMock
+
+import alarmer.main
+import alarmer.config
+import alarmer.monitoring
+from alarmer.config import ConfigParsingError
+from fakes import FakeProc
+
+
+class TestReload(unittest.TestCase):
+    """
+    Test suite for reloading the config file
+    """
+
+    def setUp(self):
+        self.proc = FakeProc(name=lambda: 'nginx', pid=1, is_running=lambda: True)
+        self.table = MagicMock(lookup=lambda name: set([self.proc]) if name == 'nginx' else set())
+        self.services = {'web': alarmer.monitoring.Service('web', ['nginx'], table=self.table),
+                         'db': alarmer.monitoring.Service('db', ['postgres'], table=self.table)}
+        self.config = MagicMock()
+        self.config.load.return_value = self.config
+        self.scheduler = alarmer.monitoring.Scheduler(10)
+        for name in self.services:
+            self.scheduler.add(name)
+
+    def test_reload_keeps_unchanged_services(self):
+        """
+        _reload keeps the Service objects that did not change
+        """
+        web = self.services['web']
+        self.config.grab_many.side_effect = [{'web': ['nginx'], 'db': ['postgres']},
+                                             {'web': ['nginx'], 'queue': ['rabbitmq']}]
+
+        index = alarmer.main._reload(self.config, MagicMock(), self.services, self.table, None, MagicMock(), self.scheduler)
+
+        self.assertTrue(self.services['web'] is web)
+        self.assertEqual(web.nginx, [1])
+        self.assertEqual(sorted(self.services), ['queue', 'web'])
+        self.assertTrue('rabbitmq' in index)
+        self.assertTrue('queue' in self.scheduler)
+        self.assertFalse('db' in self.scheduler)
+
+    def test_reload_bad_config(self):
+        """
+        _reload keeps the old services when the new config is invalid
+        """
+        self.config.grab_many.return_value = {'web': ['nginx'], 'db': ['postgres']}
+        self.config.load.side_effect = ConfigParsingError('doh')
+
+        index = alarmer.main._reload(self.config, MagicMock(), self.services, self.table, None, MagicMock(), self.scheduler)
+
+        self.assertTrue(index is None)
+        self.assertEqual(sorted(self.services), ['db', 'web'])
+
+    def test_reload_intervals(self):
+        """
+        _reload applies the new [intervals] to the scheduler
+        """
+        self.config.grab_many.return_value = {'web': ['nginx'], 'db': ['postgres']}
+        self.config.grab.return_value = 30
+        self.config.snapshot = alarmer.config.ConfigSnapshot({'intervals': {'db': 1}})
+
+        alarmer.main._reload(self.config, MagicMock(), self.services, self.table, None, MagicMock(), self.scheduler)
+
+        self.assertEqual(self.scheduler.interval_for('db'), 1)
+        self.assertEqual(self.scheduler.interval_for('web'), 30)
+
+    def test_reload_after_rejected(self):
+        """
+        _reload compares a fixed file against the last file it accepted, not the rejected one
+        """
+        fd, path = tempfile.mkstemp(suffix='.ini')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        def write(text):
+            with open(path, 'w') as the_file:
+                the_file.write(text)
+        write('[services]\nweb = nginx\n')
+        config = alarmer.config.ConfigReader(path, 'monitor', schema=alarmer.config.SCHEMA,
+                                             defaults=alarmer.config.DEFAULTS)
+        services = {'web': self.services['web']}
+        self.scheduler.remove('db')
+
+        write('[services]\nweb = nginx\ndb = postgres\n\n[thresholds]\ndb = bogus:1\n')
+        rejected = alarmer.main._reload(config, MagicMock(), services, self.table, None, MagicMock(), self.scheduler)
+        write('[services]\nweb = nginx\ndb = postgres\n\n[thresholds]\ndb = cpu:90\n')
+        index = alarmer.main._reload(config, MagicMock(), services, self.table, None, MagicMock(), self.scheduler)
+
+        self.assertTrue(rejected is None)
+        self.assertEqual(sorted(services), ['db', 'web'])
+        self.assertTrue('postgres' in index)
+        self.assertTrue('db' in self.scheduler)
+        self.assertEqual(config.grab_many(section='thresholds'), {'db': ['cpu:90']})
+
+    def test_reload_tree_mode(self):
+        """
+        _reload starts a Service over when it switches in or out of tree mode, so its live workers aren't dead
+        """
+        fd, path = tempfile.mkstemp(suffix='.ini')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        def write(text):
+            with open(path, 'w') as the_file:
+                the_file.write(text)
+        master = FakeProc(name=lambda: 'gunicorn', pid=10, ppid=1, is_running=lambda: True)
+        workers = set(FakeProc(name=lambda: 'gunicorn', pid=x, ppid=10, is_running=lambda: True) for x in (11, 12))
+        table = MagicMock(lookup=lambda name: set([master]) | workers,
+                          descendants=lambda root: workers if root is master else set())
+        write('[services]\nweb = gunicorn\n')
+        config = alarmer.config.ConfigReader(path, 'monitor', schema=alarmer.config.SCHEMA,
+                                             defaults=alarmer.config.DEFAULTS)
+        services = {'web': alarmer.monitoring.Service('web', ['gunicorn'], table=table)}
+        scheduler = alarmer.monitoring.Scheduler(10)
+        scheduler.add('web')
+
+        for text, tree in (('[services]\nweb = gunicorn\n\n[workers]\nweb = 1:4\n', (1, 4)),
+                           ('[services]\nweb = gunicorn\n', None)):
+            write(text)
+            alarmer.main._reload(config, MagicMock(), services, table, None, MagicMock(), scheduler)
+
+            self.assertEqual(services['web'].tree, tree)
+            self.assertEqual(services['web'].status(table), ({}, {}))
+
+
+class TestIntervals(unittest.TestCase):
+    """
+    Test suite for reading the [intervals] section
+    """
+
+    def test_intervals_missing(self):
+        """
+        _intervals returns an empty dict when there is no [intervals] section
+        """
+        config = MagicMock(snapshot=alarmer.config.ConfigSnapshot({'monitor': {'frequency': 10}}))
+
+        self.assertEqual(alarmer.main._intervals(config), {})
+
+    def test_intervals_invalid(self):
+        """
+        _intervals raises ConfigParsingError for an interval that isn't a positive number
+        """
+        config = MagicMock(snapshot=alarmer.config.ConfigSnapshot({'intervals': {'db': 'soon'}}))
+
+        self.assertRaises(ConfigParsingError, alarmer.main._intervals, config)
+
+
+
+class TestTrees(unittest.TestCase):
+    """
+    Test suite for reading the [workers] section
+    """
+
+    def test_trees(self):
+        """
+        _trees reads min:max, with either bound left blank
+        """
+        config = MagicMock(snapshot=alarmer.config.ConfigSnapshot({'workers': {'web': '2:16', 'db': '4:'}}))
+        config.grab_many.return_value = {'web': ['2:16'], 'db': ['4:']}
+
+        self.assertEqual(alarmer.main._trees(config), {'web': (2, 16), 'db': (4, None)})
+
+    def test_trees_invalid(self):
+        """
+        _trees raises ConfigParsingError for malformed bounds
+        """
+        config = MagicMock(snapshot=alarmer.config.ConfigSnapshot({'workers': {'web': 'lots'}}))
+        for value in ('lots', '2', 'a:b', '-1:4'):
+            config.grab_many.return_value = {'web': [value]}
+            self.assertRaises(ConfigParsingError, alarmer.main._trees, config)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+# -*- coding: UTF-8 -*-
+"""
+Test logic for picking out processes by more than their name
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+import os
+import unittest
+
+import psutil
+
+from alarmer.monitoring import ProcessTable, ServiceIndex, Service
+from alarmer.procfs import ProcScanner, available
+from alarmer.matching import Selector, ProcessAttributes, Matcher
+
+
+class FakeProc(object):
+    """A process with whatever attributes the test gives it"""
+    def __init__(self, pid, name, cmdline=(), user='root', exe=None):
+        self.pid = pid
+        self._name = name
+        self._cmdline = list(cmdline)
+        self._user = user
+        self._exe = exe
+        self.reads = 0
+
+    def __repr__(self):
+        return 'FakeProc(pid={0})'.format(self.pid)
+
+    def name(self):
+        return self._name
+
+    def is_running(self):
+        return True
+
+    def cmdline(self):
+        self.reads += 1
+        return self._cmdline
+
+    def username(self):
+        self.reads += 1
+        return self._user
+
+    def exe(self):
+        self.reads += 1
+        if self._exe is None:
+            raise psutil.AccessDenied(self.pid)
+        return self._exe
+
+
+def make_table(procs, names=None):
+    return ProcessTable(names=names, scanner=lambda: list(procs))
+
+
+class TestSelector(unittest.TestCase):
+    """
+    Test suite for the Selector object
+    """
+
+    def test_selector_plain(self):
+        """
+        Selector of just a name is plain
+        """
+        selector = Selector('nginx')
+
+        self.assertTrue(selector.plain)
+        self.assertEqual(selector.name, 'nginx')
+
+    def test_selector_filters(self):
+        """
+        Selector orders the filters cheapest first
+        """
+        selector = Selector('java[cmdline=orders.jar][user=app]')
+
+        self.assertFalse(selector.plain)
+        self.assertEqual(selector.name, 'java')
+        self.assertEqual(selector.filters, [('user', 'app'), ('cmdline', 'orders.jar')])
+
+    def test_selector_brackets_in_regex(self):
+        """
+        Selector allows brackets inside a regex
+        """
+        selector = Selector('[name~=worker-[0-9]+]')
+
+        self.assertEqual(selector.name, None)
+        self.assertTrue(selector.match_name('worker-12'))
+        self.assertFalse(selector.match_name('worker-12x'))
+
+    def test_selector_bad(self):
+        """
+        Selector raises ValueError for malformed selectors
+        """
+        for text in ('java[cmdline=x]junk', 'java[mem=1]', '[name~=(]', '', 'java[cmdline=x'):
+            self.assertRaises(ValueError, Selector, text)
+
+    def test_selector_matches(self):
+        """
+        Selector checks every filter, and stops at the first miss
+        """
+        selector = Selector('java[user=app][cmdline~=orders-\\d+\\.jar]')
+        good = FakeProc(1, 'java', ['java', '-jar', 'orders-2.jar'], user='app')
+        wrong_user = FakeProc(2, 'java', ['java', '-jar', 'orders-2.jar'], user='root')
+
+        self.assertTrue(selector.matches(ProcessAttributes(good)))
+        self.assertFalse(selector.matches(ProcessAttributes(wrong_user)))
+        self.assertEqual(wrong_user.reads, 1) # never read the cmdline
+
+    def test_selector_unreadable(self):
+        """
+        Selector doesn't match a process it's not allowed to look at
+        """
+        selector = Selector('python[exe=/usr/bin/python]')
+
+        self.assertFalse(selector.matches(ProcessAttributes(FakeProc(1, 'python'))))
+
+
+class TestMatcher(unittest.TestCase):
+    """
+    Test suite for routing processes by selector
+    """
+
+    def setUp(self):
+        self.orders = FakeProc(1, 'java', ['java', '-jar', 'orders.jar'])
+        self.billing = FakeProc(2, 'java', ['java', '-jar', 'billing.jar'])
+        self.worker = FakeProc(3, 'worker-7', user='app')
+        self.other = FakeProc(4, 'bash')
+        self.procs = [self.orders, self.billing, self.worker, self.other]
+
+    def test_route_by_cmdline(self):
+        """
+        ServiceIndex tells apart services that run the same program
+        """
+        index = ServiceIndex({'orders' : ['java[cmdline=orders.jar]'],
+                              'billing' : ['java[cmdline=billing.jar]'],
+                              'workers' : ['[name~=worker-\\d+]']})
+        table = make_table(self.procs, names=index)
+
+        found = index.route(table)
+
+        self.assertEqual(found['orders'], {'java[cmdline=orders.jar]' : set([self.orders])})
+        self.assertEqual(found['billing'], {'java[cmdline=billing.jar]' : set([self.billing])})
+        self.assertEqual(found['workers'], {'[name~=worker-\\d+]' : set([self.worker])})
+        self.assertFalse('bash' in table)
+
+    def test_route_mixed(self):
+        """
+        ServiceIndex routes plain names and selectors side by side
+        """
+        index = ServiceIndex({'web' : ['bash', 'java[cmdline=orders.jar]']})
+        table = make_table(self.procs, names=index)
+
+        found = index.route(table)
+
+        self.assertEqual(found['web'], {'bash' : set([self.other]), 'java[cmdline=orders.jar]' : set([self.orders])})
+
+    def test_attributes_read_once(self):
+        """
+        Matcher reads an attribute once per process, however many selectors want it
+        """
+        selectors = [('svc{0}'.format(x), 'java[cmdline=nope{0}]'.format(x), Selector('java[cmdline=nope{0}]'.format(x)))
+                     for x in range(5)]
+        matcher = Matcher(selectors)
+
+        matcher.route(make_table(self.procs), {})
+
+        self.assertEqual(self.orders.reads, 1)
+        self.assertEqual(self.other.reads, 0)
+
+    def test_candidates_cached(self):
+        """
+        Matcher decides once per name which selectors might match
+        """
+        matcher = Matcher([('workers', '[name~=worker-\\d+]', Selector('[name~=worker-\\d+]'))])
+
+        self.assertTrue(matcher.wants('worker-1'))
+        self.assertFalse(matcher.wants('bash'))
+        self.assertTrue(matcher.candidates('bash') is matcher.candidates('bash'))
+
+    def test_candidates_bounded(self):
+        """
+        Matcher never caches more than cache_size names, however many come and go
+        """
+        matcher = Matcher([('workers', '[name~=worker-\\d+]', Selector('[name~=worker-\\d+]'))], cache_size=100)
+
+        for idx in range(1000):
+            matcher.wants('job-{0}'.format(idx))
+
+        self.assertTrue(len(matcher._candidates) <= 100)
+        self.assertTrue(matcher.wants('worker-1'))
+
+    def test_service_find_selector(self):
+        """
+        Service finds its processes by selector, from a ProcessTable
+        """
+        table = make_table(self.procs)
+
+        service = Service('orders', ['java[cmdline=orders.jar]'], table=table)
+
+        self.assertEqual(service.processes, ['java[cmdline=orders.jar]'])
+        self.assertEqual([x[1] for x in service.tracked()], [self.orders])
+
+
+class TestProcfsAttributes(unittest.TestCase):
+    """
+    Test suite for reading selector attributes from procfs
+    """
+
+    @unittest.skipUnless(available(), 'procfs is Linux only')
+    def test_procfs_attributes(self):
+        """
+        ProcRecord reads the same attributes as psutil.Process
+        """
+        record = [x for x in ProcScanner()() if x.pid == os.getpid()][0]
+        proc = psutil.Process()
+
+        self.assertEqual(record.cmdline(), proc.cmdline())
+        self.assertEqual(record.username(), proc.username())
+        self.assertEqual(record.exe(), proc.exe())
+
+
+if __name__ == '__main__':
+    unittest.main()
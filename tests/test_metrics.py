@@ -0,0 +1,208 @@
+# -*- coding: UTF-8 -*-
+"""
+Test logic for the metrics about alarmer itself
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+import requests
+from mock import MagicMock
+
+from alarmer.monitoring import Channel, EventStore
+from alarmer.metrics import Registry, SharedRegistry, LoopMetrics, MetricsExporter, Histogram
+
+
+def _push_from_child(registry):
+    """Run in a child process"""
+    registry.counter('child_total', 'Made in the child').inc(3)
+    registry.push()
+
+
+class TestRegistry(unittest.TestCase):
+    """
+    Test suite for the Registry and the metrics in it
+    """
+
+    def test_counter_labels(self):
+        """
+        Counter keeps a value per set of labels
+        """
+        registry = Registry()
+        deaths = registry.counter('deaths_total', 'Deaths')
+
+        deaths.inc(service='web')
+        deaths.inc(2, service='web')
+        deaths.inc(service='db')
+
+        self.assertEqual(deaths.value(service='web'), 3)
+        self.assertEqual(deaths.value(service='db'), 1)
+
+    def test_registry_same_metric(self):
+        """
+        Registry returns the existing metric for a name
+        """
+        registry = Registry()
+
+        self.assertTrue(registry.counter('a_total', 'A') is registry.counter('a_total', 'A'))
+        self.assertRaises(ValueError, registry.gauge, 'a_total', 'A')
+
+    def test_histogram_buckets(self):
+        """
+        Histogram renders cumulative buckets, the sum and the count
+        """
+        registry = Registry()
+        histogram = registry.histogram('tick_seconds', 'Ticks', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+
+        lines = registry.render().splitlines()
+
+        self.assertTrue('tick_seconds_bucket{le="0.1"} 2' in lines)
+        self.assertTrue('tick_seconds_bucket{le="1"} 3' in lines)
+        self.assertTrue('tick_seconds_bucket{le="+Inf"} 4' in lines)
+        self.assertTrue('tick_seconds_sum 5.65' in lines)
+        self.assertTrue('tick_seconds_count 4' in lines)
+
+    def test_histogram_time(self):
+        """
+        Histogram.time observes how long a block took
+        """
+        histogram = Histogram('work_seconds', 'Work')
+
+        with histogram.time(kind='test'):
+            time.sleep(0.01)
+
+        self.assertEqual(histogram.count(kind='test'), 1)
+        self.assertTrue(histogram.sum(kind='test') >= 0.01)
+
+    def test_render_format(self):
+        """
+        Registry.render makes the Prometheus text format, with escaped labels
+        """
+        registry = Registry()
+        registry.gauge('depth', 'How deep').set(4, channel='e"mail')
+
+        text = registry.render()
+
+        self.assertEqual(text, '# HELP depth How deep\n# TYPE depth gauge\ndepth{channel="e\\"mail"} 4\n')
+
+    def test_render_hooks_and_sources(self):
+        """
+        Registry.render runs the hooks first, and adds the text of every source
+        """
+        registry = Registry()
+        gauge = registry.gauge('open', 'Open')
+        registry.on_render(lambda: gauge.set(7))
+        registry.add_source(lambda: 'other 1\n')
+
+        text = registry.render()
+
+        self.assertTrue('open 7\n' in text)
+        self.assertTrue(text.endswith('other 1\n'))
+
+    def test_shared_registry(self):
+        """
+        SharedRegistry renders the metrics pushed by a child process
+        """
+        registry = SharedRegistry()
+        child = multiprocessing.Process(target=_push_from_child, args=(registry,))
+        child.start()
+        child.join(5)
+
+        deadline = time.time() + 5
+        while 'child_total 3' not in registry.render() and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertTrue('child_total 3' in registry.render())
+
+    def test_loop_metrics_watch(self):
+        """
+        LoopMetrics.watch reads the open Events and queue depth on render
+        """
+        registry = Registry()
+        metrics = LoopMetrics(registry)
+        events = EventStore(reset_after=60, rate=60)
+        events.record('web', 'nginx', 1)
+
+        metrics.watch(events, MagicMock(depth=3))
+        registry.render()
+
+        self.assertEqual(metrics.open_events.value(), 1)
+        self.assertEqual(metrics.queue_depth.value(), 3)
+
+
+class TestChannelMetrics(unittest.TestCase):
+    """
+    Test suite for the metrics recorded by a Channel
+    """
+
+    def test_channel_send_metrics(self):
+        """
+        Channel records how long sends take, and how many fail
+        """
+        registry = Registry()
+        send = MagicMock(side_effect=[IOError('doh'), None])
+        channel = Channel('email', send, MagicMock(), retries=1, backoff=0, metrics=registry)
+        channel.start()
+
+        channel.put('msg', 'svc -> proc')
+        channel.join()
+
+        self.assertEqual(registry['alarmer_send_seconds'].count(channel='email'), 2)
+        self.assertEqual(registry['alarmer_send_failures_total'].value(channel='email'), 1)
+
+
+class TestMetricsExporter(unittest.TestCase):
+    """
+    Test suite for the MetricsExporter object
+    """
+
+    def setUp(self):
+        self.registry = Registry()
+        self.registry.counter('things_total', 'Things').inc()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_exporter_http(self):
+        """
+        MetricsExporter serves the metrics on /metrics
+        """
+        exporter = MetricsExporter(self.registry, listen=('127.0.0.1', 0))
+        exporter.start()
+        try:
+            url = 'http://{0}:{1}'.format(*exporter.address)
+            resp = requests.get(url + '/metrics', timeout=5)
+            missing = requests.get(url + '/nope', timeout=5)
+        finally:
+            exporter.stop()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue('things_total 1' in resp.text)
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/plain'))
+        self.assertEqual(missing.status_code, 404)
+
+    def test_exporter_textfile(self):
+        """
+        MetricsExporter writes the metrics to a file
+        """
+        path = os.path.join(self.tmpdir, 'alarmer.prom')
+        exporter = MetricsExporter(self.registry, textfile=path)
+
+        exporter.write()
+
+        with open(path) as the_file:
+            self.assertTrue('things_total 1' in the_file.read())
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+
+if __name__ == '__main__':
+    unittest.main()
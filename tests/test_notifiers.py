@@ -0,0 +1,261 @@
+# -*- coding: UTF-8 -*-
+"""
+Test logic for the notifiers, and loading them as plugins
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+import json
+import threading
+import unittest
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+from mock import MagicMock
+
+import requests
+
+from alarmer.monitoring import Channel, Dispatcher
+from alarmer.config import ConfigParsingError
+from alarmer.notifiers import (Notifier, WebhookNotifier, SlackNotifier, EmailNotifier,
+                               load_notifiers, import_notifier, overrides)
+
+
+class FakeHookHandler(BaseHTTPRequestHandler):
+    """Accepts POSTs, and remembers the JSON bodies & connections they came in on"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.posts.append(json.loads(body.decode('utf-8')))
+        self.server.connections.add(self.client_address)
+        status = self.server.status
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeHookServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeHookHandler)
+        self.posts = []
+        self.connections = set()
+        self.status = 200
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/hook'.format(self.server_address[1])
+
+
+def make_config(settings):
+    """A ConfigReader stand in, that only knows the [dispatch] settings given"""
+    def grab(item, section=None, cast=True):
+        try:
+            return settings[item]
+        except KeyError:
+            raise ConfigParsingError('No option {0} in section: {1}'.format(item, section))
+    config = MagicMock()
+    config.grab.side_effect = grab
+    return config
+
+
+class PagerNotifier(Notifier):
+    """A plugin notifier, for the tests"""
+    def send(self, msg, event_name):
+        pass
+
+
+class OnCallNotifier(Notifier):
+    """A plugin notifier with recipients, but no send_to"""
+    recipients = ['alice', 'bob']
+
+    def __init__(self, config, logger, name):
+        super(OnCallNotifier, self).__init__(config, logger, name)
+        self.sent = []
+
+    def send(self, msg, event_name):
+        self.sent.append(event_name)
+
+
+class TestWebhook(unittest.TestCase):
+    """
+    Test suite for the WebhookNotifier and SlackNotifier objects
+    """
+
+    def setUp(self):
+        self.server = FakeHookServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.config = make_config({'webhook_url' : self.server.url,
+                                   'webhook_timeout' : 5,
+                                   'webhook_workers' : 2,
+                                   'webhook_batch' : 10,
+                                   'slack_url' : self.server.url,
+                                   'slack_timeout' : 5,
+                                   'slack_workers' : 1,
+                                   'slack_batch' : 10,
+                                  })
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_webhook_batch(self):
+        """
+        WebhookNotifier posts many events in one JSON body
+        """
+        notifier = WebhookNotifier(self.config, MagicMock())
+
+        notifier.send_batch([('down', 'web -> nginx'), ('over', 'db -> postgres')])
+        notifier.close()
+
+        self.assertEqual(self.server.posts, [{'events' : [{'event' : 'web -> nginx', 'message' : 'down'},
+                                                          {'event' : 'db -> postgres', 'message' : 'over'}]}])
+
+    def test_webhook_keep_alive(self):
+        """
+        WebhookNotifier sends every post over the same connection
+        """
+        notifier = WebhookNotifier(self.config, MagicMock())
+
+        for _ in range(5):
+            notifier.send('down', 'web -> nginx')
+        notifier.close()
+
+        self.assertEqual(len(self.server.posts), 5)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_webhook_error(self):
+        """
+        WebhookNotifier raises on an HTTP error, so the Channel retries it
+        """
+        self.server.status = 500
+        notifier = WebhookNotifier(self.config, MagicMock())
+
+        self.assertRaises(requests.HTTPError, notifier.send, 'down', 'web -> nginx')
+
+    def test_webhook_needs_url(self):
+        """
+        WebhookNotifier raises ValueError without a URL
+        """
+        config = make_config({'webhook_url' : '', 'webhook_timeout' : 5, 'webhook_workers' : 1, 'webhook_batch' : 1})
+
+        self.assertRaises(ValueError, WebhookNotifier, config, MagicMock())
+
+    def test_slack_payload(self):
+        """
+        SlackNotifier sends a batch as one Slack message
+        """
+        notifier = SlackNotifier(self.config, MagicMock())
+
+        notifier.send_batch([('down', 'web -> nginx'), ('over', 'db -> postgres')])
+        notifier.close()
+
+        self.assertEqual(self.server.posts, [{'text' : '*web -> nginx*\ndown\n*db -> postgres*\nover'}])
+
+    def test_channel_batches(self):
+        """
+        Channel hands the messages waiting in its queue to send_batch together
+        """
+        notifier = WebhookNotifier(self.config, MagicMock())
+        channel = Channel('webhook', notifier.send, MagicMock(), send_batch=notifier.send_batch, batch=3)
+
+        for idx in range(7):
+            channel.put('msg{0}'.format(idx), 'event')
+        channel.start()
+        channel.join()
+        channel.stop()
+        notifier.close()
+
+        self.assertEqual([len(x['events']) for x in self.server.posts], [3, 3, 1])
+
+
+class TestLoadNotifiers(unittest.TestCase):
+    """
+    Test suite for finding notifiers by name
+    """
+
+    def test_builtin(self):
+        """
+        load_notifiers knows the built in notifiers
+        """
+        notifiers = load_notifiers()
+
+        self.assertTrue(notifiers['email'] is EmailNotifier)
+        self.assertTrue(notifiers['slack'] is SlackNotifier)
+        self.assertTrue(notifiers['webhook'] is WebhookNotifier)
+
+    def test_plugin(self):
+        """
+        load_notifiers imports plugins from the config
+        """
+        notifiers = load_notifiers(' pager = test_notifiers:PagerNotifier, ')
+
+        self.assertTrue(notifiers['pager'] is PagerNotifier)
+
+    def test_bad_plugin(self):
+        """
+        load_notifiers raises ValueError for plugins it can't load
+        """
+        for plugins in ('pager', 'pager=nope', 'pager=no_such_module:Pager', 'pager=test_notifiers:Nope'):
+            self.assertRaises(ValueError, load_notifiers, plugins)
+
+    def test_import_notifier(self):
+        """
+        import_notifier finds a class by module:Class
+        """
+        self.assertTrue(import_notifier('alarmer.notifiers:SlackNotifier') is SlackNotifier)
+
+    def test_dispatcher_plugin(self):
+        """
+        Dispatcher builds a Channel for an enabled plugin, without <name>_workers
+        """
+        config = make_config({'plugins' : 'pager=test_notifiers:PagerNotifier',
+                              'enable_pager' : True,
+                              'queue_size' : 10,
+                              'retries' : 0,
+                              'retry_backoff' : 0})
+        dispatcher = Dispatcher(config, MagicMock())
+
+        channels = dispatcher._make_channels()
+
+        self.assertEqual(sorted(channels), ['pager'])
+        self.assertEqual(channels['pager'].workers, 1)
+        self.assertTrue(isinstance(dispatcher.notifiers['pager'], PagerNotifier))
+
+    def test_dispatcher_plugin_without_send_to(self):
+        """
+        Dispatcher holds back the whole message for a plugin that can't send to some recipients
+        """
+        config = make_config({'plugins' : 'oncall=test_notifiers:OnCallNotifier',
+                              'enable_oncall' : True,
+                              'queue_size' : 10,
+                              'retries' : 2,
+                              'retry_backoff' : 0,
+                              'recipient_rate_limit' : 1,
+                              'recipient_burst' : 1,
+                              'breaker_failures' : 1})
+        dispatcher = Dispatcher(config, MagicMock())
+        channel = dispatcher._make_channels()['oncall']
+        channel._recipient_limit.take('bob')
+
+        channel._handle([('down', 'web')])
+
+        self.assertEqual(dispatcher.notifiers['oncall'].sent, [])
+        self.assertEqual(channel.held, 1)
+        self.assertEqual(channel._breaker.state, 'closed')
+        self.assertFalse(overrides(dispatcher.notifiers['oncall'], 'send_to'))
+        self.assertTrue(overrides(EmailNotifier.__new__(EmailNotifier), 'send_to'))
+
+
+if __name__ == '__main__':
+    unittest.main()
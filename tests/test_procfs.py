@@ -0,0 +1,185 @@
+# -*- coding: UTF-8 -*-
+"""
+Test logic for the procfs process table scanner
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import alarmer.monitoring
+from alarmer.procfs import ProcScanner, ProcRecord
+
+
+STAT = '{pid} ({name}) {state} {ppid} 1 1 0 -1 4194560 100 0 0 0 1 1 0 0 20 0 1 0 {start} 1000 100\n'
+
+
+class TestProcScanner(unittest.TestCase):
+    """
+    Test suite for the ProcScanner object
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_proc(self, pid, name, ppid=1, start=100, cmdline='', state='S'):
+        """Write a fake /proc/<pid> directory"""
+        proc_dir = os.path.join(self.root, str(pid))
+        if not os.path.isdir(proc_dir):
+            os.mkdir(proc_dir)
+        with open(os.path.join(proc_dir, 'stat'), 'w') as the_file:
+            the_file.write(STAT.format(pid=pid, name=name, ppid=ppid, start=start, state=state))
+        with open(os.path.join(proc_dir, 'cmdline'), 'w') as the_file:
+            the_file.write(cmdline)
+
+    def test_scanner_parses_stat(self):
+        """
+        ProcScanner extracts name, ppid and start time
+        """
+        self.make_proc(42, 'nginx', ppid=7, start=12345)
+
+        records = list(ProcScanner(root=self.root)())
+
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].name(), 'nginx')
+        self.assertEqual(records[0].ppid, 7)
+        self.assertEqual(records[0].start_time, 12345)
+
+    def test_scanner_name_with_parens(self):
+        """
+        ProcScanner handles process names with spaces and parens
+        """
+        self.make_proc(42, 'my (odd) name')
+
+        records = list(ProcScanner(root=self.root)())
+
+        self.assertEqual(records[0].name(), 'my (odd) name')
+
+    def test_scanner_skips_non_pids(self):
+        """
+        ProcScanner ignores directories that are not PIDs
+        """
+        self.make_proc(42, 'nginx')
+        os.mkdir(os.path.join(self.root, 'sys'))
+
+        records = list(ProcScanner(root=self.root)())
+
+        self.assertEqual([x.pid for x in records], [42])
+
+    def test_scanner_skips_zombies(self):
+        """
+        ProcScanner ignores processes that exited, but haven't been reaped
+        """
+        self.make_proc(42, 'nginx')
+        self.make_proc(43, 'nginx', state='Z')
+
+        records = list(ProcScanner(root=self.root)())
+
+        self.assertEqual([x.pid for x in records], [42])
+
+    def test_service_ignores_zombie(self):
+        """
+        Service.status reports a process that died once, not again as a new zombie
+        """
+        self.make_proc(42, 'nginx')
+        table = alarmer.monitoring.ProcessTable(scanner=ProcScanner(root=self.root))
+        service = alarmer.monitoring.Service('web', ['nginx'], table=table)
+
+        self.make_proc(42, 'nginx', state='Z')
+        self.make_proc(43, 'nginx')
+        table.refresh()
+        first = service.status(table)
+        self.make_proc(44, 'nginx')
+        table.refresh()
+        second = service.status(table)
+
+        self.assertEqual(first, ({'nginx': [43]}, {'nginx': [42]}))
+        self.assertEqual(second, ({'nginx': [44]}, {}))
+
+    def test_scanner_full_name(self):
+        """
+        ProcScanner uses the cmdline for names truncated by the kernel
+        """
+        self.make_proc(42, 'a_very_long_pro', cmdline='/usr/bin/a_very_long_process_name\x00--flag\x00')
+
+        records = list(ProcScanner(root=self.root)())
+
+        self.assertEqual(records[0].name(), 'a_very_long_process_name')
+
+    def test_scanner_reuses_records(self):
+        """
+        ProcScanner returns the same record for a process between scans
+        """
+        self.make_proc(42, 'nginx')
+        scanner = ProcScanner(root=self.root)
+
+        first = list(scanner())
+        second = list(scanner())
+
+        self.assertTrue(first[0] is second[0])
+
+    def test_record_is_running(self):
+        """
+        ProcRecord.is_running is False once the process exits
+        """
+        self.make_proc(42, 'nginx')
+        record = list(ProcScanner(root=self.root)())[0]
+
+        shutil.rmtree(os.path.join(self.root, '42'))
+
+        self.assertFalse(record.is_running())
+
+    def test_record_pid_reuse(self):
+        """
+        ProcRecord.is_running is False when the PID was reused
+        """
+        self.make_proc(42, 'nginx', start=100)
+        record = list(ProcScanner(root=self.root)())[0]
+
+        self.make_proc(42, 'nginx', start=200)
+
+        self.assertFalse(record.is_running())
+
+    def test_record_equality(self):
+        """
+        ProcRecords are equal when PID and start time match
+        """
+        record1 = ProcRecord(42, 'nginx', 1, 100, None)
+        record2 = ProcRecord(42, 'nginx', 1, 100, None)
+        record3 = ProcRecord(42, 'nginx', 1, 200, None)
+
+        self.assertEqual(record1, record2)
+        self.assertNotEqual(record1, record3)
+        self.assertEqual(len(set([record1, record2, record3])), 2)
+
+    def test_service_status_with_procfs(self):
+        """
+        Service.status reports new and dead PIDs when using the procfs scanner
+        """
+        self.make_proc(42, 'nginx')
+        table = alarmer.monitoring.ProcessTable(scanner=ProcScanner(root=self.root))
+        service = alarmer.monitoring.Service('web', ['nginx'], table=table)
+
+        shutil.rmtree(os.path.join(self.root, '42'))
+        self.make_proc(43, 'nginx')
+        table.refresh()
+        new_pids, dead_pids = service.status(table)
+
+        self.assertEqual(new_pids, {'nginx': [43]})
+        self.assertEqual(dead_pids, {'nginx': [42]})
+
+    def test_get_scanner_unknown(self):
+        """
+        get_scanner rejects unknown backends
+        """
+        self.assertRaises(ValueError, alarmer.monitoring.get_scanner, 'bogus')
+
+
+if __name__ == '__main__':
+    unittest.main()
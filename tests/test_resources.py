@@ -0,0 +1,252 @@
+# -*- coding: UTF-8 -*-
+"""
+Test logic for watching the CPU, memory and file descriptors of processes
+"""
+from __future__ import print_function, division, unicode_literals
+#TODO add absolute_import
+
+import os
+import unittest
+
+import psutil
+from mock import MagicMock
+
+from alarmer.monitoring import Event, EventStore, Dispatcher
+from alarmer.procfs import ProcScanner, available
+from alarmer.resources import Ring, ResourceMonitor, parse_thresholds, sample
+
+
+class FakeProc(object):
+    """A process that reports whatever usage the test sets"""
+    def __init__(self, pid, cpu=0.0, rss=0, fds=0):
+        self.pid = pid
+        self.cpu = cpu
+        self.rss = rss
+        self.fds = fds
+
+    def usage(self, fds=False):
+        if self.cpu is None:
+            return None
+        return self.cpu, self.rss, self.fds if fds else None
+
+
+class FakeService(object):
+    """Just enough of a Service for ResourceMonitor"""
+    def __init__(self, name, procs):
+        self.name = name
+        self.procs = procs
+
+    def tracked(self):
+        for name, proc in self.procs:
+            yield name, proc
+
+
+class TestParseThresholds(unittest.TestCase):
+    """
+    Test suite for the parse_thresholds function
+    """
+
+    def test_parse_thresholds(self):
+        """
+        parse_thresholds reads each kind, with size suffixes for rss
+        """
+        limits = parse_thresholds(['cpu:90', ' rss:512M', 'fds:1000'])
+
+        self.assertEqual(limits, {'cpu' : 90, 'rss' : 512 * 1024 * 1024, 'fds' : 1000})
+
+    def test_parse_thresholds_bad(self):
+        """
+        parse_thresholds raises ValueError on a bad kind, value or format
+        """
+        for item in ('mem:90', 'cpu:lots', 'cpu', 'fds:0', 'rss:'):
+            self.assertRaises(ValueError, parse_thresholds, [item])
+
+
+class TestRing(unittest.TestCase):
+    """
+    Test suite for the Ring object
+    """
+
+    def test_ring_window(self):
+        """
+        Ring keeps only the latest samples
+        """
+        ring = Ring(3)
+        for value in (5, 1, 7, 8):
+            ring.append(value)
+
+        self.assertTrue(ring.full)
+        self.assertEqual(ring.min(), 1)
+        self.assertEqual(ring.last, 8)
+
+        ring.append(9)
+
+        self.assertEqual(ring.min(), 7)
+        self.assertEqual(ring.mean(), 8)
+
+    def test_ring_not_full(self):
+        """
+        Ring only looks at the samples it has so far
+        """
+        ring = Ring(3)
+
+        self.assertTrue(ring.min() is None)
+        ring.append(4)
+
+        self.assertFalse(ring.full)
+        self.assertEqual(ring.min(), 4)
+        self.assertEqual(len(ring), 1)
+
+
+class TestResourceMonitor(unittest.TestCase):
+    """
+    Test suite for the ResourceMonitor object
+    """
+
+    def test_breach_needs_full_window(self):
+        """
+        ResourceMonitor only reports once every sample in the window is over
+        """
+        proc = FakeProc(10, rss=2000)
+        service = FakeService('web', [('nginx', proc)])
+        monitor = ResourceMonitor({'web' : {'rss' : 1000}}, samples=2)
+
+        self.assertEqual(monitor.check(service, now=1), [])
+        breaches = monitor.check(service, now=2)
+
+        self.assertEqual(len(breaches), 1)
+        self.assertEqual(breaches[0][:3], ('nginx', 10, 'rss'))
+
+    def test_spike_not_reported(self):
+        """
+        ResourceMonitor ignores a process that dips under the limit
+        """
+        proc = FakeProc(10, fds=50)
+        service = FakeService('web', [('nginx', proc)])
+        monitor = ResourceMonitor({'web' : {'fds' : 10}}, samples=2)
+
+        monitor.check(service, now=1)
+        proc.fds = 5
+        monitor.check(service, now=2)
+        proc.fds = 50
+
+        self.assertEqual(monitor.check(service, now=3), [])
+
+    def test_cpu_percent(self):
+        """
+        ResourceMonitor works out the CPU percent from the change in CPU time
+        """
+        proc = FakeProc(10, cpu=100.0)
+        service = FakeService('web', [('nginx', proc)])
+        monitor = ResourceMonitor({'web' : {'cpu' : 90}}, samples=2)
+
+        for now in (0, 10, 20):
+            proc.cpu += 9.5 # 95% of a core
+            breaches = monitor.check(service, now=now)
+
+        self.assertEqual(len(breaches), 1)
+        self.assertTrue('95.0%' in breaches[0][3])
+
+    def test_forgets_dead_process(self):
+        """
+        ResourceMonitor drops the windows of processes that are gone
+        """
+        proc = FakeProc(10, rss=2000)
+        service = FakeService('web', [('nginx', proc)])
+        monitor = ResourceMonitor({'web' : {'rss' : 1000}}, samples=2)
+        monitor.check(service, now=1)
+
+        proc.cpu = None
+        monitor.check(service, now=2)
+        proc.cpu = 0.0
+
+        self.assertEqual(monitor.check(service, now=3), [])
+
+    def test_no_limits(self):
+        """
+        ResourceMonitor doesn't sample services without limits
+        """
+        proc = MagicMock()
+        service = FakeService('web', [('nginx', proc)])
+        monitor = ResourceMonitor({})
+
+        self.assertEqual(monitor.check(service), [])
+        self.assertEqual(monitor.sampled, 0)
+
+    def test_update_resets_windows(self):
+        """
+        ResourceMonitor.update starts over for a service with new limits
+        """
+        proc = FakeProc(10, rss=2000)
+        service = FakeService('web', [('nginx', proc)])
+        monitor = ResourceMonitor({'web' : {'rss' : 1000}}, samples=2)
+        monitor.check(service, now=1)
+
+        monitor.update({'web' : {'rss' : 1500}})
+
+        self.assertEqual(monitor.check(service, now=2), [])
+
+
+class TestSample(unittest.TestCase):
+    """
+    Test suite for reading the usage of real processes
+    """
+
+    def test_sample_psutil(self):
+        """
+        sample reads a psutil.Process in one go
+        """
+        cpu, rss, fds = sample(psutil.Process(), fds=True)
+
+        self.assertTrue(rss > 0)
+        self.assertTrue(fds > 0)
+
+    @unittest.skipUnless(available(), 'procfs is Linux only')
+    def test_sample_procfs(self):
+        """
+        sample reads a ProcRecord from /proc/<pid>/stat
+        """
+        record = [x for x in ProcScanner()() if x.pid == os.getpid()][0]
+
+        cpu, rss, fds = sample(record, fds=True)
+
+        self.assertTrue(rss > 0)
+        self.assertTrue(fds > 0)
+        self.assertEqual(sample(record)[2], None)
+
+
+class TestEventKinds(unittest.TestCase):
+    """
+    Test suite for Events about a process over a limit
+    """
+
+    def test_event_kinds_are_separate(self):
+        """
+        EventStore keeps a breach apart from a death of the same process
+        """
+        events = EventStore(reset_after=60, rate=60)
+
+        died, _ = events.record('web', 'nginx', 1, now=100)
+        over, is_new = events.record('web', 'nginx', 1, now=100, kind='rss', detail='rss at 2.0MB')
+
+        self.assertTrue(is_new)
+        self.assertNotEqual(died, over)
+        self.assertEqual(over.name, 'web -> nginx (rss)')
+        self.assertEqual(over.detail, 'rss at 2.0MB')
+
+    def test_format_breach(self):
+        """
+        Dispatcher describes a breach, not a death
+        """
+        event = Event('web', 'nginx', 1, now=100, kind='cpu', detail='cpu at 99.0% for the last 3 checks; the limit is 90.0%')
+        dispatcher = Dispatcher(MagicMock(), MagicMock())
+        dispatcher.host_info = MagicMock(msg='')
+
+        msg = dispatcher._format_msg(event)
+
+        self.assertTrue('over its cpu limit' in msg)
+        self.assertTrue('cpu at 99.0%' in msg)
+
+
+if __name__ == '__main__':
+    unittest.main()
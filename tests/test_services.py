@@ -5,18 +5,41 @@ Test logic for the Services object
 from __future__ import print_function, division, unicode_literals
 #TODO add absolute_import
 
+import time
 import unittest
+import subprocess
 import psutil
-from mock import patch
+from mock import patch, MagicMock
 
 import alarmer.monitoring
+from fakes import FakeProc
 
 
-class FakeProc(object):
-    '''For testing'''
-    def __init__(self, **kwargs):
-        for k, v in kwargs.items():
-            setattr(self, str(k), v)
+class Ident(object):
+    """A process that compares on PID & start time, like psutil.Process"""
+    def __init__(self, pid, start_time, name):
+        self.pid = pid
+        self.start_time = start_time
+        self._name = name
+
+    def __hash__(self):
+        return hash((self.pid, self.start_time))
+
+    def __eq__(self, other):
+        return (self.pid, self.start_time) == (other.pid, other.start_time)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def name(self):
+        return self._name
+
+
+class TreeProc(Ident):
+    """A process with a parent, like a ProcRecord"""
+    def __init__(self, pid, ppid, name):
+        super(TreeProc, self).__init__(pid, 100, name)
+        self.ppid = ppid
 
 
 class TestServices(unittest.TestCase):
@@ -89,5 +112,304 @@ class TestServices(unittest.TestCase):
         self.assertEqual(len(services.members['proc2']), 1)
 
 
+class TestProcessTable(unittest.TestCase):
+    """
+    Test suite for the ProcessTable object
+    """
+
+    @patch.object(alarmer.monitoring, 'psutil')
+    def test_process_table_indexes_by_name(self, mocked_psutil):
+        """
+        ProcessTable groups processes by their name
+        """
+        proc1 = FakeProc(name=lambda: 'proc1')
+        proc2 = FakeProc(name=lambda: 'proc1')
+        proc3 = FakeProc(name=lambda: 'proc2')
+        mocked_psutil.process_iter.return_value = [proc1, proc2, proc3]
+
+        table = alarmer.monitoring.ProcessTable()
+
+        self.assertEqual(table.lookup('proc1'), set([proc1, proc2]))
+        self.assertEqual(table.size, 3)
+
+    @patch.object(alarmer.monitoring, 'psutil')
+    def test_process_table_lookup_missing(self, mocked_psutil):
+        """
+        ProcessTable.lookup returns an empty set for unknown names
+        """
+        mocked_psutil.process_iter.return_value = []
+
+        table = alarmer.monitoring.ProcessTable()
+
+        self.assertEqual(table.lookup('nope'), set())
+
+    @patch.object(alarmer.monitoring, 'psutil')
+    def test_process_table_scans_once(self, mocked_psutil):
+        """
+        Many services share a single scan of the process table
+        """
+        proc1 = FakeProc(name=lambda: 'proc1', pid=1, is_running=lambda: True)
+        proc2 = FakeProc(name=lambda: 'proc2', pid=2, is_running=lambda: True)
+        mocked_psutil.process_iter.return_value = [proc1, proc2]
+
+        table = alarmer.monitoring.ProcessTable()
+        for idx in range(10):
+            alarmer.monitoring.Service('service{0}'.format(idx), ['proc1', 'proc2'], table=table)
+
+        self.assertEqual(mocked_psutil.process_iter.call_count, 1)
+
+
+    def test_process_table_skips_zombies(self):
+        """
+        ProcessTable ignores a process that exited but hasn't been reaped
+        """
+        child = subprocess.Popen(['sleep', '60'])
+        child.kill()
+        try:
+            while psutil.Process(child.pid).status() != psutil.STATUS_ZOMBIE:
+                time.sleep(0.01)
+            table = alarmer.monitoring.ProcessTable(names=set(['sleep']), scanner=psutil.process_iter)
+
+            self.assertFalse(child.pid in [x.pid for x in table.lookup('sleep')])
+        finally:
+            child.wait()
+
+
+class TestServiceIndex(unittest.TestCase):
+    """
+    Test suite for the ServiceIndex object
+    """
+
+    def test_service_index_shared_name(self):
+        """
+        ServiceIndex maps one process name to many services
+        """
+        index = alarmer.monitoring.ServiceIndex({'web': ['python', 'nginx'],
+                                                 'worker': ['python']})
+
+        expected = set([('web', 'python'), ('worker', 'python')])
+        found = set(index.services_for('python'))
+
+        self.assertEqual(expected, found)
+
+    def test_service_index_string_processes(self):
+        """
+        ServiceIndex rejects a string for the processes of a service
+        """
+        self.assertRaises(ValueError, alarmer.monitoring.ServiceIndex, {'web': 'nginx'})
+
+    @patch.object(alarmer.monitoring, 'psutil')
+    def test_service_index_route(self, mocked_psutil):
+        """
+        ServiceIndex.route fans a single scan out to every service
+        """
+        proc1 = FakeProc(name=lambda: 'python')
+        proc2 = FakeProc(name=lambda: 'nginx')
+        proc3 = FakeProc(name=lambda: 'bash')
+        mocked_psutil.process_iter.return_value = [proc1, proc2, proc3]
+        index = alarmer.monitoring.ServiceIndex({'web': ['python', 'nginx'],
+                                                 'worker': ['python']})
+        table = alarmer.monitoring.ProcessTable(names=index)
+
+        found = index.route(table)
+
+        expected = {'web': {'python': set([proc1]), 'nginx': set([proc2])},
+                    'worker': {'python': set([proc1])}}
+        self.assertEqual(expected, found)
+        self.assertFalse('bash' in table)
+
+
+class TestService(unittest.TestCase):
+    """
+    Test suite for the Service object
+    """
+
+    @patch.object(alarmer.monitoring, 'psutil')
+    def test_service_status_new_and_dead(self, mocked_psutil):
+        """
+        Service.status reports new and dead PIDs from the shared table
+        """
+        proc1 = FakeProc(name=lambda: 'proc1', pid=1, is_running=lambda: True)
+        mocked_psutil.process_iter.return_value = [proc1]
+        table = alarmer.monitoring.ProcessTable()
+        service = alarmer.monitoring.Service('service', ['proc1'], table=table)
+
+        proc1.is_running = lambda: False
+        proc2 = FakeProc(name=lambda: 'proc1', pid=2, is_running=lambda: True)
+        mocked_psutil.process_iter.return_value = [proc2]
+        table.refresh()
+
+        new_pids, dead_pids = service.status(table)
+
+        self.assertEqual(new_pids, {'proc1': [2]})
+        self.assertEqual(dead_pids, {'proc1': [1]})
+
+    def test_service_status_pid_reuse(self):
+        """
+        Service.status sees a reused PID as a death and a birth
+        """
+        old = Ident(pid=1, start_time=100, name='proc1')
+        table = alarmer.monitoring.ProcessTable(scanner=lambda: [old])
+        service = alarmer.monitoring.Service('service', ['proc1'], table=table)
+
+        new = Ident(pid=1, start_time=200, name='proc1')
+        table._scanner = lambda: [new]
+        table.refresh()
+        new_pids, dead_pids = service.status(table)
+
+        self.assertEqual(new_pids, {'proc1': [1]})
+        self.assertEqual(dead_pids, {'proc1': [1]})
+
+    def test_service_status_unchanged(self):
+        """
+        Service.status skips processes with no births or deaths since the last check
+        """
+        proc1 = Ident(pid=1, start_time=100, name='proc1')
+        table = alarmer.monitoring.ProcessTable(scanner=lambda: [proc1])
+        service = alarmer.monitoring.Service('service', ['proc1'], table=table)
+        before = table.lookup('proc1')
+
+        table.refresh()
+
+        self.assertTrue(table.lookup('proc1') is before)
+        self.assertEqual(service.status(table), ({}, {}))
+
+    def test_process_table_descendants(self):
+        """
+        ProcessTable finds every process under a process, whatever its name
+        """
+        master = TreeProc(10, 1, 'gunicorn')
+        worker = TreeProc(11, 10, 'gunicorn')
+        helper = TreeProc(12, 11, 'sh')
+        other = TreeProc(20, 1, 'bash')
+        table = alarmer.monitoring.ProcessTable(names=['gunicorn'], scanner=lambda: [master, worker, helper, other], tree=True)
+
+        self.assertEqual(sorted(x.pid for x in table.descendants(master)), [11, 12])
+        self.assertFalse('sh' in table)
+
+    def test_service_tree_workers(self):
+        """
+        Service in tree mode tracks the root, and counts the workers under it
+        """
+        procs = [TreeProc(10, 1, 'gunicorn'), TreeProc(11, 10, 'gunicorn'), TreeProc(12, 10, 'gunicorn')]
+        table = alarmer.monitoring.ProcessTable(scanner=lambda: list(procs), tree=True)
+        service = alarmer.monitoring.Service('web', ['gunicorn'], table=table, tree=(2, 4))
+
+        self.assertEqual(service.gunicorn, [10])
+        self.assertEqual(service.worker_breaches(), [])
+
+        procs[1:] = [TreeProc(13, 10, 'gunicorn')]
+        table.refresh()
+        new_pids, dead_pids = service.status(table)
+
+        self.assertEqual((new_pids, dead_pids), ({}, {}))
+        self.assertEqual(service.workers, {'gunicorn': (1, 1, 2)})
+        breaches = service.worker_breaches()
+        self.assertEqual(breaches[0][:2], ('gunicorn', 10))
+        self.assertTrue(breaches[0][2].startswith('1 workers, expected 2 to 4'))
+
+    def test_service_update(self):
+        """
+        Service.update keeps PIDs of processes that are still part of the service
+        """
+        proc1 = FakeProc(name=lambda: 'proc1', pid=1, is_running=lambda: True)
+        proc2 = FakeProc(name=lambda: 'proc2', pid=2, is_running=lambda: True)
+        table = MagicMock(lookup=lambda name: {'proc1': set([proc1]), 'proc2': set([proc2])}.get(name, set()))
+        service = alarmer.monitoring.Service('service', ['proc1', 'proc2'], table=table)
+
+        service.update(['proc1', 'proc3'])
+
+        self.assertEqual(sorted(service.processes), ['proc1', 'proc3'])
+        self.assertEqual(service.proc1, [1])
+        self.assertEqual(service.proc3, [])
+
+    def test_diff_services(self):
+        """
+        diff_services finds added, removed and changed services
+        """
+        old = {'web': ['nginx'], 'db': ['postgres'], 'cache': ['redis']}
+        new = {'web': ['nginx'], 'db': ['postgres', 'pgbouncer'], 'queue': ['rabbitmq']}
+
+        added, removed, changed = alarmer.monitoring.diff_services(old, new)
+
+        self.assertEqual(added, set(['queue']))
+        self.assertEqual(removed, set(['cache']))
+        self.assertEqual(changed, set(['db']))
+
+    def test_service_string_processes(self):
+        """
+        Service rejects a string for the processes param
+        """
+        self.assertRaises(ValueError, alarmer.monitoring.Service, 'service', 'proc1')
+
+
+class TestScheduler(unittest.TestCase):
+    """
+    Test suite for the Scheduler object
+    """
+
+    def test_scheduler_new_service_due(self):
+        """
+        Scheduler.add makes a service due right away
+        """
+        scheduler = alarmer.monitoring.Scheduler(10)
+        scheduler.add('web', now=100)
+
+        self.assertEqual(scheduler.due(now=100), ['web'])
+        self.assertEqual(scheduler.next_due(), 110)
+
+    def test_scheduler_intervals(self):
+        """
+        Scheduler checks each service at its own interval
+        """
+        scheduler = alarmer.monitoring.Scheduler(10, intervals={'db': 1})
+        scheduler.add('web', now=0)
+        scheduler.add('db', now=0)
+        scheduler.due(now=0)
+
+        checks = []
+        for now in range(1, 11):
+            checks.extend(scheduler.due(now=now))
+
+        self.assertEqual(checks.count('db'), 10)
+        self.assertEqual(checks.count('web'), 1)
+
+    def test_scheduler_no_catch_up(self):
+        """
+        Scheduler doesn't run missed checks back to back
+        """
+        scheduler = alarmer.monitoring.Scheduler(10)
+        scheduler.add('web', now=0)
+        scheduler.due(now=0)
+
+        self.assertEqual(scheduler.due(now=55), ['web'])
+        self.assertEqual(scheduler.due(now=55), [])
+        self.assertEqual(scheduler.next_due(), 65)
+
+    def test_scheduler_remove(self):
+        """
+        Scheduler.remove stops a service from coming due
+        """
+        scheduler = alarmer.monitoring.Scheduler(10)
+        scheduler.add('web', now=0)
+        scheduler.add('db', now=5)
+        scheduler.remove('web')
+
+        self.assertEqual(scheduler.next_due(), 5)
+        self.assertEqual(scheduler.due(now=20), ['db'])
+        self.assertFalse('web' in scheduler)
+
+    def test_scheduler_update(self):
+        """
+        Scheduler.update changes the interval used after the next check
+        """
+        scheduler = alarmer.monitoring.Scheduler(10, intervals={'web': 5})
+        scheduler.add('web', now=0)
+        scheduler.update(20)
+        scheduler.due(now=0)
+
+        self.assertEqual(scheduler.next_due(), 20)
+
+
 if __name__ == '__main__':
     unittest.main()